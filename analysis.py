@@ -8,8 +8,13 @@ import pandas as pd
 import geopandas as gpd
 import numpy as np
 
+import tracemalloc
+import time
+
 import data_manager
 import data_processing
+import arrow_engine
+import anomalies
 
 WORLD_STATS = ["new_cases", "daily_vaccinations"]
 US_STATS = [
@@ -42,6 +47,35 @@ US_STATS = [
     "85 years and over",
     "Under 1 year"
 ]
+US_COUNTY_STATS = ["new_case", "daily_vaccinations"]
+WORLD_DATASETS = [
+    "world_covid_data",
+    "world_covid_vaccinations",
+    "world_countries_map",
+    "world_country_centroids",
+    "world_population",
+]
+US_DATASETS = [
+    "us_covid_data",
+    "us_covid_vaccinations",
+    "us_covid_age_deaths",
+    "us_covid_ethnicity_deaths",
+    "us_states_map",
+    "us_population",
+]
+US_COUNTY_DATASETS = [
+    "us_county_covid_data",
+    "us_county_vaccinations",
+    "us_counties_map",
+    "us_county_population",
+]
+# Peak memory of analysis as a multiple of the consolidated data: one copy of it as
+# the per capita frame, plus population lookups and grouping
+ANALYSIS_MEMORY_CEILING = 1.5
+# Bytes analysis may use beyond the consolidated data and its results, set to analyze
+# world and US data a few jurisdictions at a time (None analyzes all at once)
+ANALYSIS_MEMORY_BUDGET = None
+COUNT_COL = "rows"
 
 
 def analyze_world_data(world_data, world_pop_data):
@@ -51,28 +85,51 @@ def analyze_world_data(world_data, world_pop_data):
 
     print("Analyzing world data...")
 
-    # Filter world case and vaccinations data to countries with known population
-    world_data = world_data[
-        world_data["iso_code"].isin(world_pop_data["Location"])
-    ].copy()
+    if ANALYSIS_MEMORY_BUDGET is not None:
+        return analyze_in_chunks(
+            world_data,
+            ["iso_code", "location"],
+            "date",
+            world_pop_data,
+            "Location",
+            "PopTotal",
+            WORLD_STATS,
+            "world",
+        )
+
+    # Filter world case and vaccinations data to countries with known population, and
+    # find per capita daily case and vaccination rates with each day's population
+    world_data = get_per_capita_data(
+        world_data,
+        world_data["iso_code"].isin(world_pop_data["Location"]),
+        WORLD_STATS,
+        "iso_code",
+        "date",
+        world_pop_data,
+        "Location",
+        "PopTotal",
+    )
 
-    # Find per capita daily case and vaccination rates
-    for index, row in world_pop_data.iterrows():
-        jurisdiction = world_data[world_data["iso_code"] == row["Location"]].copy()
-        jurisdiction[WORLD_STATS] /= row["PopTotal"]
-        world_data[world_data["iso_code"] == row["Location"]] = jurisdiction
+    # Flag, clip, or redistribute reporting dumps and negative corrections
+    if anomalies.ANOMALY_MODE is not None:
+        world_data = anomalies.handle_world_anomalies(world_data)
 
-    # Fill empty daily case and vaccination rate cells
-    filled_world_data = world_data.copy()
-    filled_world_data[WORLD_STATS] = filled_world_data[WORLD_STATS].fillna(0)
+    # Find average daily case and vaccination rates by country and by day on Arrow columns
+    if data_processing.DATAFRAME_ENGINE == "arrow":
+        average_per_cap_by_country, average_per_cap_by_day = arrow_engine.aggregate_means(
+            world_data, ["iso_code", "location"], "date", WORLD_STATS
+        )
+        return world_data, average_per_cap_by_country, average_per_cap_by_day
 
     # Find average daily case and vaccination rates for all the data for each country
-    agg_ops = dict.fromkeys(WORLD_STATS, 'mean')
-    agg_ops['geometry'] = 'first'
-    average_per_cap_by_country = filled_world_data.groupby(["iso_code", "location"]).agg(agg_ops)
+    by_country, rows = group_rows(world_data, ["iso_code", "location"])
+    average_per_cap_by_country = filled_means(by_country, WORLD_STATS, rows)
+    average_per_cap_by_country["geometry"] = by_country["geometry"].first().to_numpy()
+    del by_country
 
     # Find average daily case and vaccination rates for every day we have data on across countries
-    average_per_cap_by_day = filled_world_data.groupby("date")[WORLD_STATS].mean()
+    by_day, rows = group_rows(world_data, ["date"])
+    average_per_cap_by_day = filled_means(by_day, WORLD_STATS, rows)
 
     return world_data, average_per_cap_by_country, average_per_cap_by_day
 
@@ -84,35 +141,757 @@ def analyze_us_data(us_data, us_pop_data):
 
     print("Analyzing US data...")
 
-    # Filter US case and vaccinations data to states with known population
-    us_data = us_data[us_data["state"].isin(us_pop_data["NAME"])].copy()
+    if ANALYSIS_MEMORY_BUDGET is not None:
+        return analyze_in_chunks(
+            us_data,
+            ["state"],
+            "submission_date",
+            us_pop_data,
+            "NAME",
+            data_processing.US_POP_PREFIX,
+            US_STATS,
+            "us",
+        )
+
+    # Filter US case and vaccinations data to states with known population, and find per
+    # capita daily case, vaccination, age-based death, and ethnicity-based death rates
+    # with each day's population
+    us_data = get_per_capita_data(
+        us_data,
+        us_data["state"].isin(us_pop_data["NAME"]),
+        US_STATS,
+        "state",
+        "submission_date",
+        us_pop_data,
+        "NAME",
+        data_processing.US_POP_PREFIX,
+    )
 
-    # Find per capita daily case, vaccination, age-based death, and ethnicity-based death rates
-    for index, row in us_pop_data.iterrows():
-        jurisdiction = us_data[us_data["state"] == row["NAME"]].copy()
-        jurisdiction[US_STATS] /= row["POPESTIMATE2020"]
-        us_data[us_data["state"] == row["NAME"]] = jurisdiction
+    # Flag, clip, or redistribute reporting dumps and negative corrections
+    if anomalies.ANOMALY_MODE is not None:
+        us_data = anomalies.handle_us_anomalies(us_data)
 
-    # Fill empty daily case, vaccination, age-based death, and ethnicity-based death rate cells
-    filled_us_data = us_data.copy()
-    filled_us_data[US_STATS] = filled_us_data[US_STATS].fillna(0)
+    # Find average rates by state and by day on Arrow columns
+    if data_processing.DATAFRAME_ENGINE == "arrow":
+        average_per_cap_by_state, average_per_cap_by_day = arrow_engine.aggregate_means(
+            us_data, ["state"], "submission_date", US_STATS
+        )
+        return us_data, average_per_cap_by_state, average_per_cap_by_day
 
     # Find average rates for all the data for each state
-    agg_ops = dict.fromkeys(US_STATS, 'mean')
-    agg_ops['geometry'] = 'first'
-    average_per_cap_by_state = filled_us_data.groupby(["state"]).agg(agg_ops)
+    by_state, rows = group_rows(us_data, ["state"])
+    average_per_cap_by_state = filled_means(by_state, US_STATS, rows)
+    average_per_cap_by_state["geometry"] = by_state["geometry"].first().to_numpy()
+    del by_state
 
     # Find average rates for every day we have data on across states
-    average_per_cap_by_day = filled_us_data.groupby("submission_date")[US_STATS].mean()
+    by_day, rows = group_rows(us_data, ["submission_date"])
+    average_per_cap_by_day = filled_means(by_day, US_STATS, rows)
 
     return us_data, average_per_cap_by_state, average_per_cap_by_day
 
 
+def analyze_us_county_data(us_county_data, us_county_pop_data):
+    """
+    Analyzes the consolidated US county and county population data, returns several smaller datasets with per capita rate calculations
+    """
+
+    print("Analyzing US county data...")
+
+    # Filter county case and vaccination data to counties with known population, and
+    # find per capita daily case and vaccination rates with each day's population
+    us_county_data = get_per_capita_data(
+        us_county_data,
+        us_county_data["fips"].isin(us_county_pop_data["FIPS"]),
+        US_COUNTY_STATS,
+        "fips",
+        "date",
+        us_county_pop_data,
+        "FIPS",
+        data_processing.US_POP_PREFIX,
+    )
+
+    # Find average rates by county and by day on Arrow columns
+    if data_processing.DATAFRAME_ENGINE == "arrow":
+        average_per_cap_by_county, average_per_cap_by_day = arrow_engine.aggregate_means(
+            us_county_data, ["state", "fips"], "date", US_COUNTY_STATS
+        )
+        return us_county_data, average_per_cap_by_county, average_per_cap_by_day
+
+    # Find average rates for all the data for each county
+    by_county, rows = group_rows(us_county_data, ["state", "fips"])
+    average_per_cap_by_county = filled_means(by_county, US_COUNTY_STATS, rows)
+    average_per_cap_by_county["geometry"] = by_county["geometry"].first().to_numpy()
+    del by_county
+
+    # Find average rates for every day we have data on across counties
+    by_day, rows = group_rows(us_county_data, ["date"])
+    average_per_cap_by_day = filled_means(by_day, US_COUNTY_STATS, rows)
+
+    return us_county_data, average_per_cap_by_county, average_per_cap_by_day
+
+
+def analyze_in_chunks(
+    data,
+    jurisdiction_cols,
+    date_col,
+    pop_data,
+    pop_locations_col,
+    pop_col,
+    stats,
+    region,
+):
+    """
+    Analyze consolidated world or US data like analyze_world_data and analyze_us_data,
+    but a few whole jurisdictions at a time so that memory used beyond the data and
+    its results stays within ANALYSIS_MEMORY_BUDGET. Each chunk adds partial sums and
+    counts to the averages by jurisdiction, and a second pass over whole days does
+    the same for the averages by day. Since every group is summed within one chunk
+    in its original row order, the means are identical to analyzing everything at
+    once. Always runs on the pandas engine
+    """
+
+    jurisdiction_col = jurisdiction_cols[0]
+    keep = data[jurisdiction_col].isin(pop_data[pop_locations_col]).to_numpy()
+    kept_rows = np.flatnonzero(keep)
+
+    # As many rows per chunk as fit in the budget left after the row positions, at
+    # the peak memory analysis needs per byte of data on top of copying the chunk
+    # out of it. Ordering the rows briefly needs about four positions per row
+    row_size = data.memory_usage(deep=False).sum() / max(len(data), 1)
+    chunk_rows = int(
+        (ANALYSIS_MEMORY_BUDGET - keep.nbytes - 2 * kept_rows.nbytes)
+        / ((1 + ANALYSIS_MEMORY_CEILING) * row_size)
+    )
+    if chunk_rows < 1 or ANALYSIS_MEMORY_BUDGET < keep.nbytes + 4 * kept_rows.nbytes:
+        raise ValueError(
+            "ANALYSIS_MEMORY_BUDGET is too small to analyze " + region + " data in chunks"
+        )
+
+    # Stats are filled in chunk by chunk, other columns are taken once
+    columns = {
+        column: np.empty(len(kept_rows)) if column in stats else data[column].array[keep]
+        for column in data.columns
+    }
+    by_jurisdiction, geometry, by_day, anomaly_summaries = [], [], [], []
+
+    if anomalies.ANOMALY_MODE is not None:
+        print("Detecting anomalies in " + region + " data...")
+
+    order, bounds = get_chunks(np.asarray(columns[jurisdiction_col]), chunk_rows)
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        positions = np.sort(order[start:end])
+        chunk = data.iloc[kept_rows[positions]]
+        chunk = get_per_capita_data(
+            chunk,
+            pd.Series(True, index=chunk.index),
+            stats,
+            jurisdiction_col,
+            date_col,
+            pop_data,
+            pop_locations_col,
+            pop_col,
+        )
+
+        # Anomalies are found per jurisdiction, so chunks hold whole jurisdictions
+        if anomalies.ANOMALY_MODE is not None:
+            chunk, summary = anomalies.handle_anomalies(
+                chunk,
+                jurisdiction_col,
+                date_col,
+                anomalies.WORLD_ANOMALY_STATS
+                if region == "world"
+                else anomalies.US_ANOMALY_STATS,
+            )
+            anomaly_summaries.append(summary)
+
+        for stat in stats:
+            columns[stat][positions] = chunk[stat].to_numpy()
+
+        grouped = chunk.groupby(jurisdiction_cols)
+        by_jurisdiction.append(partial_sums(grouped, stats))
+        geometry.append(grouped["geometry"].first())
+        del chunk, grouped
+
+    # Per capita stats of whole days at a time
+    del order
+    order, bounds = get_chunks(
+        np.asarray(columns[date_col], dtype="datetime64[ns]"), chunk_rows
+    )
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        positions = np.sort(order[start:end])
+        chunk = pd.DataFrame(
+            {column: columns[column][positions] for column in [date_col] + stats}
+        )
+        by_day.append(partial_sums(chunk.groupby(date_col), stats))
+        del chunk
+
+    if anomalies.ANOMALY_MODE is not None:
+        anomalies.export_anomalies(
+            pd.concat(anomaly_summaries, ignore_index=True), region
+        )
+
+    average_per_cap_by_jurisdiction = merge_means(by_jurisdiction)
+    average_per_cap_by_jurisdiction["geometry"] = pd.concat(geometry)
+    average_per_cap_by_day = merge_means(by_day)
+
+    return (
+        pd.DataFrame(columns, index=data.index[keep], copy=False),
+        average_per_cap_by_jurisdiction,
+        average_per_cap_by_day,
+    )
+
+
+def get_chunks(keys, chunk_rows):
+    """
+    Return the positions of an array of keys ordered by key, and the bounds splitting
+    those positions into chunks of whole keys with at most chunk_rows rows each (or a
+    single key, if it has more rows than that)
+    """
+
+    # Where each key's rows end, without hashing every row
+    order = np.argsort(keys, kind="stable")
+    ordered_keys = keys[order]
+    ends = np.append(
+        np.flatnonzero(ordered_keys[1:] != ordered_keys[:-1]) + 1, len(keys)
+    )
+    del ordered_keys
+
+    bounds = [0]
+    while bounds[-1] < len(order):
+        fitting = ends[(ends > bounds[-1]) & (ends <= bounds[-1] + chunk_rows)]
+        bounds.append(fitting[-1] if len(fitting) else ends[ends > bounds[-1]][0])
+
+    return order, bounds
+
+
+def get_per_capita_data(
+    data, keep, stats, data_locations_col, date_col, pop_data, pop_locations_col, pop_col
+):
+    """
+    Return the rows of data marked to keep, with each stat divided by the row's
+    population on the row's date. The kept rows are copied once, and only their
+    populations are looked up, so the stats are divided in place on that copy
+    """
+
+    # Stats are copied last, once the populations are found and their lookups freed
+    keep = keep.to_numpy()
+    columns = {
+        column: None if column in stats else data[column].array[keep]
+        for column in data.columns
+    }
+    index = data.index[keep]
+
+    population = data_processing.get_daily_population(
+        pd.DataFrame(
+            {
+                data_locations_col: columns[data_locations_col],
+                date_col: columns[date_col],
+            },
+            index=index,
+            copy=False,
+        ),
+        data_locations_col,
+        date_col,
+        pop_data,
+        pop_locations_col,
+        pop_col,
+    ).to_numpy()
+    for stat in stats:
+        columns[stat] = data[stat].to_numpy(dtype=float)[keep]
+        columns[stat] /= population
+    del population
+
+    return pd.DataFrame(columns, index=index, copy=False)
+
+
+def group_rows(data, key_cols):
+    """
+    Group the rows of data by key columns like data.groupby(key_cols), without pandas
+    hashing every row of every key column at once. Each row's group is looked up a
+    block of rows at a time among the sorted unique keys, and the rows are grouped by
+    a categorical of those group numbers. Returns the grouping, whose results are in
+    key order, and the number of rows in each group indexed by its keys
+    """
+
+    block_rows = data_processing.LOOKUP_BLOCK_ROWS
+    starts = range(0, len(data), block_rows)
+    values = [data[column].to_numpy() for column in key_cols]
+
+    # Every column's sorted unique keys, found a block at a time
+    uniques = []
+    for column_values in values:
+        column_uniques = [column_values[:0]]
+        for start in starts:
+            column_uniques.append(pd.unique(column_values[start : start + block_rows]))
+        uniques.append(
+            pd.Index(pd.unique(np.concatenate(column_uniques))).dropna().sort_values()
+        )
+    sizes = [len(column_uniques) for column_uniques in uniques]
+
+    # Number every combination of keys in key order (-1 if any key is missing), and
+    # count the rows of each
+    dtype = np.min_scalar_type(-max(int(np.prod(sizes)), 1))
+    codes = np.empty(len(data), dtype=dtype)
+    counts = np.zeros(int(np.prod(sizes)) + 1, dtype=np.int64)
+    for start in starts:
+        block = np.zeros(min(block_rows, len(data) - start), dtype=np.int64)
+        for column_values, column_uniques in zip(values, uniques):
+            column_codes = column_uniques.get_indexer(
+                column_values[start : start + block_rows]
+            )
+            block = np.where(
+                (block < 0) | (column_codes < 0),
+                -1,
+                block * len(column_uniques) + column_codes,
+            )
+        codes[start : start + block_rows] = block
+        counts += np.bincount(block + 1, minlength=len(counts))
+
+    # Renumber the combinations that have rows, so there is a group for each
+    observed = np.flatnonzero(counts[1:])
+    groups = np.full(len(counts), -1, dtype=dtype)
+    groups[observed + 1] = np.arange(len(observed))
+    for start in starts:
+        codes[start : start + block_rows] = groups[
+            codes[start : start + block_rows].astype(np.int64) + 1
+        ]
+
+    # Label each group with its keys
+    keys = []
+    combinations = observed
+    for column_uniques, size in zip(reversed(uniques), reversed(sizes)):
+        keys.insert(0, column_uniques.take(combinations % size))
+        combinations = combinations // size
+    if len(key_cols) == 1:
+        keys = keys[0].rename(key_cols[0])
+    else:
+        keys = pd.MultiIndex.from_arrays(keys, names=key_cols)
+
+    grouped = data.groupby(
+        pd.Categorical.from_codes(codes, categories=pd.RangeIndex(len(observed))),
+        observed=False,
+    )
+
+    return grouped, pd.Series(counts[observed + 1], index=keys)
+
+
+def filled_means(grouped, stats, rows=None):
+    """
+    Return the mean of every stat in each group with missing values counted as 0,
+    without filling in a copy of the data first. Groupings from group_rows take the
+    row counts it returns
+    """
+
+    return merge_means([partial_sums(grouped, stats, rows)])
+
+
+def partial_sums(grouped, stats, rows=None):
+    """
+    Return the sum of every stat in each group with missing values counted as 0, and
+    the number of rows in each group, which merge_means combines across chunks.
+    Groupings from group_rows take the row counts it returns, which also label the
+    sums with each group's keys
+    """
+
+    # Summing one column at a time avoids copying every stat into a single block
+    sums = pd.DataFrame({stat: grouped[stat].sum() for stat in stats})
+    if rows is None:
+        sums[COUNT_COL] = grouped.size()
+    else:
+        sums.index = rows.index
+        sums[COUNT_COL] = rows.to_numpy()
+
+    return sums
+
+
+def merge_means(partials):
+    """
+    Return the mean of every stat in each group from the partial sums of one or more
+    chunks of data
+    """
+
+    if len(partials) == 1:
+        sums = partials[0]
+    else:
+        sums = pd.concat(partials)
+        sums = sums.groupby(level=list(range(sums.index.nlevels))).sum()
+
+    return sums.drop(columns=COUNT_COL).div(sums[COUNT_COL], axis=0)
+
+
+def run_world_pipeline(data):
+    """
+    Consolidate and analyze world data from the raw datasets in WORLD_DATASETS
+    """
+
+    world_c_data = data_processing.consolidate_world_data(data)
+    world_pop = data_processing.get_world_pop_data(data)
+
+    return analyze_world_data(world_c_data, world_pop)
+
+
+def run_us_pipeline(data):
+    """
+    Consolidate and analyze US data from the raw datasets in US_DATASETS
+    """
+
+    us_c_data = data_processing.consolidate_us_data(data)
+    us_pop = data_processing.get_us_pop_data(data)
+
+    return analyze_us_data(us_c_data, us_pop)
+
+
+def run_us_county_pipeline(data):
+    """
+    Consolidate and analyze US county data from the raw datasets in US_COUNTY_DATASETS
+    """
+
+    us_county_c_data = data_processing.consolidate_us_county_data(data)
+    us_county_pop = data_processing.get_us_county_pop_data(data)
+
+    return analyze_us_county_data(us_county_c_data, us_county_pop)
+
+
+def run_pipeline(data, engine):
+    """
+    Consolidate and analyze world and US data with the given dataframe engine,
+    returning the world and US results
+    """
+
+    previous_engine = data_processing.DATAFRAME_ENGINE
+    data_processing.DATAFRAME_ENGINE = engine
+
+    try:
+        world_results = run_world_pipeline(data)
+        us_results = run_us_pipeline(data)
+    finally:
+        data_processing.DATAFRAME_ENGINE = previous_engine
+
+    return world_results, us_results
+
+
+def run_with_engine(engine, function, *args):
+    """
+    Return the result of calling a function with the given dataframe engine
+    """
+
+    previous_engine = data_processing.DATAFRAME_ENGINE
+    data_processing.DATAFRAME_ENGINE = engine
+
+    try:
+        return function(*args)
+    finally:
+        data_processing.DATAFRAME_ENGINE = previous_engine
+
+
+def test_engine_equivalence():
+    """
+    Test that every step with an arrow implementation gives the same results on both
+    dataframe engines, on small synthetic datasets that need no downloads
+    """
+
+    rng = np.random.default_rng(0)
+    dates = pd.date_range("2021-01-01", periods=6)
+    state_ids = pd.read_csv(data_processing.STATE_IDENTIFIERS)
+    states = state_ids.iloc[:3]
+
+    # Case data for every day, vaccinations for some, and a territory to filter out
+    data = {
+        "world_covid_data": pd.DataFrame(
+            {
+                "location": np.repeat(["Aland", "Bland"], len(dates)),
+                "date": np.tile(dates, 2),
+                "iso_code": np.repeat(["AAA", "BBB"], len(dates)),
+                "new_cases": rng.random(2 * len(dates)),
+            }
+        ),
+        "us_covid_data": pd.DataFrame(
+            {
+                "state": np.repeat(list(states["Identifier"]) + ["PR"], len(dates)),
+                "submission_date": np.tile(dates, len(states) + 1),
+                "new_case": rng.random((len(states) + 1) * len(dates)),
+            }
+        ),
+        "us_covid_vaccinations": pd.DataFrame(
+            {
+                "location": np.repeat(states["Name"], 4),
+                "date": np.tile(dates[2:], len(states)),
+                "daily_vaccinations": rng.random(4 * len(states)),
+            }
+        ),
+    }
+    data["world_covid_vaccinations"] = data["world_covid_data"].iloc[3:].rename(
+        columns={"new_cases": "daily_vaccinations"}
+    )
+
+    # Ethnicity and age deaths on partly different dates and states
+    data["us_covid_ethnicity_deaths"] = pd.DataFrame(
+        {
+            "Date": np.repeat(dates[:3], 2),
+            "State": np.tile(states["Identifier"].iloc[:2], 3),
+            **{
+                column: rng.random(6)
+                for column in [
+                    "Deaths_Total",
+                    "Deaths_White",
+                    "Deaths_Black",
+                    "Deaths_Latinx",
+                    "Deaths_Asian",
+                    "Deaths_AIAN",
+                    "Deaths_NHPI",
+                    "Deaths_Multiracial",
+                    "Deaths_Other",
+                    "Deaths_Unknown",
+                ]
+            },
+        }
+    )
+    age_groups = ["All Ages", "0-17 years", "18-64 years", "65+ years"]
+    data["us_covid_age_deaths"] = pd.DataFrame(
+        {
+            "End Date": np.repeat(dates[1:4], 2 * len(age_groups)),
+            "State": np.tile(np.repeat(states["Name"].iloc[1:3], len(age_groups)), 3),
+            "Sex": "All Sexes",
+            "Age Group": np.tile(age_groups, 6),
+            "COVID-19 Deaths": rng.random(6 * len(age_groups)),
+        }
+    )
+
+    # Death data with dates and states the case data does not have
+    deaths = pd.DataFrame(
+        {
+            "Date": pd.to_datetime(["2021-01-02", "2020-12-31", "2021-01-03"]),
+            "State": [states["Identifier"].iloc[0], "WA", states["Identifier"].iloc[1]],
+            "Deaths_Total": [1.0, 2.0, 3.0],
+        }
+    )
+
+    world_data, world_pop_data = get_synthetic_world_data(20, 60)
+    steps = [
+        (data_processing.process_world_data, (data,), ["location", "date", "iso_code"]),
+        (data_processing.process_us_data, (data, state_ids), ["state", "submission_date"]),
+        (data_processing.process_us_age_ethnicity_data, (data, state_ids), None),
+        (
+            data_processing.merge_us_deaths_data,
+            (data_processing.process_us_data(data, state_ids), deaths),
+            None,
+        ),
+        (analyze_world_data, (world_data, world_pop_data), ["location", "date"]),
+    ]
+
+    for function, args, keys in steps:
+        expected = run_with_engine("pandas", function, *args)
+        actual = run_with_engine("arrow", function, *args)
+        if not isinstance(expected, tuple):
+            expected, actual = (expected,), (actual,)
+
+        for i, (expected_result, actual_result) in enumerate(zip(expected, actual)):
+
+            # Per-row results may come back in a different row order, aggregates
+            # are indexed the same way by both engines
+            if i == 0:
+                if keys is not None:
+                    expected_result = expected_result.sort_values(keys)
+                    actual_result = actual_result.sort_values(keys)
+                expected_result = expected_result.reset_index(drop=True)
+                actual_result = actual_result.reset_index(drop=True)
+            pd.testing.assert_frame_equal(
+                expected_result,
+                actual_result[expected_result.columns],
+                check_dtype=False,
+            )
+
+    print("Engine equivalence test passed")
+
+
+def compare_engines(data):
+    """
+    Test that the arrow dataframe engine produces the same results as the pandas engine
+    """
+
+    pandas_results = run_pipeline(data, "pandas")
+    arrow_results = run_pipeline(data, "arrow")
+
+    for expected_results, actual_results, keys in zip(
+        pandas_results,
+        arrow_results,
+        [["location", "date", "iso_code"], ["submission_date", "state"]],
+    ):
+
+        # Per-row results may come back in a different row order
+        expected, actual = (
+            frame.sort_values(keys).reset_index(drop=True)
+            for frame in (expected_results[0], actual_results[0])
+        )
+        pd.testing.assert_frame_equal(expected, actual[expected.columns], check_dtype=False)
+
+        # Aggregates are indexed the same way by both engines
+        for expected, actual in zip(expected_results[1:], actual_results[1:]):
+            pd.testing.assert_frame_equal(expected, actual, check_dtype=False)
+
+    print("Arrow engine results match pandas engine results")
+
+
+def benchmark_engines(data, repeats=3):
+    """
+    Time the full consolidation and analysis with the pandas engine and with the
+    arrow engine using one thread and every core
+    """
+
+    results = []
+    cpu_count = arrow_engine.pa.cpu_count()
+
+    for engine, threads in [("pandas", 1), ("arrow", 1), ("arrow", cpu_count)]:
+        arrow_engine.pa.set_cpu_count(threads)
+
+        timings = []
+        for i in range(repeats):
+            start = time.perf_counter()
+            run_pipeline(data, engine)
+            timings.append(time.perf_counter() - start)
+
+        results.append({"Engine": engine, "Threads": threads, "Seconds": min(timings)})
+
+    arrow_engine.pa.set_cpu_count(cpu_count)
+
+    results = pd.DataFrame(results)
+    results["Speedup"] = results["Seconds"].iloc[0] / results["Seconds"]
+    print(results)
+
+    return results
+
+
+def benchmark_us_tiers(data):
+    """
+    Time the US pipeline at state and at county resolution, reporting how the run
+    time scales with the number of rows and jurisdictions
+    """
+
+    results = []
+    for tier, pipeline, jurisdiction_col in [
+        ("state", run_us_pipeline, "state"),
+        ("county", run_us_county_pipeline, "fips"),
+    ]:
+        start = time.perf_counter()
+        daily_results = pipeline(data)[0]
+        seconds = time.perf_counter() - start
+
+        results.append(
+            {
+                "Tier": tier,
+                "Rows": len(daily_results),
+                "Jurisdictions": daily_results[jurisdiction_col].nunique(),
+                "Seconds": seconds,
+            }
+        )
+
+    results = pd.DataFrame(results)
+    results["Microseconds_Per_Row"] = results["Seconds"] / results["Rows"] * 1e6
+    print(results)
+
+    return results
+
+
+def get_synthetic_world_data(jurisdictions, days):
+    """
+    Return a synthetic consolidated world history and world population data, with
+    some days missing vaccinations
+    """
+
+    rng = np.random.default_rng(0)
+    codes = ["C" + str(i) for i in range(jurisdictions)]
+    world_data = pd.DataFrame(
+        {
+            "location": np.repeat(codes, days),
+            "date": np.tile(pd.date_range("2020-01-01", periods=days), jurisdictions),
+            "iso_code": np.repeat(codes, days),
+            "new_cases": rng.poisson(100, jurisdictions * days).astype(float),
+            "daily_vaccinations": rng.poisson(100, jurisdictions * days).astype(float),
+            "geometry": None,
+        }
+    )
+    world_data.loc[world_data.index % 7 == 0, "daily_vaccinations"] = np.nan
+    world_pop_data = pd.DataFrame(
+        {
+            "Location": np.repeat(codes, 6),
+            "Time": np.tile(np.arange(2019, 2025), jurisdictions),
+            "PopTotal": rng.uniform(1e5, 1e8, jurisdictions * 6),
+        }
+    )
+
+    return world_data, world_pop_data
+
+
+def test_analysis_memory(jurisdictions=200, days=1000):
+    """
+    Test that analyzing a synthetic world history peaks below ANALYSIS_MEMORY_CEILING
+    times the size of the consolidated data, which leaves room for one copy of it
+    and half as much again for population lookups and grouping
+    """
+
+    world_data, world_pop_data = get_synthetic_world_data(jurisdictions, days)
+    data_size = world_data.memory_usage(deep=False).sum()
+    tracemalloc.start()
+    analyze_world_data(world_data, world_pop_data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print(
+        "Analysis peaked at "
+        + str(round(peak / data_size, 2))
+        + " times the size of the consolidated data"
+    )
+    assert peak < ANALYSIS_MEMORY_CEILING * data_size
+
+    print("Analysis memory test passed")
+
+
+def test_chunked_analysis(jurisdictions=200, days=1000):
+    """
+    Test that analyzing a synthetic world history in chunks gives identical results
+    to analyzing it all at once, while using no more than ANALYSIS_MEMORY_BUDGET
+    beyond the data and results
+    """
+
+    global ANALYSIS_MEMORY_BUDGET
+
+    world_data, world_pop_data = get_synthetic_world_data(jurisdictions, days)
+    data_size = world_data.memory_usage(deep=False).sum()
+    expected = analyze_world_data(world_data, world_pop_data)
+
+    previous_budget = ANALYSIS_MEMORY_BUDGET
+    ANALYSIS_MEMORY_BUDGET = data_size
+    try:
+        tracemalloc.start()
+        actual = analyze_world_data(world_data, world_pop_data)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        ANALYSIS_MEMORY_BUDGET = previous_budget
+
+    for expected_result, actual_result in zip(expected, actual):
+        pd.testing.assert_frame_equal(expected_result, actual_result, check_exact=True)
+
+    results_size = sum(result.memory_usage(deep=False).sum() for result in actual)
+    print(
+        "Chunked analysis used "
+        + str(round((peak - results_size) / data_size, 2))
+        + " times its memory budget beyond its results"
+    )
+    assert peak - results_size <= data_size
+
+    print("Chunked analysis test passed")
+
+
 def main():
     """
     Tests all methods in analysis
     """
 
+    # Test that both dataframe engines agree without any downloaded data
+    test_engine_equivalence()
+
     datasets = data_manager.get_dataset_info()
     data_manager.update_datasets(datasets)
     data = data_manager.retrieve_datasets(datasets)
@@ -127,6 +906,19 @@ def main():
     us_pop = data_processing.get_us_pop_data(data)
     print(analyze_us_data(us_c_data, us_pop))
 
+    # Test US county analysis, and how it scales against state analysis
+    print(run_us_county_pipeline(data))
+    benchmark_us_tiers(data)
+
+    # Test that analysis stays within its peak memory ceiling, and within its memory
+    # budget when run in chunks
+    test_analysis_memory()
+    test_chunked_analysis()
+
+    # Test and time the arrow dataframe engine against the pandas engine
+    compare_engines(data)
+    benchmark_engines(data)
+
 
 if __name__ == "__main__":
     main()
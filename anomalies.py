@@ -0,0 +1,280 @@
+"""
+Daniel Rashevsky
+CSE 163 AE
+This file detects reporting dumps and negative corrections in daily case counts for
+every country and US state at once, flagging, clipping, or redistributing them
+before the all-time averages are taken
+"""
+
+import pandas as pd
+import numpy as np
+
+import time
+import os
+
+import data_manager
+import data_processing
+
+# One of None (off), "flag", "clip", or "redistribute"
+ANOMALY_MODE = None
+ANOMALY_PATH = "anomalies"
+ANOMALY_WINDOW_DAYS = 15
+ANOMALY_MIN_DAYS = 7
+# Above the robust z of a weekly reporting cadence (about 6 over ANOMALY_WINDOW_DAYS),
+# below that of a single dump in an otherwise flat window (about 12)
+ANOMALY_THRESHOLD = 7
+REDISTRIBUTE_DAYS = 14
+WORLD_ANOMALY_STATS = ["new_cases"]
+US_ANOMALY_STATS = ["new_case"]
+MAD_SCALE = 0.6745
+MEAN_AD_SCALE = 0.7979
+
+
+def robust_z_scores(matrix):
+    """
+    Given a date x jurisdiction matrix, return the rolling median and robust z-score
+    of every value over a centered window of ANOMALY_WINDOW_DAYS, for all jurisdictions
+    in one pass. Windows whose median absolute deviation is 0 fall back to the mean
+    absolute deviation around the median
+    """
+
+    rolling = dict(window=ANOMALY_WINDOW_DAYS, center=True, min_periods=ANOMALY_MIN_DAYS)
+
+    median = matrix.rolling(**rolling).median()
+    deviation = (matrix - median).abs()
+    mad = deviation.rolling(**rolling).median() / MAD_SCALE
+    mean_ad = deviation.rolling(**rolling).mean() / MEAN_AD_SCALE
+    scale = mad.where(mad > 0, mean_ad)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        z = (matrix - median) / scale
+
+    # A value differing from a window of identical values is infinitely far off
+    z = z.mask((scale == 0) & (deviation == 0), 0.0)
+
+    return median, scale, z
+
+
+def redistribute(values, excess):
+    """
+    Given date x jurisdiction arrays of values and of the excess removed from anomalous
+    days, spread each day's excess evenly over the known days among the
+    REDISTRIBUTE_DAYS before it, keeping every jurisdiction's total unchanged. Excess
+    with no known day before it is left where it was
+    """
+
+    known = pd.DataFrame(~np.isnan(values), dtype=float)
+    excess = pd.DataFrame(excess)
+
+    # Known days among the REDISTRIBUTE_DAYS before each day
+    previous_known = known.rolling(REDISTRIBUTE_DAYS, min_periods=1).sum()
+    previous_known = previous_known.shift(1).fillna(0)
+    stranded = (previous_known == 0) & (excess != 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        share = (excess / previous_known).where(~stranded, 0.0)
+
+    # Each day receives the shares of the REDISTRIBUTE_DAYS after it
+    received = share[::-1].rolling(REDISTRIBUTE_DAYS, min_periods=1).sum().shift(1)[::-1]
+    received = received.fillna(0) * known
+
+    return values + received.to_numpy() + np.where(stranded, excess, 0.0)
+
+
+def handle_anomalies(data, jurisdiction_col, date_col, stats, mode=None):
+    """
+    Find anomalous days of each stat for every jurisdiction, where the robust z-score
+    exceeds ANOMALY_THRESHOLD or the value is negative, and flag, clip, or redistribute
+    them. Returns the data, with anomalies replaced unless only flagging, and a summary
+    of every anomaly found
+    """
+
+    mode = ANOMALY_MODE if mode is None else mode
+    start = time.perf_counter()
+
+    # Position of every row in the date x jurisdiction matrices
+    dates = pd.date_range(data[date_col].min(), data[date_col].max())
+    jurisdictions = pd.Index(data[jurisdiction_col].dropna().unique())
+    rows = dates.get_indexer(data[date_col])
+    cols = jurisdictions.get_indexer(data[jurisdiction_col])
+    placed = (rows >= 0) & (cols >= 0)
+    rows, cols = rows[placed], cols[placed]
+
+    data = data.copy()
+    summary = []
+
+    for stat in stats:
+        values = np.full((len(dates), len(jurisdictions)), np.nan)
+        values[rows, cols] = data.loc[placed, stat].to_numpy(dtype=float)
+        matrix = pd.DataFrame(values, index=dates, columns=jurisdictions)
+
+        median, scale, z = robust_z_scores(matrix)
+        anomalous = ((z.abs() > ANOMALY_THRESHOLD) | (matrix < 0)).to_numpy()
+
+        # Clip to the nearest value within the threshold, never below zero
+        lower = (median - ANOMALY_THRESHOLD * scale).clip(lower=0).to_numpy()
+        upper = (median + ANOMALY_THRESHOLD * scale).to_numpy()
+        clipped = np.clip(values, np.where(np.isnan(lower), 0, lower), upper)
+        clipped = np.where(anomalous, np.where(np.isnan(clipped), 0, clipped), values)
+
+        if mode == "clip":
+            replaced = clipped
+        elif mode == "redistribute":
+            replaced = redistribute(clipped, np.where(anomalous, values - clipped, 0.0))
+        else:
+            replaced = values
+
+        data.loc[placed, stat] = replaced[rows, cols]
+
+        days, places = np.nonzero(anomalous)
+        summary.append(
+            pd.DataFrame(
+                {
+                    jurisdiction_col: jurisdictions[places],
+                    date_col: dates[days],
+                    "stat": stat,
+                    "value": values[days, places],
+                    "rolling_median": median.to_numpy()[days, places],
+                    "robust_z": z.to_numpy()[days, places],
+                    "replaced_value": replaced[days, places],
+                }
+            )
+        )
+
+    summary = pd.concat(summary, ignore_index=True)
+    print(
+        "Found "
+        + str(len(summary))
+        + " anomalies in "
+        + str(round(time.perf_counter() - start, 3))
+        + "s"
+    )
+
+    return data, summary
+
+
+def export_anomalies(summary, name):
+    """
+    Save the summary of anomalies found in a run as a CSV in ANOMALY_PATH
+    """
+
+    if not os.path.isdir(ANOMALY_PATH):
+        os.mkdir(ANOMALY_PATH)
+
+    summary.to_csv(ANOMALY_PATH + "/" + name + "_anomalies.csv", index=False)
+
+
+def handle_world_anomalies(world_data):
+    """
+    Handle anomalies in daily world stats by country with ANOMALY_MODE, exporting
+    a summary of them
+    """
+
+    print("Detecting anomalies in world data...")
+
+    world_data, summary = handle_anomalies(
+        world_data, "iso_code", "date", WORLD_ANOMALY_STATS
+    )
+    export_anomalies(summary, "world")
+
+    return world_data
+
+
+def handle_us_anomalies(us_data):
+    """
+    Handle anomalies in daily US stats by state with ANOMALY_MODE, exporting
+    a summary of them
+    """
+
+    print("Detecting anomalies in US data...")
+
+    us_data, summary = handle_anomalies(
+        us_data, "state", "submission_date", US_ANOMALY_STATS
+    )
+    export_anomalies(summary, "us")
+
+    return us_data
+
+
+def test_handle_anomalies():
+    """
+    Test that dumps and negative corrections are found, that the z-scores match a
+    per-jurisdiction rolling computation, and that each mode handles them
+    """
+
+    rng = np.random.default_rng(0)
+    dates = pd.date_range("2021-01-01", periods=60)
+    data = pd.DataFrame(
+        {
+            "state": np.repeat(["WA", "OR"], 60),
+            "submission_date": np.tile(dates, 2),
+            "new_case": rng.poisson(100, 120).astype(float),
+        }
+    )
+    data.loc[30, "new_case"] = 2000.0
+    data.loc[90, "new_case"] = -300.0
+    data.loc[100, "new_case"] = np.nan
+
+    flagged, summary = handle_anomalies(
+        data, "state", "submission_date", ["new_case"], "flag"
+    )
+    assert flagged["new_case"].equals(data["new_case"])
+    assert set(zip(summary["state"], summary["submission_date"])) == {
+        ("WA", dates[30]),
+        ("OR", dates[30]),
+    }
+
+    # Batched z-scores match rolling each jurisdiction on its own
+    for state, group in data.groupby("state"):
+        series = group.set_index("submission_date")["new_case"]
+        median = series.rolling(
+            ANOMALY_WINDOW_DAYS, center=True, min_periods=ANOMALY_MIN_DAYS
+        ).median()
+        expected = summary.loc[summary["state"] == state, "rolling_median"]
+        assert np.isclose(expected, median[dates[30]]).all()
+
+    # Clipping keeps anomalies within bounds and never below zero
+    clipped, summary = handle_anomalies(
+        data, "state", "submission_date", ["new_case"], "clip"
+    )
+    assert clipped.loc[30, "new_case"] < 2000
+    assert clipped.loc[90, "new_case"] >= 0
+    assert np.isnan(clipped.loc[100, "new_case"])
+
+    # Redistributing moves the excess onto earlier days, keeping totals
+    spread, summary = handle_anomalies(
+        data, "state", "submission_date", ["new_case"], "redistribute"
+    )
+    totals = data.groupby("state")["new_case"].sum()
+    assert np.allclose(spread.groupby("state")["new_case"].sum()[totals.index], totals)
+    assert (spread.loc[16:29, "new_case"] > data.loc[16:29, "new_case"]).all()
+    assert spread.loc[31:59, "new_case"].equals(data.loc[31:59, "new_case"])
+
+    print("Anomaly detection test passed")
+
+
+def main():
+    """
+    Test all methods in anomalies, then summarize anomalies in the downloaded data
+    """
+
+    test_handle_anomalies()
+
+    datasets = data_manager.get_dataset_info()
+    data_manager.update_datasets(datasets)
+    data = data_manager.retrieve_datasets(datasets)
+
+    world_data = data_processing.consolidate_world_data(data)
+    world_data, world_summary = handle_anomalies(
+        world_data, "iso_code", "date", WORLD_ANOMALY_STATS, "flag"
+    )
+    print(world_summary)
+
+    us_data = data_processing.consolidate_us_data(data)
+    us_data, us_summary = handle_anomalies(
+        us_data, "state", "submission_date", US_ANOMALY_STATS, "flag"
+    )
+    print(us_summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""
+Daniel Rashevsky
+CSE 163 AE
+This file provides an Arrow-backed alternative to the pandas merges and groupbys used
+by data_processing and analysis, running them on columnar data with multi-threaded
+compute kernels
+"""
+
+import pandas as pd
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+    pc = None
+
+ROW_ORDER_COL = "__row_order"
+
+
+def require_pyarrow():
+    """
+    Raise an ImportError if pyarrow is not installed
+    """
+
+    if pa is None:
+        raise ImportError("The arrow dataframe engine requires the pyarrow package")
+
+
+def to_table(data, columns):
+    """
+    Convert the given columns of a pandas dataframe to an Arrow table
+    """
+
+    return pa.Table.from_pandas(data[columns], preserve_index=False)
+
+
+def to_frame(table):
+    """
+    Convert an Arrow table back to a pandas dataframe with a fresh index
+    """
+
+    return table.to_pandas()
+
+
+def replace_values(array, mapping):
+    """
+    Return an Arrow array with values replaced according to a mapping, leaving
+    values not in the mapping unchanged (like pd.Series.replace)
+    """
+
+    keys = pa.array(list(mapping.keys()))
+    values = pa.array(list(mapping.values()))
+    positions = pc.index_in(array, value_set=keys)
+
+    return pc.if_else(pc.is_null(positions), array, pc.take(values, positions))
+
+
+def process_world_data(data):
+    """
+    Merge the raw world case and vaccination datasets into a single one
+    """
+
+    require_pyarrow()
+
+    keys = ["location", "date", "iso_code"]
+    world_cases = to_table(data["world_covid_data"], keys + ["new_cases"])
+    world_vaccinations = to_table(
+        data["world_covid_vaccinations"], keys + ["daily_vaccinations"]
+    )
+
+    # Left join, keeping the row order of the case data like pd.merge does
+    world_cases = world_cases.append_column(
+        ROW_ORDER_COL, pa.array(np.arange(world_cases.num_rows))
+    )
+    world_data = world_cases.join(
+        world_vaccinations, keys=keys, join_type="left outer", use_threads=True
+    )
+    world_data = world_data.sort_by(ROW_ORDER_COL).drop([ROW_ORDER_COL])
+
+    return to_frame(world_data)
+
+
+def process_us_data(data, state_ids, state_ids_mapping):
+    """
+    Merge the raw US case and vaccination datasets into a single one, limited to
+    the jurisdictions in state_ids
+    """
+
+    require_pyarrow()
+
+    keys = ["state", "submission_date"]
+    us_cases = to_table(data["us_covid_data"], keys + ["new_case"])
+    us_vaccinations = to_table(
+        data["us_covid_vaccinations"], ["location", "date", "daily_vaccinations"]
+    )
+
+    # Map state names to postal codes and line up column names with the case data
+    us_vaccinations = pa.table(
+        {
+            "state": replace_values(us_vaccinations["location"], state_ids_mapping),
+            "submission_date": us_vaccinations["date"],
+            "daily_vaccinations": us_vaccinations["daily_vaccinations"],
+        }
+    )
+
+    # Merge and filter data to only include 50 mainland US states + DC
+    us_data = us_cases.join(
+        us_vaccinations, keys=keys, join_type="full outer", use_threads=True
+    )
+    us_data = us_data.filter(
+        pc.is_in(us_data["state"], value_set=pa.array(state_ids["Identifier"]))
+    )
+    us_data = us_data.sort_by([(key, "ascending") for key in keys])
+
+    return to_frame(us_data.select(keys + ["new_case", "daily_vaccinations"]))
+
+
+def merge_ordered_outer(left, right, left_on, right_on=None):
+    """
+    Full outer join two dataframes on differently named keys like pd.merge_ordered,
+    returning rows sorted by whichever side's keys they have and only the left key
+    columns, which are missing on rows only found in the right dataframe. Without
+    right_on, both dataframes share the keys, which are filled in from whichever side
+    has them like pd.merge_ordered(on=left_on)
+    """
+
+    require_pyarrow()
+
+    left_table = pa.Table.from_pandas(left, preserve_index=False)
+    right_table = pa.Table.from_pandas(right, preserve_index=False)
+
+    if right_on is None:
+        merged = left_table.join(
+            right_table, keys=left_on, join_type="full outer", use_threads=True
+        )
+        order = pc.sort_indices(
+            merged, sort_keys=[(key, "ascending") for key in left_on]
+        )
+        return to_frame(merged.take(order))
+
+    merged = left_table.join(
+        right_table,
+        keys=left_on,
+        right_keys=right_on,
+        join_type="full outer",
+        use_threads=True,
+        coalesce_keys=False,
+    )
+    order = pc.sort_indices(
+        pa.table(
+            {
+                left_key: pc.coalesce(merged[left_key], merged[right_key])
+                for left_key, right_key in zip(left_on, right_on)
+            }
+        ),
+        sort_keys=[(key, "ascending") for key in left_on],
+    )
+
+    return to_frame(merged.take(order).drop(right_on))
+
+
+def aggregate_means(data, jurisdiction_cols, date_col, stats):
+    """
+    Return the mean of every stat (with missing values counted as 0) for each
+    jurisdiction, with the jurisdiction's first known geometry, and for each day
+    """
+
+    require_pyarrow()
+
+    table = to_table(data, jurisdiction_cols + [date_col] + stats)
+    table = pa.table(
+        {
+            name: (
+                pc.fill_null(pc.cast(table[name], pa.float64()), 0.0)
+                if name in stats
+                else table[name]
+            )
+            for name in table.column_names
+        }
+    )
+
+    # Average every stat by jurisdiction and by day
+    by_jurisdiction = group_means(table, jurisdiction_cols, stats)
+    by_day = group_means(table, [date_col], stats)
+
+    # Attach the first known geometry of each jurisdiction
+    if "geometry" in data.columns:
+        geometry = data.loc[
+            data["geometry"].notna(), jurisdiction_cols + ["geometry"]
+        ].drop_duplicates(jurisdiction_cols)
+        by_jurisdiction["geometry"] = geometry.set_index(jurisdiction_cols)[
+            "geometry"
+        ].reindex(by_jurisdiction.index)
+
+    return by_jurisdiction, by_day
+
+
+def group_means(table, keys, stats):
+    """
+    Return a dataframe indexed by the sorted keys with the mean of each stat per group
+    """
+
+    # Drop rows with missing keys, as pandas groupby does
+    valid = pc.is_valid(table[keys[0]])
+    for key in keys[1:]:
+        valid = pc.and_(valid, pc.is_valid(table[key]))
+    table = table.filter(valid)
+
+    grouped = table.group_by(keys).aggregate([(stat, "mean") for stat in stats])
+    grouped = grouped.rename_columns(
+        [
+            name[: -len("_mean")] if name.endswith("_mean") else name
+            for name in grouped.column_names
+        ]
+    )
+    grouped = grouped.sort_by([(key, "ascending") for key in keys])
+
+    return to_frame(grouped).set_index(keys)[stats]
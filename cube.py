@@ -0,0 +1,344 @@
+"""
+Daniel Rashevsky
+CSE 163 AE
+This file publishes each region's per capita daily results as a memory-mapped stat
+cube (stat x date x jurisdiction) on disk, which worker processes and later runs
+attach to without copying or unpickling the result frames
+"""
+
+import pandas as pd
+import numpy as np
+
+import concurrent.futures
+import multiprocessing
+import tempfile
+import pickle
+import json
+import time
+import sys
+import os
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import data_manager
+import analysis
+
+CUBE_DIR = "cube"
+CUBE_DTYPE = "float64"
+INDEX_EXT = ".json"
+# How long each benchmark task holds its worker, so every task gets its own worker
+WORKER_HOLD_SECONDS = 1
+# Jurisdiction column, date column, and stats of each region's daily results
+CUBE_REGIONS = {
+    "world": ("iso_code", "date", analysis.WORLD_STATS),
+    "us": ("state", "submission_date", analysis.US_STATS),
+    "us_county": ("fips", "date", analysis.US_COUNTY_STATS),
+}
+
+
+def get_index_path(region):
+    """
+    Return the path of the index naming a region's cube file and its labels
+    """
+
+    return CUBE_DIR + "/" + region + INDEX_EXT
+
+
+def publish_cube(region, daily_results):
+    """
+    Write a region's daily results as a stat x date x jurisdiction cube, with days a
+    jurisdiction did not report left as NaN. Each publish writes a new cube file and
+    then swaps the index over to it, so processes attached to the old cube keep
+    reading it until they re-attach
+    """
+
+    jurisdiction_col, date_col, stats = CUBE_REGIONS[region]
+    os.makedirs(CUBE_DIR, exist_ok=True)
+
+    jurisdiction_codes, jurisdictions = pd.factorize(
+        daily_results[jurisdiction_col], sort=True
+    )
+    date_codes, dates = pd.factorize(daily_results[date_col], sort=True)
+
+    # Fill the cube one stat at a time straight from each column
+    fd, data_path = tempfile.mkstemp(dir=CUBE_DIR, prefix=region + "-", suffix=".npy")
+    os.close(fd)
+    values = np.lib.format.open_memmap(
+        data_path,
+        mode="w+",
+        dtype=CUBE_DTYPE,
+        shape=(len(stats), len(dates), len(jurisdictions)),
+    )
+    for i, stat in enumerate(stats):
+        values[i] = np.nan
+        values[i, date_codes, jurisdiction_codes] = daily_results[stat].to_numpy(
+            dtype=CUBE_DTYPE
+        )
+    values.flush()
+    del values
+
+    index = {
+        "file": os.path.basename(data_path),
+        "stats": list(stats),
+        "dates": [date.strftime("%Y-%m-%d") for date in dates],
+        "jurisdictions": jurisdictions.tolist(),
+    }
+
+    # Only remove the old cube file after no new attach can find it
+    old_index = read_index(region)
+    index_path = get_index_path(region)
+    fd, tmp_path = tempfile.mkstemp(dir=CUBE_DIR, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+    if old_index is not None and old_index["file"] != index["file"]:
+        try:
+            os.remove(CUBE_DIR + "/" + old_index["file"])
+        except OSError:
+            # Still mapped by a reader on a platform that cannot remove open files
+            pass
+
+
+def publish_results(results):
+    """
+    Publish the daily results of every region, given as a dictionary from region name
+    to the results of its pipeline
+    """
+
+    for region, region_results in results.items():
+        publish_cube(region, region_results[0])
+
+
+def read_index(region):
+    """
+    Return a region's cube index, or None if it has never been published
+    """
+
+    index_path = get_index_path(region)
+    if not os.path.exists(index_path):
+        return None
+
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def attach_cube(region):
+    """
+    Return a region's published cube as a read-only memory-mapped array, along with
+    its index of stat, date, and jurisdiction labels. Pages are only read from disk
+    as they are used, and are shared by every process attached to the same cube
+    """
+
+    index = read_index(region)
+    if index is None:
+        raise FileNotFoundError("No cube has been published for " + region)
+
+    values = np.load(CUBE_DIR + "/" + index["file"], mmap_mode="r")
+    index["dates"] = pd.to_datetime(index["dates"])
+
+    return values, index
+
+
+def get_stat_frame(values, index, stat):
+    """
+    Return one stat of an attached cube as a date by jurisdiction dataframe, backed by
+    the memory-mapped cube instead of a copy of it
+    """
+
+    return pd.DataFrame(
+        values[index["stats"].index(stat)],
+        index=pd.Index(index["dates"], name="date"),
+        columns=pd.Index(index["jurisdictions"], name="jurisdiction"),
+        copy=False,
+    )
+
+
+def get_memory_usage():
+    """
+    Return this process's proportional set size in bytes, which splits shared pages
+    between the processes mapping them, or its peak resident set size where the
+    proportional size is not reported (0 if neither is)
+    """
+
+    if os.path.exists("/proc/self/smaps_rollup"):
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+
+    if resource is None:
+        return 0
+
+    # Reported in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def get_worker_memory(_):
+    """
+    Return a worker process's memory usage, holding the worker for
+    WORKER_HOLD_SECONDS
+    """
+
+    time.sleep(WORKER_HOLD_SECONDS)
+
+    return get_memory_usage()
+
+
+def load_in_worker(source):
+    """
+    Load a region's results in a worker process, either by unpickling a result frame
+    or by attaching to its cube, and read every value. Returns how long loading took
+    and the worker's memory usage afterwards, holding the worker (and the loaded
+    results) for WORKER_HOLD_SECONDS
+    """
+
+    global CUBE_DIR
+
+    start = time.perf_counter()
+    if source[0] == "pickle":
+        frame = pickle.loads(source[1])
+        frame.select_dtypes("number").sum()
+    else:
+        CUBE_DIR = source[2]
+        values, index = attach_cube(source[1])
+        np.nansum(values)
+    seconds = time.perf_counter() - start
+
+    memory = get_memory_usage()
+    time.sleep(WORKER_HOLD_SECONDS)
+
+    return seconds, memory
+
+
+def benchmark_workers(region, daily_results, workers=4):
+    """
+    Compare handing a region's daily results to worker processes as pickles against
+    attaching them to its published cube, by each worker's load time, the time to
+    load all workers, and the total memory all workers add
+    """
+
+    payload = pickle.dumps(daily_results, protocol=pickle.HIGHEST_PROTOCOL)
+    sources = [("pickle", payload), ("cube", region, os.path.abspath(CUBE_DIR))]
+    results = []
+
+    for source in sources:
+
+        # Fresh interpreters, so no worker starts with the results already in memory
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            baseline = sum(pool.map(get_worker_memory, range(workers)))
+            start = time.perf_counter()
+            loads = list(pool.map(load_in_worker, [source] * workers))
+            seconds = time.perf_counter() - start - WORKER_HOLD_SECONDS
+
+        results.append(
+            {
+                "Source": source[0],
+                "Payload_MB": len(payload) / 2**20 if source[0] == "pickle" else 0,
+                "Load_Seconds": np.median([load[0] for load in loads]),
+                "Fan_Out_Seconds": seconds,
+                "Worker_Memory_MB": (sum(load[1] for load in loads) - baseline) / 2**20,
+            }
+        )
+
+    results = pd.DataFrame(results)
+    print(results)
+
+    return results
+
+
+def test_cube():
+    """
+    Test that a published cube holds every daily result at its stat, date, and
+    jurisdiction, that it attaches read-only in this and other processes, and that
+    republishing leaves already attached cubes readable
+    """
+
+    global CUBE_DIR
+
+    rng = np.random.default_rng(0)
+    dates = pd.date_range("2021-01-01", periods=30)
+    states = ["WA", "OR", "CA"]
+    daily_results = pd.DataFrame(
+        {
+            "state": np.repeat(states, len(dates)),
+            "submission_date": np.tile(dates, len(states)),
+        }
+    )
+    for stat in analysis.US_STATS:
+        daily_results[stat] = rng.random(len(daily_results))
+    daily_results.loc[daily_results.index % 5 == 0, "new_case"] = np.nan
+
+    # One state missing a day
+    daily_results = daily_results.drop(index=40).sample(frac=1, random_state=0)
+
+    previous_dir = CUBE_DIR
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            CUBE_DIR = tmp_dir
+            publish_cube("us", daily_results)
+            values, index = attach_cube("us")
+
+            assert isinstance(values, np.memmap) and not values.flags.writeable
+            assert values.shape == (len(analysis.US_STATS), len(dates), len(states))
+            assert index["jurisdictions"] == sorted(states)
+            assert (index["dates"] == dates).all()
+
+            # Every result is at its labels, and the missing day is NaN
+            for stat in ["new_case", "daily_vaccinations"]:
+                expected = daily_results.pivot(
+                    index="submission_date", columns="state", values=stat
+                )
+                actual = get_stat_frame(values, index, stat)
+                np.testing.assert_array_equal(
+                    actual.to_numpy(), expected.reindex(dates)[sorted(states)].to_numpy()
+                )
+            assert np.isnan(get_stat_frame(values, index, "new_case").loc[dates[10], "OR"])
+
+            # Other processes attach to the same file
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn")
+            ) as pool:
+                pool.submit(load_in_worker, ("cube", "us", tmp_dir)).result()
+
+            # Republishing swaps in a new file without disturbing attached readers
+            old_sum = np.nansum(values)
+            daily_results[analysis.US_STATS] *= 2
+            publish_cube("us", daily_results)
+            new_values, new_index = attach_cube("us")
+            assert np.nansum(values) == old_sum
+            assert np.isclose(np.nansum(new_values), 2 * old_sum)
+            assert len([f for f in os.listdir(tmp_dir) if f.endswith(".npy")]) == 1
+            del values, new_values
+    finally:
+        CUBE_DIR = previous_dir
+
+    print("Cube test passed")
+
+
+def main():
+    """
+    Test all methods in cube, then publish world and US results and compare
+    attaching worker processes to them against pickling them
+    """
+
+    test_cube()
+
+    datasets = data_manager.get_dataset_info()
+    data_manager.update_datasets(datasets)
+    data = data_manager.retrieve_datasets(datasets)
+
+    results = {"world": analysis.run_world_pipeline(data), "us": analysis.run_us_pipeline(data)}
+    publish_results(results)
+    for region, region_results in results.items():
+        benchmark_workers(region, region_results[0])
+
+
+if __name__ == "__main__":
+    main()
@@ -9,16 +9,54 @@ import geopandas as gpd
 import numpy as np
 
 import requests
+import urllib3
 import zipfile
 import datetime
+import hashlib
+import gzip
+import time
 import shutil
+import json
 import os
+import http.server
+import threading
+import tempfile
+import contextlib
+import multiprocessing
+import random
+
+# Cross-process file locks, with flock on POSIX and msvcrt byte locks on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 DATASET_INFO = "metadata/datasets.csv"
+DATASET_SCHEMAS = "metadata/dataset_schemas.csv"
 UPDATE_INFO = "timestamps.csv"
 DATASET_DIR = "datasets"
 DAYS_BETWEEN_UPDATE = 2
-STREAM_CHUNK_SZ = 8192
+STREAM_CHUNK_SZ = 1048576
+WRITE_BUFFER_SZ = 4194304
+PARTIAL_EXT = ".part"
+PARTIAL_INFO_EXT = ".part.json"
+MAX_DOWNLOAD_ATTEMPTS = 5
+# Seconds to wait for a connection and for each read, and before the first retry
+DOWNLOAD_TIMEOUT = (10, 60)
+DOWNLOAD_RETRY_DELAY = 1
+CHECKSUM_ALGORITHM = "sha256"
+NEGOTIATE_GZIP = False
+STORAGE_COMPRESSION = None
+COMPRESSION_EXTS = {"gzip": ".gz", "zstd": ".zst"}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 9
+LOCK_EXT = ".lock"
+LOCK_POLL_INTERVAL = 0.1
+SCHEDULER_MAX_SLEEP = 3600
+RETRY_BASE_DELAY = 60
+RETRY_MAX_DELAY = 21600
+RETRY_JITTER = 0.5
 
 
 def download_file(metadata_row):
@@ -29,21 +67,28 @@ def download_file(metadata_row):
     # Get needed file metadata
     is_zip = metadata_row["Is_Zip"]
     extract_filename = metadata_row["Extract_FileName"]
+    expected_checksum = metadata_row.get("Checksum")
 
     # Generate filenames
     fname = metadata_row["Alias"]
     download_fname = fname + (".csv" if not is_zip else ".zip")
-    save_fname = fname + (
-        ".csv" if not is_zip else os.path.splitext(extract_filename)[1]
-    )
     print("Downloading " + fname + "...")
 
-    # Download file
-    with requests.get(metadata_row["URL"], stream=True) as r:
-        r.raise_for_status()
-        with open(DATASET_DIR + "/" + download_fname, "wb") as f:
-            for chunk in r.iter_content(chunk_size=STREAM_CHUNK_SZ):
-                f.write(chunk)
+    # Download file, resuming from any partial transfer left by earlier attempts
+    checksum, content_encoding = download_resumable(
+        metadata_row["URL"],
+        DATASET_DIR + "/" + download_fname,
+        None if pd.isna(expected_checksum) else expected_checksum,
+        NEGOTIATE_GZIP and not is_zip,
+    )
+
+    # Store plain datasets in the configured on-disk compression format
+    if not is_zip:
+        store_dataset(
+            DATASET_DIR + "/" + download_fname,
+            get_dataset_filename(metadata_row),
+            content_encoding,
+        )
 
     # If the file is compressed, extract it
     if is_zip:
@@ -57,43 +102,434 @@ def download_file(metadata_row):
         z.close()
         os.remove(DATASET_DIR + "/" + download_fname)
 
+    return checksum
+
 
-def download_files(metadata_frame, timestamps):
+def download_resumable(url, path, expected_checksum=None, accept_gzip=False):
     """
-    Download multiple datasets, given a set of datasets to download and their last update times
+    Download a url to a path using HTTP Range requests to resume interrupted
+    transfers, verify the final size and checksum, and return the checksum and
+    content encoding of the bytes written (the body is stored as transferred, so
+    a gzip-encoded response is left compressed). Checksums are always of the decoded
+    content, so they do not depend on how the server encoded the response
     """
 
-    # Download every dataset in dataframe
-    for i, row in metadata_frame.iterrows():
+    partial_path = path + PARTIAL_EXT
+    info_path = path + PARTIAL_INFO_EXT
+
+    for attempt in range(MAX_DOWNLOAD_ATTEMPTS):
+
+        # Back off before each retry, doubling the wait every time
+        if attempt > 0:
+            time.sleep(DOWNLOAD_RETRY_DELAY * 2 ** (attempt - 1))
+
         try:
-            alias = metadata_frame.loc[i, "Alias"]
-            download_file(metadata_frame.loc[i])
-            timestamps.loc[alias, "TimeStamp"] = datetime.datetime.now()
-        except Exception as e:
-            print("File failed to download. Error: " + str(e))
+            complete = transfer_partial(url, partial_path, info_path, accept_gzip)
+        except (
+            requests.ConnectionError,
+            requests.Timeout,
+            urllib3.exceptions.HTTPError,
+        ) as e:
+            print(
+                "Transfer interrupted ("
+                + str(e)
+                + "), resuming from byte "
+                + str(get_partial_size(partial_path))
+                + "..."
+            )
+            continue
+
+        if complete:
+            break
+    else:
+        raise IOError(
+            "Download of " + url + " did not complete after "
+            + str(MAX_DOWNLOAD_ATTEMPTS) + " attempts"
+        )
+
+    # Verify the completed transfer before it replaces the current file
+    partial_info = read_partial_info(info_path)
+    checksum = get_file_checksum(partial_path, partial_info.get("content_encoding"))
+    try:
+        verify_download(
+            partial_path, partial_info.get("total_size"), checksum, expected_checksum
+        )
+    except IOError:
+        os.remove(partial_path)
+        os.remove(info_path)
+        raise
+
+    os.replace(partial_path, path)
+    os.remove(info_path)
+
+    return checksum, partial_info.get("content_encoding")
 
 
-def check_aliases_exist(metadata_frame):
+def transfer_partial(url, partial_path, info_path, accept_gzip=False):
     """
-    Given a set of datasets to check, checks if datasets specified by datasets.csv are already downloaded
+    Continue downloading a url into a partial file, tracking the remote file's
+    identity in a sidecar so a resumed transfer never mixes two versions of a file.
+    Returns whether the partial file now holds the whole file
     """
 
-    exists = []
+    partial_info = read_partial_info(info_path)
+    if partial_info.get("url") != url:
+        partial_info = {"url": url}
+    offset = get_partial_size(partial_path) if "total_size" in partial_info else 0
 
-    for i, row in metadata_frame.iterrows():
+    # Ask only for the missing bytes, and only if the remote file is unchanged
+    headers = {"Accept-Encoding": "gzip" if accept_gzip else "identity"}
+    if offset > 0:
+        headers["Range"] = "bytes=" + str(offset) + "-"
+        validator = partial_info.get("etag") or partial_info.get("last_modified")
+        if validator is not None:
+            headers["If-Range"] = validator
 
-        # Get filename
-        alias = metadata_frame.loc[i, "Alias"]
-        is_zip = metadata_frame.loc[i, "Is_Zip"]
-        extract_filename = metadata_frame.loc[i, "Extract_FileName"]
-        fname = alias + (
-            ".csv" if not is_zip else os.path.splitext(extract_filename)[1]
+    with requests.get(
+        url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT
+    ) as r:
+
+        # The partial file already holds every byte of the remote file
+        if r.status_code == 416 and offset == partial_info.get("total_size"):
+            return True
+
+        # Any other unsatisfiable range means the partial file does not match the
+        # remote file, so it is discarded and the transfer starts over
+        if r.status_code == 416 and offset > 0:
+            for stale_path in [partial_path, info_path]:
+                if os.path.exists(stale_path):
+                    os.remove(stale_path)
+            return transfer_partial(url, partial_path, info_path, accept_gzip)
+
+        r.raise_for_status()
+
+        # A full response means the server ignored the range or the file changed
+        # (or is now encoded differently)
+        content_range = r.headers.get("Content-Range", "")
+        content_encoding = r.headers.get("Content-Encoding")
+        if (
+            r.status_code != 206
+            or not content_range.startswith("bytes " + str(offset) + "-")
+            or content_encoding != partial_info.get("content_encoding")
+        ):
+            offset = 0
+            partial_info = {
+                "url": url,
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+                "total_size": get_total_size(r.headers, 0),
+                "content_encoding": content_encoding,
+            }
+            write_partial_info(info_path, partial_info)
+
+        # Write the body exactly as transferred so ranges line up on resume
+        mode = "ab" if offset > 0 else "wb"
+        with open(partial_path, mode, buffering=WRITE_BUFFER_SZ) as f:
+            for chunk in r.raw.stream(STREAM_CHUNK_SZ, decode_content=False):
+                f.write(chunk)
+
+    total_size = partial_info.get("total_size")
+    return total_size is None or get_partial_size(partial_path) >= total_size
+
+
+def get_total_size(headers, offset):
+    """
+    Return the full size of a remote file from its response headers, or None if unknown
+    """
+
+    content_range = headers.get("Content-Range")
+    if content_range is not None and not content_range.endswith("/*"):
+        return int(content_range.rsplit("/", 1)[1])
+
+    content_length = headers.get("Content-Length")
+    if content_length is not None:
+        return offset + int(content_length)
+
+    return None
+
+
+def get_partial_size(partial_path):
+    """
+    Return the number of bytes already downloaded to a partial file
+    """
+
+    return os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+
+
+def read_partial_info(info_path):
+    """
+    Return the tracking information stored alongside a partial download
+    """
+
+    if not os.path.exists(info_path):
+        return {}
+
+    with open(info_path) as f:
+        return json.load(f)
+
+
+def write_partial_info(info_path, partial_info):
+    """
+    Store the tracking information for a partial download
+    """
+
+    with open(info_path, "w") as f:
+        json.dump(partial_info, f)
+
+
+def get_file_checksum(path, content_encoding=None):
+    """
+    Return the hex digest of a file's contents, decoding them first if the file
+    holds a gzip-encoded response
+    """
+
+    digest = hashlib.new(CHECKSUM_ALGORITHM)
+    if content_encoding == "gzip":
+        opened = gzip.open(path, "rb")
+    else:
+        opened = open(path, "rb", buffering=0)
+
+    with opened as f:
+        for chunk in iter(lambda: f.read(STREAM_CHUNK_SZ), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def verify_download(path, expected_size, checksum, expected_checksum):
+    """
+    Raise an IOError if a downloaded file does not have the expected size or checksum
+    """
+
+    size = os.path.getsize(path)
+    if expected_size is not None and size != expected_size:
+        raise IOError(
+            "Downloaded " + str(size) + " bytes, expected " + str(expected_size)
+        )
+
+    if expected_checksum is not None and checksum != expected_checksum.lower():
+        raise IOError(
+            "Downloaded file has " + CHECKSUM_ALGORITHM + " " + checksum
+            + ", expected " + expected_checksum
+        )
+
+
+def store_dataset(download_path, save_fname, content_encoding):
+    """
+    Move a downloaded plain dataset to its final filename, compressing or
+    decompressing it to match STORAGE_COMPRESSION
+    """
+
+    save_path = DATASET_DIR + "/" + save_fname
+    is_gzip = content_encoding == "gzip"
+
+    # Remove copies of the dataset stored with any other compression setting
+    for ext in [""] + list(COMPRESSION_EXTS.values()):
+        stale_path = download_path + ext
+        if stale_path not in [download_path, save_path] and os.path.exists(stale_path):
+            os.remove(stale_path)
+
+    # The transferred bytes are already in the stored format
+    if (STORAGE_COMPRESSION == "gzip" and is_gzip) or (
+        STORAGE_COMPRESSION is None and not is_gzip
+    ):
+        os.replace(download_path, save_path)
+        return
+
+    with open_dataset_file(download_path, "gzip" if is_gzip else None, "rb") as src:
+        with open_dataset_file(save_path + ".tmp", STORAGE_COMPRESSION, "wb") as dst:
+            shutil.copyfileobj(src, dst, STREAM_CHUNK_SZ)
+
+    if download_path != save_path:
+        os.remove(download_path)
+    os.replace(save_path + ".tmp", save_path)
+
+
+def open_dataset_file(path, compression, mode):
+    """
+    Open a dataset file for binary reading or writing through the given
+    compression format (None, "gzip" or "zstd")
+    """
+
+    if compression is None:
+        return open(path, mode, buffering=WRITE_BUFFER_SZ)
+
+    if compression == "gzip":
+        return gzip.open(path, mode, compresslevel=GZIP_LEVEL)
+
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("zstd dataset storage requires the zstandard package")
+
+        return zstandard.open(
+            path, mode, cctx=zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1)
         )
 
-        # Check if file exists
-        exists.append(not os.path.exists(DATASET_DIR + "/" + fname))
+    raise ValueError("Unknown dataset compression: " + str(compression))
+
+
+def get_dataset_filename(metadata_row):
+    """
+    Return the filename a dataset is saved under with the current storage settings
+    """
+
+    if metadata_row["Is_Zip"]:
+        return metadata_row["Alias"] + os.path.splitext(metadata_row["Extract_FileName"])[1]
+
+    return metadata_row["Alias"] + ".csv" + COMPRESSION_EXTS.get(STORAGE_COMPRESSION, "")
+
+
+def find_dataset_file(metadata_row):
+    """
+    Return the path of a downloaded dataset, whichever compression it was
+    stored with, or None if it has not been downloaded
+    """
 
-    return pd.Series(exists)
+    fname = get_dataset_filename(metadata_row)
+    candidates = [fname]
+    if not metadata_row["Is_Zip"]:
+        plain_fname = metadata_row["Alias"] + ".csv"
+        candidates += [plain_fname + ext for ext in [""] + list(COMPRESSION_EXTS.values())]
+
+    for candidate in candidates:
+        if os.path.exists(DATASET_DIR + "/" + candidate):
+            return DATASET_DIR + "/" + candidate
+
+    return None
+
+
+def needs_update(metadata_row, timestamps):
+    """
+    Return whether a dataset is missing, has no recorded update, or was last updated
+    at least its Update_Interval days ago
+    """
+
+    alias = metadata_row["Alias"]
+    if find_dataset_file(metadata_row) is None or alias not in timestamps.index:
+        return True
+
+    age = datetime.datetime.now() - timestamps.loc[alias, "TimeStamp"]
+
+    return pd.isna(age) or age.days >= metadata_row["Update_Interval"]
+
+
+def read_timestamps():
+    """
+    Return the last update time and checksum of every downloaded dataset, indexed by alias
+    """
+
+    if not os.path.exists(UPDATE_INFO):
+        return pd.DataFrame(columns=["TimeStamp", "Checksum"])
+
+    return pd.read_csv(UPDATE_INFO, parse_dates=["TimeStamp"], index_col=0)
+
+
+def write_timestamps(timestamps):
+    """
+    Replace the update registry in one step, so other processes only ever read
+    a complete file
+    """
+
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(UPDATE_INFO)), suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "w", newline="") as f:
+            timestamps.to_csv(f)
+        os.replace(tmp_path, UPDATE_INFO)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def record_update(alias, checksum):
+    """
+    Record a dataset's update in the registry, holding the registry's lock so
+    updates from other processes are never lost
+    """
+
+    with file_lock(UPDATE_INFO):
+        timestamps = read_timestamps()
+        timestamps.loc[alias, "TimeStamp"] = datetime.datetime.now()
+        timestamps.loc[alias, "Checksum"] = checksum
+        write_timestamps(timestamps)
+
+
+@contextlib.contextmanager
+def file_lock(path, shared=False):
+    """
+    Hold a cross-process lock on path (through a lock file beside it) for the body of a
+    with block. Shared locks only exclude exclusive ones, and are exclusive on Windows
+    """
+
+    with open(path + LOCK_EXT, "a+") as f:
+        if not acquire_lock(f, shared, blocking=False):
+            print("Waiting for another process to release " + path + "...")
+            acquire_lock(f, shared, blocking=True)
+
+        try:
+            yield
+        finally:
+            release_lock(f)
+
+
+def acquire_lock(f, shared, blocking):
+    """
+    Lock an open lock file, returning whether the lock was acquired
+    """
+
+    if fcntl is not None:
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(f, flags | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return False
+        return True
+
+    # msvcrt locks the first byte, retrying on its own only for about 10 seconds
+    while True:
+        try:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            if not blocking:
+                return False
+            time.sleep(LOCK_POLL_INTERVAL)
+
+
+def release_lock(f):
+    """
+    Unlock an open lock file
+    """
+
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def parse_dates(values, date_format):
+    """
+    Parse a column of dates with an explicit format, parsing each unique value only
+    once and mapping the results back onto every row. Columns that are already
+    datetimes are returned unchanged
+    """
+
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+
+    codes, uniques = pd.factorize(values)
+    parsed = pd.to_datetime(pd.Index(uniques).astype(str), format=date_format)
+
+    return pd.Series(
+        parsed.take(codes, allow_fill=True, fill_value=pd.NaT),
+        index=values.index,
+        name=values.name,
+    )
 
 
 def get_dataset_info():
@@ -104,47 +540,199 @@ def get_dataset_info():
     return pd.read_csv(DATASET_INFO)
 
 
+def get_dataset_encoding(metadata_row):
+    """
+    Return the text encoding declared for a dataset, or None for UTF-8
+    """
+
+    encoding = metadata_row.get("Encoding")
+
+    return encoding if isinstance(encoding, str) else None
+
+
+def get_dataset_schemas():
+    """
+    Get the columns, dtypes, and date formats declared for each dataset
+    """
+
+    return pd.read_csv(DATASET_SCHEMAS)
+
+
+def read_dataset(path, schema, encoding=None):
+    """
+    Read a CSV dataset in an optional text encoding, loading only the columns
+    declared in its schema with their declared dtypes and parsing its date columns.
+    Datasets without a schema are read in full with inferred dtypes
+    """
+
+    if len(schema) == 0:
+        return pd.read_csv(path, encoding=encoding)
+
+    # Date columns are read as text and parsed once per unique value
+    is_date = schema["Date_Format"].notna()
+    dtypes = {
+        column: (str if (dtype == "str" or date) else dtype)
+        for column, dtype, date in zip(schema["Column"], schema["Dtype"], is_date)
+    }
+
+    # Declared columns missing from the file are left for validation to report
+    columns = set(schema["Column"])
+    try:
+        frame = pd.read_csv(
+            path, usecols=lambda column: column in columns, dtype=dtypes, encoding=encoding
+        )
+    except (ValueError, TypeError):
+
+        # Some column no longer holds its declared dtype, so convert the columns one
+        # at a time and leave the ones that fail as read for validation to report
+        frame = pd.read_csv(
+            path,
+            usecols=lambda column: column in columns,
+            dtype={column: str for column in schema.loc[is_date, "Column"]},
+            encoding=encoding,
+        )
+        for column in frame.columns:
+            try:
+                frame[column] = frame[column].astype(dtypes[column])
+            except (ValueError, TypeError):
+                pass
+
+    # Dates that no longer match their format are likewise left as text
+    for column, date_format in zip(
+        schema.loc[is_date, "Column"], schema.loc[is_date, "Date_Format"]
+    ):
+        if column in frame.columns:
+            try:
+                frame[column] = parse_dates(frame[column], date_format)
+            except ValueError:
+                pass
+
+    return frame
+
+
 def update_datasets(metadata_frame):
     """
-    Given a set of datasets, update them
+    Given a set of datasets, update the missing and stale ones, returning the aliases
+    downloaded. Each dataset is locked across processes while it is checked and
+    downloaded, so a process that finds a download already in progress waits for it
+    and reuses the result
     """
 
-    dir_exists = os.path.isdir(DATASET_DIR)
+    os.makedirs(DATASET_DIR, exist_ok=True)
+    updated = []
 
-    # Create new dataset age tracking frame
-    timestamps = pd.DataFrame()
+    for i, row in metadata_frame.iterrows():
+        alias = row["Alias"]
 
-    if dir_exists:
+        with file_lock(DATASET_DIR + "/" + alias):
 
-        # Find stale datasets
-        if os.path.exists(UPDATE_INFO):
-            timestamps = pd.read_csv(
-                UPDATE_INFO, parse_dates=["TimeStamp"], index_col=0
-            )
-            timestamp_deltas = (
-                datetime.datetime.now() - timestamps["TimeStamp"]
-            ).dt.days
-            timestamp_deltas.index = range(len(timestamp_deltas))
-            stale_mask = timestamp_deltas >= metadata_frame["Update_Interval"]
+            # Another process may have updated the dataset while this one waited
+            if not needs_update(row, read_timestamps()):
+                continue
+
+            try:
+                checksum = download_file(row)
+            except Exception as e:
+                print("File failed to download. Error: " + str(e))
+                continue
+
+            record_update(alias, checksum)
+            updated.append(alias)
+
+    return updated
+
+
+def get_update_times(metadata_frame, timestamps):
+    """
+    Return when each dataset next needs updating, indexed by alias: its last update
+    plus its Update_Interval days, or now if it is missing or was never recorded
+    """
+
+    now = datetime.datetime.now()
+    update_times = {}
+
+    for i, row in metadata_frame.iterrows():
+        alias = row["Alias"]
+        if needs_update(row, timestamps):
+            update_times[alias] = now
         else:
-            stale_mask = True
+            update_times[alias] = timestamps.loc[alias, "TimeStamp"] + datetime.timedelta(
+                days=int(row["Update_Interval"])
+            )
 
-        # Find missing datasets
-        exists_mask = check_aliases_exist(metadata_frame)
+    return pd.Series(update_times, dtype="datetime64[ns]")
 
-        # Update them
-        download_files(metadata_frame[stale_mask | exists_mask], timestamps)
 
-    else:
+def get_retry_delay(attempts):
+    """
+    Return the seconds to wait before retrying a dataset that failed to update
+    attempts times in a row, doubling each time up to RETRY_MAX_DELAY, jittered by
+    RETRY_JITTER either way so processes that failed together do not retry together
+    """
 
-        # Create directory to hold datasets
-        os.mkdir(DATASET_DIR)
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
 
-        # Download all datasets
-        download_files(metadata_frame, timestamps)
+    return delay * random.uniform(1 - RETRY_JITTER, 1 + RETRY_JITTER)
 
-    # Update dataset info
-    timestamps.to_csv(UPDATE_INFO)
+
+def run_scheduler(metadata_frame, on_update=None, stop_event=None):
+    """
+    Keep every dataset fresh until stop_event is set, updating each one when its
+    Update_Interval runs out and retrying failed updates with jittered exponential
+    backoff. on_update is called with the aliases of every batch of new data
+    """
+
+    if stop_event is None:
+        stop_event = threading.Event()
+
+    # Consecutive failures and next retry time of each failing dataset
+    failures = {}
+    retry_times = {}
+
+    print("Scheduling updates of " + str(len(metadata_frame)) + " datasets...")
+
+    while not stop_event.is_set():
+        update_times = get_update_times(metadata_frame, read_timestamps())
+        for alias, retry_time in retry_times.items():
+            update_times[alias] = max(update_times[alias], retry_time)
+
+        # Update every dataset that is due
+        now = datetime.datetime.now()
+        due = update_times[update_times <= now].index
+        if len(due) > 0:
+            updated = update_datasets(metadata_frame[metadata_frame["Alias"].isin(due)])
+            timestamps = read_timestamps()
+
+            for i, row in metadata_frame[metadata_frame["Alias"].isin(due)].iterrows():
+                alias = row["Alias"]
+
+                # Updated here or by another process in the meantime
+                if alias in updated or not needs_update(row, timestamps):
+                    failures.pop(alias, None)
+                    retry_times.pop(alias, None)
+                    continue
+
+                failures[alias] = failures.get(alias, 0) + 1
+                delay = get_retry_delay(failures[alias])
+                retry_times[alias] = now + datetime.timedelta(seconds=delay)
+                print(
+                    "Retrying " + alias + " in " + str(round(delay, 1)) + "s (attempt "
+                    + str(failures[alias] + 1) + ")..."
+                )
+
+            if len(updated) > 0 and on_update is not None:
+                try:
+                    on_update(updated)
+                except Exception as e:
+                    print("Processing new data failed. Error: " + str(e))
+            continue
+
+        # Sleep until the next dataset is due, waking up at least every
+        # SCHEDULER_MAX_SLEEP seconds to pick up updates made by other processes
+        seconds = SCHEDULER_MAX_SLEEP
+        if len(update_times) > 0:
+            seconds = (update_times.min() - now).total_seconds()
+        stop_event.wait(min(max(seconds, 0), SCHEDULER_MAX_SLEEP))
 
 
 def retrieve_datasets(metadata_frame):
@@ -153,35 +741,481 @@ def retrieve_datasets(metadata_frame):
     """
 
     data_dict = {}
+    schemas = get_dataset_schemas()
 
     for i, row in metadata_frame.iterrows():
 
         # Get file metadata
         alias = metadata_frame.loc[i, "Alias"]
-        is_zip = metadata_frame.loc[i, "Is_Zip"]
         is_shapefile = metadata_frame.loc[i, "Is_ShapeFile"]
-        extract_filename = metadata_frame.loc[i, "Extract_FileName"]
 
-        # Get filename
-        fname = alias + (
-            ".csv" if not is_zip else os.path.splitext(extract_filename)[1]
-        )
+        # Get filename, compressed files are decompressed by their extension
+        path = find_dataset_file(metadata_frame.loc[i])
 
-        # Check if file exists
-        if os.path.exists(DATASET_DIR + "/" + fname):
-            if is_shapefile:
-                data_dict[alias] = gpd.read_file(DATASET_DIR + "/" + fname)
-            else:
-                data_dict[alias] = pd.read_csv(DATASET_DIR + "/" + fname)
+        # Check if file exists, reading it only while no other process replaces it
+        if path is not None:
+            with file_lock(DATASET_DIR + "/" + alias, shared=True):
+                path = find_dataset_file(metadata_frame.loc[i])
+                if is_shapefile:
+                    data_dict[alias] = gpd.read_file(path)
+                else:
+                    data_dict[alias] = read_dataset(
+                        path,
+                        schemas[schemas["Alias"] == alias],
+                        get_dataset_encoding(row),
+                    )
 
     return data_dict
 
 
+def test_resumable_download():
+    """
+    Test that download_resumable resumes and verifies a transfer from a local
+    HTTP server that cuts every connection partway through, and gives up on one
+    that stalls
+    """
+
+    global DOWNLOAD_TIMEOUT, DOWNLOAD_RETRY_DELAY
+
+    payload = os.urandom(5 * STREAM_CHUNK_SZ + 123)
+    cut_after = 2 * STREAM_CHUNK_SZ
+    requests_seen = []
+
+    class DroppingHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append(self.headers.get("Range"))
+
+            # The stall path never sends a body
+            if self.path == "/stall":
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                time.sleep(2)
+                return
+
+            # The gzip path serves the payload gzip-encoded, as a server would
+            # when gzip is negotiated
+            body = payload
+            if self.path == "/gzip":
+                body = gzip.compress(payload)
+
+            # Serve the requested range, but never more than cut_after bytes of it
+            start = 0
+            if self.headers.get("Range") is not None:
+                start = int(self.headers["Range"][len("bytes="):].rstrip("-"))
+                if start >= len(body):
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */" + str(len(body)))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header(
+                    "Content-Range",
+                    "bytes " + str(start) + "-" + str(len(body) - 1)
+                    + "/" + str(len(body)),
+                )
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(len(body) - start))
+            self.send_header("ETag", '"test"')
+            if self.path == "/gzip":
+                self.send_header("Content-Encoding", "gzip")
+            self.end_headers()
+            self.wfile.write(body[start:start + cut_after])
+            self.close_connection = True
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), DroppingHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    if not os.path.isdir(DATASET_DIR):
+        os.mkdir(DATASET_DIR)
+    path = DATASET_DIR + "/resume_test.bin"
+    url = "http://127.0.0.1:" + str(server.server_address[1]) + "/"
+    previous_settings = (DOWNLOAD_TIMEOUT, DOWNLOAD_RETRY_DELAY)
+    DOWNLOAD_RETRY_DELAY = 0.01
+
+    try:
+        checksum, content_encoding = download_resumable(
+            url, path, hashlib.new(CHECKSUM_ALGORITHM, payload).hexdigest()
+        )
+        with open(path, "rb") as f:
+            assert f.read() == payload
+        assert checksum == hashlib.new(CHECKSUM_ALGORITHM, payload).hexdigest()
+        assert requests_seen[0] is None and len(requests_seen) == 3
+        assert not os.path.exists(path + PARTIAL_EXT)
+
+        # A wrong checksum must be rejected and leave nothing behind
+        try:
+            download_resumable(url, path + "2", "0" * 64)
+            assert False, "checksum mismatch was not detected"
+        except IOError:
+            assert not os.path.exists(path + "2")
+            assert not os.path.exists(path + "2" + PARTIAL_EXT)
+
+        # A gzip-encoded response matches the checksum of the plain file
+        checksum, content_encoding = download_resumable(
+            url + "gzip",
+            path + "3",
+            hashlib.new(CHECKSUM_ALGORITHM, payload).hexdigest(),
+            accept_gzip=True,
+        )
+        assert content_encoding == "gzip"
+        assert checksum == hashlib.new(CHECKSUM_ALGORITHM, payload).hexdigest()
+        os.remove(path + "3")
+
+        # A partial file longer than the remote file, with no known total size, gets
+        # an unsatisfiable range and is downloaded again from the start
+        with open(path + "5" + PARTIAL_EXT, "wb") as f:
+            f.write(payload + b"stale")
+        write_partial_info(
+            path + "5" + PARTIAL_INFO_EXT, {"url": url, "total_size": None}
+        )
+        requests_seen.clear()
+        checksum, content_encoding = download_resumable(
+            url, path + "5", hashlib.new(CHECKSUM_ALGORITHM, payload).hexdigest()
+        )
+        with open(path + "5", "rb") as f:
+            assert f.read() == payload
+        assert requests_seen[:2] == ["bytes=" + str(len(payload) + 5) + "-", None]
+        assert not os.path.exists(path + "5" + PARTIAL_INFO_EXT)
+        os.remove(path + "5")
+
+        # A stalled transfer times out and is retried until it gives up
+        DOWNLOAD_TIMEOUT = (1, 0.2)
+        try:
+            start = time.perf_counter()
+            download_resumable(url + "stall", path + "4")
+            assert False, "stalled transfer did not time out"
+        except IOError:
+            assert time.perf_counter() - start < 2 * MAX_DOWNLOAD_ATTEMPTS
+        for leftover in [path + "4" + PARTIAL_EXT, path + "4" + PARTIAL_INFO_EXT]:
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    finally:
+        DOWNLOAD_TIMEOUT, DOWNLOAD_RETRY_DELAY = previous_settings
+        server.shutdown()
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+
+    print("Resumable download test passed")
+
+
+def run_update_worker(metadata_frame, dataset_dir, update_info):
+    """
+    Update and read back datasets into the given directory and registry, as a
+    separate process would
+    """
+
+    global DATASET_DIR, UPDATE_INFO
+    DATASET_DIR, UPDATE_INFO = dataset_dir, update_info
+
+    update_datasets(metadata_frame)
+    data = retrieve_datasets(metadata_frame)
+    assert set(data) == set(metadata_frame["Alias"])
+
+
+def test_concurrent_updates(processes=4):
+    """
+    Test that processes updating the same datasets at once download each dataset only
+    once from a slow local HTTP server, reuse each other's downloads, and leave a
+    complete registry behind
+    """
+
+    global DATASET_DIR, UPDATE_INFO
+
+    payloads = {
+        "/" + alias + ".csv": ("location,new_cases\n" + "A,1\n" * 10000).encode()
+        for alias in ["lock_test_a", "lock_test_b"]
+    }
+    requests_seen = []
+
+    class SlowHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append(self.path)
+
+            # Take long enough that every process finds the download in progress
+            time.sleep(0.5)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(payloads[self.path])))
+            self.end_headers()
+            self.wfile.write(payloads[self.path])
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = "http://127.0.0.1:" + str(server.server_address[1])
+
+    metadata_frame = pd.DataFrame(
+        {
+            "Alias": [path[1:-len(".csv")] for path in payloads],
+            "URL": [url + path for path in payloads],
+            "Is_ShapeFile": False,
+            "Is_Zip": False,
+            "Extract_FileName": np.nan,
+            "Update_Interval": 1,
+            "Checksum": np.nan,
+            "Encoding": np.nan,
+        }
+    )
+    previous_paths = (DATASET_DIR, UPDATE_INFO)
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            DATASET_DIR = tmp_dir + "/datasets"
+            UPDATE_INFO = tmp_dir + "/timestamps.csv"
+
+            workers = [
+                multiprocessing.Process(
+                    target=run_update_worker,
+                    args=(metadata_frame, DATASET_DIR, UPDATE_INFO),
+                )
+                for i in range(processes)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+            assert all(worker.exitcode == 0 for worker in workers)
+            assert sorted(requests_seen) == sorted(payloads)
+
+            # Every process's update is in the registry, and every file is whole
+            timestamps = read_timestamps()
+            assert set(timestamps.index) == set(metadata_frame["Alias"])
+            for path, payload in payloads.items():
+                with open(DATASET_DIR + path, "rb") as f:
+                    assert f.read() == payload
+                assert timestamps.loc[path[1:-len(".csv")], "Checksum"] == (
+                    hashlib.new(CHECKSUM_ALGORITHM, payload).hexdigest()
+                )
+    finally:
+        DATASET_DIR, UPDATE_INFO = previous_paths
+        server.shutdown()
+        server.server_close()
+
+    print("Concurrent update test passed")
+
+
+def test_scheduler():
+    """
+    Test that the scheduler retries a failing dataset with growing delays, reports
+    it once it updates, and then waits out its Update_Interval
+    """
+
+    global DATASET_DIR, UPDATE_INFO, RETRY_BASE_DELAY
+
+    payload = ("location,new_cases\n" + "A,1\n" * 100).encode()
+    requests_seen = []
+
+    class FlakyHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append(time.perf_counter())
+
+            # Fail the first two requests
+            if len(requests_seen) <= 2:
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    metadata_frame = pd.DataFrame(
+        {
+            "Alias": ["schedule_test"],
+            "URL": ["http://127.0.0.1:" + str(server.server_address[1]) + "/"],
+            "Is_ShapeFile": [False],
+            "Is_Zip": [False],
+            "Extract_FileName": [np.nan],
+            "Update_Interval": [1],
+            "Checksum": [np.nan],
+            "Encoding": [np.nan],
+        }
+    )
+    previous_settings = (DATASET_DIR, UPDATE_INFO, RETRY_BASE_DELAY)
+    updates = []
+    stop_event = threading.Event()
+
+    def on_update(aliases):
+        updates.append(aliases)
+        stop_event.set()
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            DATASET_DIR = tmp_dir + "/datasets"
+            UPDATE_INFO = tmp_dir + "/timestamps.csv"
+            RETRY_BASE_DELAY = 0.2
+
+            scheduler = threading.Thread(
+                target=run_scheduler, args=(metadata_frame, on_update, stop_event)
+            )
+            scheduler.start()
+            scheduler.join(10)
+            stop_event.set()
+
+            assert updates == [["schedule_test"]]
+            assert len(requests_seen) == 3
+
+            # The second retry waits about twice as long as the first
+            first_delay = requests_seen[1] - requests_seen[0]
+            second_delay = requests_seen[2] - requests_seen[1]
+            assert 0.1 <= first_delay and 0.2 <= second_delay
+
+            # The fresh dataset is next due after its Update_Interval
+            update_times = get_update_times(metadata_frame, read_timestamps())
+            assert update_times["schedule_test"] > datetime.datetime.now() + (
+                datetime.timedelta(hours=23)
+            )
+    finally:
+        DATASET_DIR, UPDATE_INFO, RETRY_BASE_DELAY = previous_settings
+        server.shutdown()
+        server.server_close()
+
+    print("Scheduler test passed")
+
+
+def benchmark_storage(metadata_frame):
+    """
+    Compare the disk footprint and read throughput of every downloaded CSV
+    dataset stored plain, gzip-compressed, and zstd-compressed
+    """
+
+    results = []
+
+    for i, row in metadata_frame[~metadata_frame["Is_ShapeFile"]].iterrows():
+        path = find_dataset_file(metadata_frame.loc[i])
+        if path is None:
+            continue
+
+        # Write a copy of the dataset in every storage format
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for compression in [None, "gzip", "zstd"]:
+                copy_path = (
+                    tmp_dir + "/" + row["Alias"] + ".csv"
+                    + COMPRESSION_EXTS.get(compression, "")
+                )
+                try:
+                    with open_dataset_file(
+                        path, pd.io.common.infer_compression(path, "infer"), "rb"
+                    ) as src:
+                        with open_dataset_file(copy_path, compression, "wb") as dst:
+                            shutil.copyfileobj(src, dst, STREAM_CHUNK_SZ)
+                except ImportError as e:
+                    print("Skipping " + str(compression) + ": " + str(e))
+                    continue
+
+                # Time a full read of the copy
+                start = time.perf_counter()
+                frame = pd.read_csv(copy_path)
+                elapsed = time.perf_counter() - start
+
+                results.append(
+                    {
+                        "Alias": row["Alias"],
+                        "Compression": compression or "none",
+                        "Bytes": os.path.getsize(copy_path),
+                        "Read_Seconds": elapsed,
+                        "Rows_Per_Second": len(frame) / elapsed,
+                    }
+                )
+
+    results = pd.DataFrame(results)
+    if len(results) > 0:
+        plain_bytes = results[results["Compression"] == "none"].set_index("Alias")["Bytes"]
+        results["Ratio"] = plain_bytes.reindex(results["Alias"]).values / results["Bytes"]
+
+    print(results)
+    return results
+
+
+def test_compressed_storage():
+    """
+    Test that datasets stored with every compression setting are found and
+    read back identically by retrieve_datasets
+    """
+
+    global STORAGE_COMPRESSION
+
+    metadata_frame = pd.DataFrame(
+        {
+            "Alias": ["compression_test"],
+            "URL": [""],
+            "Is_ShapeFile": [False],
+            "Is_Zip": [False],
+            "Extract_FileName": [np.nan],
+            "Update_Interval": [1],
+        }
+    )
+    expected = pd.DataFrame({"location": ["A", "B"] * 50, "new_cases": range(100)})
+
+    if not os.path.isdir(DATASET_DIR):
+        os.mkdir(DATASET_DIR)
+    download_path = DATASET_DIR + "/compression_test.csv"
+    previous_compression = STORAGE_COMPRESSION
+
+    try:
+        for compression in [None, "gzip", "zstd"]:
+            STORAGE_COMPRESSION = compression
+            expected.to_csv(download_path, index=False)
+            try:
+                store_dataset(
+                    download_path, get_dataset_filename(metadata_frame.loc[0]), None
+                )
+            except ImportError as e:
+                print("Skipping " + str(compression) + ": " + str(e))
+                continue
+
+            path = find_dataset_file(metadata_frame.loc[0])
+            assert path.endswith(".csv" + COMPRESSION_EXTS.get(compression, ""))
+            actual = retrieve_datasets(metadata_frame)["compression_test"]
+            assert actual.equals(expected)
+    finally:
+        STORAGE_COMPRESSION = previous_compression
+        for ext in [""] + list(COMPRESSION_EXTS.values()):
+            if os.path.exists(download_path + ext):
+                os.remove(download_path + ext)
+        if os.path.exists(DATASET_DIR + "/compression_test" + LOCK_EXT):
+            os.remove(DATASET_DIR + "/compression_test" + LOCK_EXT)
+
+    print("Compressed storage test passed")
+
+
 def main():
     """
     Test all methods in data manager
     """
 
+    # Test resuming interrupted downloads
+    test_resumable_download()
+
+    # Test compressed dataset storage
+    test_compressed_storage()
+
+    # Test processes updating the same datasets at once
+    test_concurrent_updates()
+
+    # Test scheduled updates with retries
+    test_scheduler()
+
     # Test retrieve
     datasets = get_dataset_info()
     update_datasets(datasets)
@@ -203,6 +1237,9 @@ def main():
     print(retrieve_datasets(datasets).keys())
     print(datasets)
 
+    # Compare storage formats for the downloaded datasets
+    benchmark_storage(datasets)
+
 
 if __name__ == "__main__":
     main()
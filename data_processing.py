@@ -7,13 +7,27 @@ This file processes all downloaded data into a format used by data analysis to t
 import pandas as pd
 import geopandas as gpd
 import numpy as np
+import shapely
+
+import time
+import os
 
 import data_manager
+import arrow_engine
 
 WORLD_IDENTIFIERS = "metadata/world_country_identifiers.csv"
 STATE_IDENTIFIERS = "metadata/us_state_identifiers.csv"
-TARGET_POP_YEAR = 2020
 WORLD_POP_VARIANT = "Medium"
+US_POP_PREFIX = "POPESTIMATE"
+POP_ESTIMATE_MONTH = 7
+# Rows looked up at a time when finding each row's population or group, which keeps
+# pandas' per-lookup hash tables and other per-row temporaries small
+LOOKUP_BLOCK_ROWS = 8192
+COUNTY_SUMMARY_LEVEL = "050"
+COUNTY_SIMPLIFY_TOLERANCE = 0.01
+DATAFRAME_ENGINE = "pandas"
+WORLD_MAP_MATCHES = "world_map_matches.csv"
+SPATIAL_MATCH_MAX_DISTANCE = 1.0
 
 
 def consolidate_world_data(data):
@@ -21,26 +35,165 @@ def consolidate_world_data(data):
     Return final combined COVID dataset for the world, given a set of raw datasets
     """
 
-    # Get country identifiers, map two letter to three letter ISO codes
-    world_ids = pd.read_csv(WORLD_IDENTIFIERS)
-    world_ids_mapping = get_identifier_mapping(world_ids)
-
     print("Processing world COVID case and vaccination data...")
 
+    # Give every dataset's dates a uniform datetime64 key
+    normalize_dates(data)
+
     # Merge country case and vaccination data
     world_data = process_world_data(data)
 
     print("Merging world data with geospatial map...")
 
     # Merge consolidated dataset with country map data
-    world_map = data["world_countries_map"]
-    world_map["ISO"].replace(world_ids_mapping, inplace=True)
+    world_map = get_world_map(data)
     world_data = merge_geographic_data(world_data, world_map, "iso_code", "ISO")
     world_data = world_data.drop(columns="ISO")
 
     return world_data
 
 
+def get_world_map(data):
+    """
+    Return the world map with its two letter ISO codes replaced by three letter ISO codes
+    """
+
+    # Get country identifiers, map two letter to three letter ISO codes
+    world_ids = pd.read_csv(WORLD_IDENTIFIERS)
+    world_ids_mapping = get_identifier_mapping(world_ids)
+
+    world_map = data["world_countries_map"]
+    world_map["ISO"].replace(world_ids_mapping, inplace=True)
+
+    # Give jurisdictions without a matching code a copy of the polygon found for
+    # them spatially
+    matches = get_world_map_matches(data, world_map)
+    matches = matches[matches["Match"] == "spatial"]
+    matched = matches[["iso_code", "Map_ISO"]].merge(
+        world_map, left_on="Map_ISO", right_on="ISO"
+    )
+    matched["ISO"] = matched["iso_code"]
+
+    return gpd.GeoDataFrame(
+        pd.concat([world_map, matched[world_map.columns]], ignore_index=True),
+        crs=world_map.crs,
+    )
+
+
+def get_world_map_matches(data, world_map):
+    """
+    Return the map polygon matched spatially to every world jurisdiction whose code
+    is not on the map, with unmatched jurisdictions reported. Matches are cached in
+    WORLD_MAP_MATCHES and reused while the same jurisdictions are missing from the
+    map, so only the cache is needed when the world COVID data is not loaded
+    """
+
+    path = data_manager.DATASET_DIR + "/" + WORLD_MAP_MATCHES
+    cached = None
+    if os.path.exists(path):
+        cached = pd.read_csv(path, dtype=str, keep_default_na=False, na_values=[""])
+
+    if "world_covid_data" not in data:
+        return cached if cached is not None else get_spatial_matches(
+            pd.DataFrame(columns=["iso_code", "location"]), world_map, None, []
+        )
+
+    # Jurisdictions whose code the map does not have
+    jurisdictions = data["world_covid_data"][["iso_code", "location"]]
+    jurisdictions = jurisdictions.drop_duplicates("iso_code").dropna()
+    unmatched = jurisdictions[~jurisdictions["iso_code"].isin(world_map["ISO"])]
+
+    # Reuse cached matches for the same jurisdictions onto polygons still on the map
+    if (
+        cached is not None
+        and set(cached["iso_code"]) == set(unmatched["iso_code"])
+        and cached["Map_ISO"].dropna().isin(world_map["ISO"]).all()
+    ):
+        return cached
+
+    matches = get_spatial_matches(
+        unmatched,
+        world_map,
+        data.get("world_country_centroids"),
+        jurisdictions["iso_code"],
+    )
+    matches.to_csv(path, index=False)
+
+    return matches
+
+
+def get_spatial_matches(jurisdictions, world_map, centroids, claimed_codes):
+    """
+    Match each jurisdiction to the map polygon containing its reference point (or the
+    nearest one within SPATIAL_MATCH_MAX_DISTANCE degrees), only among polygons no
+    other jurisdiction's code already claims. Reference points are found by two
+    letter ISO code, then by name. Prints a report of unmatched jurisdictions
+    """
+
+    start = time.perf_counter()
+
+    # Reference point of every jurisdiction, by two letter code and then by name
+    points = pd.Series(None, index=jurisdictions.index, dtype=object)
+    if centroids is not None:
+        centroids = centroids.dropna(subset=["latitude", "longitude"])
+        centroid_points = pd.Series(
+            shapely.points(centroids["longitude"], centroids["latitude"]),
+            index=centroids.index,
+        )
+        world_ids = pd.read_csv(WORLD_IDENTIFIERS)
+        short_ids = get_identifier_mapping(world_ids[["Identifier", "Short_Identifier"]])
+        by_code = centroid_points.groupby(centroids["country"]).first()
+        by_name = centroid_points.groupby(centroids["name"]).first()
+        points = jurisdictions["iso_code"].map(short_ids).map(by_code)
+        points = points.fillna(jurisdictions["location"].map(by_name))
+
+    # Only polygons whose code no jurisdiction has can be matched
+    unclaimed = world_map[~world_map["ISO"].isin(claimed_codes)]
+    tree = shapely.STRtree(unclaimed.geometry.to_numpy())
+
+    has_point = points.notna().to_numpy()
+    query_points = points[has_point].to_numpy()
+    polygon = np.full(len(query_points), -1)
+
+    # Points inside a polygon, then points just off one (islands and coastlines are
+    # generalized away in the map)
+    point_idx, tree_idx = tree.query(query_points, predicate="intersects")
+    polygon[point_idx[::-1]] = tree_idx[::-1]
+    outside = np.flatnonzero(polygon < 0)
+    point_idx, tree_idx = tree.query_nearest(
+        query_points[outside], max_distance=SPATIAL_MATCH_MAX_DISTANCE
+    )
+    polygon[outside[point_idx[::-1]]] = tree_idx[::-1]
+
+    map_iso = np.full(len(jurisdictions), None, dtype=object)
+    map_iso[np.flatnonzero(has_point)[polygon >= 0]] = (
+        unclaimed["ISO"].to_numpy()[polygon[polygon >= 0]]
+    )
+    matches = pd.DataFrame(
+        {
+            "iso_code": jurisdictions["iso_code"].to_numpy(),
+            "location": jurisdictions["location"].to_numpy(),
+            "Map_ISO": map_iso,
+            "Match": np.where(pd.notna(map_iso), "spatial", "unmatched"),
+        }
+    )
+
+    print(
+        "Matched "
+        + str((matches["Match"] == "spatial").sum())
+        + " world jurisdictions to the map spatially in "
+        + str(round(time.perf_counter() - start, 3))
+        + "s, "
+        + str((matches["Match"] == "unmatched").sum())
+        + " unmatched"
+    )
+    unmatched = matches[matches["Match"] == "unmatched"]
+    if len(unmatched) > 0:
+        print(unmatched[["iso_code", "location"]].to_string(index=False))
+
+    return matches
+
+
 def consolidate_us_data(data):
     """
     Return final combined COVID dataset for the US, given a set of raw datasets
@@ -51,6 +204,9 @@ def consolidate_us_data(data):
 
     print("Processing US COVID case and vaccination data...")
 
+    # Give every dataset's dates a uniform datetime64 key
+    normalize_dates(data)
+
     # Merge state case and vaccination data
     us_data = process_us_data(data, state_ids)
 
@@ -60,14 +216,7 @@ def consolidate_us_data(data):
     us_age_ethnicity_deaths_data = process_us_age_ethnicity_data(data, state_ids)
 
     # Merge case, vaccination, and age/ethnicity data together
-    us_all_data = pd.merge_ordered(
-        us_data,
-        us_age_ethnicity_deaths_data,
-        how="outer",
-        left_on=["submission_date", "state"],
-        right_on=["Date", "State"],
-    )
-    us_all_data = us_all_data.drop(columns=["Date", "State"])
+    us_all_data = merge_us_deaths_data(us_data, us_age_ethnicity_deaths_data)
 
     print("Merging US data with geospatial map...")
 
@@ -79,11 +228,141 @@ def consolidate_us_data(data):
     return us_all_data
 
 
+def consolidate_us_county_data(data):
+    """
+    Return final combined COVID dataset for US counties, given a set of raw datasets
+    """
+
+    print("Processing US county COVID case and vaccination data...")
+
+    # Give every dataset's dates a uniform datetime64 key
+    normalize_dates(data)
+
+    # Get county identifiers keyed by FIPS code
+    county_ids = get_county_identifiers(data)
+
+    # Daily new cases and vaccinations from cumulative counts, each keyed by the
+    # county's position in county_ids and the date as one sortable integer
+    us_county_cases = get_daily_changes(
+        data["us_county_covid_data"]["cases"],
+        county_ids.index.get_indexer(data["us_county_covid_data"]["fips"]),
+        data["us_county_covid_data"]["date"],
+    )
+    us_county_vaccinations = get_daily_changes(
+        data["us_county_vaccinations"]["Administered_Dose1_Recip"]
+        + data["us_county_vaccinations"]["Series_Complete_Yes"],
+        county_ids.index.get_indexer(data["us_county_vaccinations"]["FIPS"]),
+        data["us_county_vaccinations"]["Date"],
+    )
+
+    # Join case and vaccination data on their sorted integer keys
+    us_county_data = pd.DataFrame(
+        {"new_case": us_county_cases, "daily_vaccinations": us_county_vaccinations}
+    )
+    keys = us_county_data.index.to_numpy()
+    codes = keys // (1 << 32)
+    us_county_data.insert(0, "fips", county_ids.index[codes])
+    us_county_data.insert(
+        1, "date", (keys % (1 << 32)).astype("datetime64[D]").astype("datetime64[ns]")
+    )
+    us_county_data.reset_index(drop=True, inplace=True)
+
+    print("Merging US county data with geospatial map...")
+
+    # Look up each row's state and simplified county geometry by position
+    us_county_data["state"] = county_ids["state"].to_numpy()[codes]
+    geometry = get_county_map(data).set_index("FIPS")["geometry"]
+    geometry = geometry.reindex(county_ids.index)
+    us_county_data["geometry"] = geometry.to_numpy()[codes]
+
+    return us_county_data
+
+
+def get_daily_changes(totals, location_codes, dates):
+    """
+    Given cumulative totals along with the integer location code and date of each,
+    return the change from each location's previous date (or its first total), keyed
+    and sorted by location and date. Rows with no location code (-1) are dropped
+    """
+
+    dates = dates.to_numpy(dtype="datetime64[ns]")
+    known = (location_codes >= 0) & ~np.isnat(dates)
+    keys = get_location_date_keys(location_codes[known], dates[known])
+    totals = totals.to_numpy(dtype=float)[known]
+
+    order = np.argsort(keys, kind="stable")
+    keys, totals = keys[order], totals[order]
+    location_codes = location_codes[known][order]
+
+    # Difference consecutive totals, restarting at each location's first date
+    changes = totals.copy()
+    changes[1:] -= totals[:-1]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = location_codes[1:] != location_codes[:-1]
+    changes[first] = totals[first]
+
+    return pd.Series(changes, index=keys)
+
+
+def get_county_identifiers(data):
+    """
+    Return the name and two-letter state code of every county in the 50 states + DC,
+    indexed by five digit FIPS code
+    """
+
+    state_ids = pd.read_csv(STATE_IDENTIFIERS)
+
+    counties = data["us_county_population"]
+    counties = counties[
+        (counties["SUMLEV"] == COUNTY_SUMMARY_LEVEL)
+        & counties["STNAME"].isin(state_ids["Name"])
+    ]
+
+    return pd.DataFrame(
+        {
+            "county": counties["CTYNAME"].to_numpy(),
+            "state": counties["STNAME"].map(get_identifier_mapping(state_ids)).to_numpy(),
+        },
+        index=pd.Index(get_county_fips(counties), name="fips"),
+    )
+
+
+def get_county_fips(counties):
+    """
+    Return the five digit FIPS code of every row of census county data
+    """
+
+    return (counties["STATE"].str.zfill(2) + counties["COUNTY"].str.zfill(3)).to_numpy()
+
+
+def get_county_map(data):
+    """
+    Return the county map with one simplified geometry for every FIPS code, dissolving
+    counties split across several map rows into one
+    """
+
+    county_map = data["us_counties_map"][["FIPS", "geometry"]]
+
+    split = county_map["FIPS"].duplicated(keep=False)
+    county_map = pd.concat(
+        [county_map[~split], county_map[split].dissolve(by="FIPS").reset_index()],
+        ignore_index=True,
+    )
+    county_map["geometry"] = county_map.simplify(
+        COUNTY_SIMPLIFY_TOLERANCE, preserve_topology=True
+    )
+
+    return county_map
+
+
 def process_world_data(data):
     """
     Merge several raw world datasets into a single one
     """
 
+    if DATAFRAME_ENGINE == "arrow":
+        return arrow_engine.process_world_data(data)
+
     # Load world data on new COVID cases and daily vaccinations
     world_cases = data["world_covid_data"][
         ["location", "date", "iso_code", "new_cases"]
@@ -106,27 +385,26 @@ def process_us_data(data, state_ids):
     # Get US state two-letter ID mappings
     state_ids_mapping = get_identifier_mapping(state_ids)
 
-    # Load US state data on new COVID cases and daily vaccinations
-    us_cases = data["us_covid_data"][["state", "submission_date", "new_case"]]
-    us_vaccinations = data["us_covid_vaccinations"][
-        ["location", "date", "daily_vaccinations"]
-    ].copy()
-    us_vaccinations["location"].replace(state_ids_mapping, inplace=True)
-    us_vaccinations.rename(
-        columns={"location": "state", "date": "submission_date"}, inplace=True
-    )
-
-    # Merge and filter data to only include required rows and 50 mainland US states + DC
-    us_data = pd.merge(
-        us_cases, us_vaccinations, how="outer", on=["state", "submission_date"]
-    )
-    us_data = us_data[["state", "submission_date", "new_case", "daily_vaccinations"]]
-    us_data = us_data[us_data["state"].isin(state_ids["Identifier"])]
-
-    # Get real datetimes for data
-    us_data["submission_date"] = pd.to_datetime(
-        us_data["submission_date"], infer_datetime_format=True
-    )
+    if DATAFRAME_ENGINE == "arrow":
+        us_data = arrow_engine.process_us_data(data, state_ids, state_ids_mapping)
+    else:
+
+        # Load US state data on new COVID cases and daily vaccinations
+        us_cases = data["us_covid_data"][["state", "submission_date", "new_case"]]
+        us_vaccinations = data["us_covid_vaccinations"][
+            ["location", "date", "daily_vaccinations"]
+        ].copy()
+        us_vaccinations["location"].replace(state_ids_mapping, inplace=True)
+        us_vaccinations.rename(
+            columns={"location": "state", "date": "submission_date"}, inplace=True
+        )
+
+        # Merge and filter data to only include required rows and 50 mainland US states + DC
+        us_data = pd.merge(
+            us_cases, us_vaccinations, how="outer", on=["state", "submission_date"]
+        )
+        us_data = us_data[["state", "submission_date", "new_case", "daily_vaccinations"]]
+        us_data = us_data[us_data["state"].isin(state_ids["Identifier"])]
 
     return us_data
 
@@ -156,9 +434,6 @@ def process_us_age_ethnicity_data(data, state_ids):
             "Deaths_Unknown",
         ]
     ].copy()
-    us_ethnicity_deaths["Date"] = pd.to_datetime(
-        us_ethnicity_deaths["Date"], format="%Y%m%d"
-    )
     us_ethnicity_deaths = us_ethnicity_deaths[
         us_ethnicity_deaths["State"].isin(state_ids["Identifier"])
     ]
@@ -180,7 +455,6 @@ def process_us_age_ethnicity_data(data, state_ids):
         0, column="Date", value=data["us_covid_age_deaths"]["End Date"]
     )
     us_age_deaths.insert(1, column="State", value=data["us_covid_age_deaths"]["State"])
-    us_age_deaths["Date"] = pd.to_datetime(us_age_deaths["Date"], format="%m/%d/%Y")
 
     # Filter age data to only contain the 50 mainland US states + DC, collapse by day and state
     us_age_deaths = us_age_deaths[us_age_deaths["State"].isin(state_ids["Name"])]
@@ -188,6 +462,11 @@ def process_us_age_ethnicity_data(data, state_ids):
     us_age_deaths = us_age_deaths.groupby(["Date", "State"]).mean()
 
     # Merge ethnicity and age death data
+    if DATAFRAME_ENGINE == "arrow":
+        return arrow_engine.merge_ordered_outer(
+            us_ethnicity_deaths, us_age_deaths.reset_index(), ["Date", "State"]
+        )
+
     us_age_ethnicity_data = pd.merge_ordered(
         us_ethnicity_deaths, us_age_deaths, how="outer", on=["Date", "State"]
     )
@@ -195,6 +474,31 @@ def process_us_age_ethnicity_data(data, state_ids):
     return us_age_ethnicity_data
 
 
+def merge_us_deaths_data(us_data, us_age_ethnicity_deaths_data):
+    """
+    Outer merge US case and vaccination data with age and ethnicity death data in
+    date and state order, keeping only the case data's date and state columns
+    """
+
+    if DATAFRAME_ENGINE == "arrow":
+        return arrow_engine.merge_ordered_outer(
+            us_data,
+            us_age_ethnicity_deaths_data,
+            ["submission_date", "state"],
+            ["Date", "State"],
+        )
+
+    us_all_data = pd.merge_ordered(
+        us_data,
+        us_age_ethnicity_deaths_data,
+        how="outer",
+        left_on=["submission_date", "state"],
+        right_on=["Date", "State"],
+    )
+
+    return us_all_data.drop(columns=["Date", "State"])
+
+
 def get_world_pop_data(data):
     """
     Process and return world population data in an acceptable format, given a raw world population dataset
@@ -202,13 +506,10 @@ def get_world_pop_data(data):
 
     print("Retrieving world population data...")
 
-    # Load and filter world population data
+    # Load and filter world population data, keeping every year
     world_pop_data = data["world_population"]
-    world_pop_data = world_pop_data[
-        (world_pop_data["Time"] == TARGET_POP_YEAR)
-        & (world_pop_data["Variant"] == WORLD_POP_VARIANT)
-    ]
-    world_pop_data = world_pop_data[["Location", "Time", "PopTotal"]]
+    world_pop_data = world_pop_data[world_pop_data["Variant"] == WORLD_POP_VARIANT]
+    world_pop_data = world_pop_data[["Location", "Time", "PopTotal"]].copy()
     world_pop_data["PopTotal"] *= 1000
 
     # Get mapping of country names to ISO codes and two-letter to three-letter ISO codes
@@ -233,9 +534,8 @@ def get_us_pop_data(data):
 
     print("Retrieving US population data...")
 
-    # Load and filter US population data
-    us_pop_data = data["us_population"]
-    us_pop_data = us_pop_data[["NAME", "POPESTIMATE2020"]]
+    # Load US population data, with one row for each state's estimate for each year
+    us_pop_data = melt_pop_estimates(data["us_population"], "NAME")
 
     # Get US state two-letter ID mappings
     state_ids = pd.read_csv(STATE_IDENTIFIERS)
@@ -248,6 +548,158 @@ def get_us_pop_data(data):
     return us_pop_data
 
 
+def get_us_county_pop_data(data):
+    """
+    Process and return US county population data keyed by FIPS code, with one row for
+    each county's estimate for each year, given a raw county population dataset
+    """
+
+    print("Retrieving US county population data...")
+
+    # Keep only county rows, dropping state totals
+    us_county_pop_data = data["us_county_population"]
+    us_county_pop_data = us_county_pop_data[
+        us_county_pop_data["SUMLEV"] == COUNTY_SUMMARY_LEVEL
+    ].copy()
+    us_county_pop_data["FIPS"] = get_county_fips(us_county_pop_data)
+
+    return melt_pop_estimates(us_county_pop_data, "FIPS")
+
+
+def melt_pop_estimates(pop_data, locations_col):
+    """
+    Given census data with a POPESTIMATE column for each year, return one row for
+    each location's estimate for each year
+    """
+
+    pop_data = pop_data.melt(
+        id_vars=locations_col,
+        value_vars=[
+            column for column in pop_data.columns if column.startswith(US_POP_PREFIX)
+        ],
+        var_name="Time",
+        value_name=US_POP_PREFIX,
+    )
+    pop_data["Time"] = pop_data["Time"].str[len(US_POP_PREFIX):].astype(int)
+
+    return pop_data
+
+
+def get_daily_population(
+    data, data_locations_col, date_col, pop_data, pop_locations_col, pop_col
+):
+    """
+    Return the population of each row's jurisdiction on the row's date, aligned with
+    the rows of data. Yearly estimates are taken as of POP_ESTIMATE_MONTH and
+    interpolated linearly between years, holding the first and last estimates
+    constant before and after them
+    """
+
+    # Estimates sorted by location code and date, each keyed by both at once
+    locations = pd.Index(pop_data[pop_locations_col].unique())
+    estimates = pd.DataFrame(
+        {
+            "location": locations.get_indexer(pop_data[pop_locations_col]),
+            "date": pd.to_datetime(
+                pd.DataFrame(
+                    {"year": pop_data["Time"], "month": POP_ESTIMATE_MONTH, "day": 1}
+                )
+            ),
+            "population": pop_data[pop_col].to_numpy(dtype=float),
+        }
+    ).sort_values(["location", "date"])
+    estimate_locations = estimates["location"].to_numpy()
+    estimate_dates = estimates["date"].to_numpy()
+    estimate_populations = estimates["population"].to_numpy()
+    estimate_keys = get_location_date_keys(estimate_locations, estimate_dates)
+
+    # Rows are interpolated a block at a time, so lookups and temporaries stay small
+    all_locations = data[data_locations_col].to_numpy()
+    all_dates = data[date_col].to_numpy(dtype="datetime64[ns]")
+    daily_population = np.full(len(data), np.nan)
+
+    for start in range(0, len(data), LOOKUP_BLOCK_ROWS):
+        end = start + LOOKUP_BLOCK_ROWS
+
+        # Find the latest estimate at or before every row's date in one sorted pass
+        row_locations = locations.get_indexer(all_locations[start:end])
+        row_dates = all_dates[start:end]
+        known = (row_locations >= 0) & ~np.isnat(row_dates)
+        row_locations, row_dates = row_locations[known], row_dates[known]
+        latest = (
+            np.searchsorted(
+                estimate_keys,
+                get_location_date_keys(row_locations, row_dates),
+                side="right",
+            )
+            - 1
+        )
+
+        # Dates before a location's first estimate take that first estimate
+        first = np.searchsorted(estimate_locations, row_locations)
+        latest = np.where(
+            estimate_locations[latest.clip(0)] == row_locations, latest, first
+        )
+        latest = latest.clip(0)
+
+        # Interpolate toward the next estimate of the same location, if there is one
+        following = (latest + 1).clip(max=len(estimates) - 1)
+        has_following = (
+            (following > latest)
+            & (estimate_locations[following] == row_locations)
+            & (row_dates > estimate_dates[latest])
+        )
+        fraction = (row_dates - estimate_dates[latest]) / (
+            estimate_dates[following] - estimate_dates[latest]
+        )
+        population = estimate_populations[latest]
+        population += np.where(
+            has_following,
+            (estimate_populations[following] - population) * fraction,
+            0.0,
+        )
+
+        daily_population[start:end][known] = population
+
+    return pd.Series(daily_population, index=data.index)
+
+
+def get_location_date_keys(location_codes, dates):
+    """
+    Return a single sortable key for each pair of integer location code and date,
+    ordering by location and then by day
+    """
+
+    days = dates.astype("datetime64[D]").astype(np.int64)
+
+    return location_codes.astype(np.int64) * (1 << 32) + days
+
+
+def get_date_columns():
+    """
+    Return the alias, column, and date format of every date column declared in
+    the dataset schemas
+    """
+
+    schemas = data_manager.get_dataset_schemas()
+    schemas = schemas[schemas["Date_Format"].notna()]
+
+    return zip(schemas["Alias"], schemas["Column"], schemas["Date_Format"])
+
+
+def normalize_dates(data):
+    """
+    Replace every date column declared in the dataset schemas with parsed datetimes,
+    skipping columns that were already parsed when their dataset was loaded
+    """
+
+    for alias, column, date_format in get_date_columns():
+        if alias in data and column in data[alias].columns:
+            data[alias][column] = data_manager.parse_dates(
+                data[alias][column], date_format
+            )
+
+
 def get_identifier_mapping(csv_ids):
     """
     Return from jurisdiction name and postal/iso code data a mapping that can be used by pd.replace
@@ -270,11 +722,141 @@ def merge_geographic_data(data, geodata, data_locations_col, geodata_locations_c
     )
 
 
+def benchmark_date_parsing(data, repeats=3):
+    """
+    Time parsing every date column in the dataset schemas element by element
+    against parsing each column's unique values once
+    """
+
+    results = []
+
+    for alias, column, date_format in get_date_columns():
+        raw = data[alias][column]
+        if pd.api.types.is_datetime64_any_dtype(raw):
+            raw = raw.dt.strftime(date_format)
+
+        # Parse every element
+        start = time.perf_counter()
+        for i in range(repeats):
+            expected = pd.to_datetime(raw, format=date_format)
+        elementwise = (time.perf_counter() - start) / repeats
+
+        # Parse unique values and map them back
+        start = time.perf_counter()
+        for i in range(repeats):
+            actual = data_manager.parse_dates(raw, date_format)
+        cached = (time.perf_counter() - start) / repeats
+
+        assert actual.equals(expected)
+        results.append(
+            {
+                "Alias": alias,
+                "Column": column,
+                "Rows": len(raw),
+                "Unique": raw.nunique(),
+                "Elementwise_Seconds": elementwise,
+                "Cached_Seconds": cached,
+                "Speedup": elementwise / cached,
+            }
+        )
+
+    results = pd.DataFrame(results)
+    print(results)
+
+    return results
+
+
+def benchmark_daily_population(data, pop_data, data_locations_col, date_col, pop_col):
+    """
+    Time interpolating every row's population with one as-of join against
+    interpolating each jurisdiction's rows separately, checking both agree
+    """
+
+    data = data[data[data_locations_col].isin(pop_data.iloc[:, 0])]
+
+    # Interpolate each jurisdiction on its own
+    start = time.perf_counter()
+    expected = pd.Series(np.nan, index=data.index)
+    for location, rows in data.groupby(data_locations_col)[date_col]:
+        estimates = pop_data[pop_data.iloc[:, 0] == location].sort_values("Time")
+        estimate_dates = pd.to_datetime(
+            estimates["Time"].astype(str) + "-" + str(POP_ESTIMATE_MONTH) + "-01"
+        )
+        expected[rows.index] = np.interp(
+            rows.to_numpy(dtype="int64"),
+            estimate_dates.to_numpy(dtype="int64"),
+            estimates[pop_col].to_numpy(dtype=float),
+        )
+    per_jurisdiction = time.perf_counter() - start
+
+    # Interpolate every row at once
+    start = time.perf_counter()
+    actual = get_daily_population(
+        data, data_locations_col, date_col, pop_data, pop_data.columns[0], pop_col
+    )
+    as_of_join = time.perf_counter() - start
+
+    assert np.allclose(actual, expected)
+    results = pd.DataFrame(
+        [
+            {
+                "Rows": len(data),
+                "Jurisdictions": data[data_locations_col].nunique(),
+                "Years": pop_data["Time"].nunique(),
+                "Per_Jurisdiction_Seconds": per_jurisdiction,
+                "As_Of_Join_Seconds": as_of_join,
+                "Speedup": per_jurisdiction / as_of_join,
+            }
+        ]
+    )
+    print(results)
+
+    return results
+
+
+def test_get_spatial_matches():
+    """
+    Test that jurisdictions missing from the map are matched to unclaimed polygons by
+    reference point, and that the rest are reported unmatched
+    """
+
+    world_map = gpd.GeoDataFrame(
+        {"ISO": ["AFG", "XA", "XB"]},
+        geometry=[shapely.box(i * 3, 0, i * 3 + 2, 2) for i in range(3)],
+    )
+    centroids = pd.DataFrame(
+        {
+            "country": ["AF", "AL", "QQ", "ZZ"],
+            "latitude": [1.0, 1.0, 1.0, 1.0],
+            "longitude": [1.0, 4.0, 8.5, 1.5],
+            "name": ["Afghanistan", "Albania", "Somewhere", "Stray"],
+        }
+    )
+    jurisdictions = pd.DataFrame(
+        {
+            "iso_code": ["ALB", "OWID_SMW", "OWID_STR", "OWID_WRL"],
+            "location": ["Albania", "Somewhere", "Stray", "World"],
+        }
+    )
+
+    matches = get_spatial_matches(
+        jurisdictions, world_map, centroids, ["AFG"] + list(jurisdictions["iso_code"])
+    )
+
+    # By code inside a polygon, by name just off one, never onto a claimed polygon
+    assert list(matches["Map_ISO"]) == ["XA", "XB", None, None]
+    assert list(matches["Match"]) == ["spatial", "spatial", "unmatched", "unmatched"]
+
+    print("Spatial map matching test passed")
+
+
 def main():
     """
     Test all methods in data_processing
     """
 
+    test_get_spatial_matches()
+
     datasets = data_manager.get_dataset_info()
     data_manager.update_datasets(datasets)
     data = data_manager.retrieve_datasets(datasets)
@@ -293,6 +875,15 @@ def main():
     print(world_pop)
     print(us_pop)
 
+    # Time cached date parsing against parsing every element
+    benchmark_date_parsing(data_manager.retrieve_datasets(datasets))
+
+    # Time daily population interpolation over the full world and US histories
+    benchmark_daily_population(world_c_data, world_pop, "iso_code", "date", "PopTotal")
+    benchmark_daily_population(
+        us_c_data, us_pop, "state", "submission_date", US_POP_PREFIX
+    )
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,322 @@
+"""
+Daniel Rashevsky
+CSE 163 AE
+This file exports analysis results as compressed Parquet for downstream jobs, with the
+daily per capita tables partitioned by region and month so a single month or
+jurisdiction can be read without rerunning the pipeline
+"""
+
+import pandas as pd
+import numpy as np
+
+import functools
+import operator
+import tempfile
+import shutil
+import time
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = None
+    pq = None
+    ds = None
+
+import data_manager
+import analysis
+
+EXPORT_DIR = "export"
+EXPORT_TABLES = ["daily", "by_jurisdiction", "by_day"]
+EXPORT_COMPRESSION = "zstd"
+EXPORT_COMPRESSION_LEVEL = 6
+EXPORT_ROW_GROUP_SIZE = 16384
+MONTH_COL = "month"
+# Jurisdiction and date columns of each region's daily results
+EXPORT_REGIONS = {
+    "world": ("iso_code", "date"),
+    "us": ("state", "submission_date"),
+    "us_county": ("fips", "date"),
+}
+
+
+def require_pyarrow():
+    """
+    Raise an ImportError if pyarrow is not installed
+    """
+
+    if pa is None:
+        raise ImportError("Exporting results requires the pyarrow package")
+
+
+def write_parquet(frame, path):
+    """
+    Write a dataframe as a compressed Parquet file with statistics for every row group
+    """
+
+    pq.write_table(
+        pa.Table.from_pandas(frame, preserve_index=False),
+        path,
+        row_group_size=EXPORT_ROW_GROUP_SIZE,
+        compression=EXPORT_COMPRESSION,
+        compression_level=EXPORT_COMPRESSION_LEVEL,
+        write_statistics=True,
+    )
+
+
+def export_region(region, results):
+    """
+    Export one region's results, replacing any earlier export of it. Daily results are
+    written one file per month, sorted by jurisdiction and date so each row group's
+    statistics cover a narrow range of jurisdictions
+    """
+
+    require_pyarrow()
+    start = time.perf_counter()
+    jurisdiction_col, date_col = EXPORT_REGIONS[region]
+    daily_results, results_by_jurisdiction, results_by_day = (
+        result.drop(columns="geometry", errors="ignore") for result in results
+    )
+
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=EXPORT_DIR) as tmp_dir:
+
+        # Daily results, partitioned by month
+        daily_results = daily_results.sort_values([jurisdiction_col, date_col])
+        # Truncate dates to months before formatting, only the distinct months
+        months = daily_results[date_col].to_numpy().astype("datetime64[M]")
+        for month, rows in daily_results.groupby(months).indices.items():
+            month_dir = tmp_dir + "/daily/" + MONTH_COL + "=" + str(month)[:7]
+            os.makedirs(month_dir)
+            write_parquet(daily_results.iloc[rows], month_dir + "/part-0.parquet")
+
+        # Aggregates, keyed by their index
+        for table, result in [
+            ("by_jurisdiction", results_by_jurisdiction),
+            ("by_day", results_by_day),
+        ]:
+            os.makedirs(tmp_dir + "/" + table)
+            write_parquet(result.reset_index(), tmp_dir + "/" + table + "/part-0.parquet")
+
+        # Swap each table's new export in for the old one
+        for table in EXPORT_TABLES:
+            region_dir = get_export_path(table, region)
+            if os.path.exists(region_dir):
+                shutil.rmtree(region_dir)
+            os.makedirs(os.path.dirname(region_dir), exist_ok=True)
+            os.replace(tmp_dir + "/" + table, region_dir)
+
+    print(
+        "Exported "
+        + region
+        + " results in "
+        + str(round(time.perf_counter() - start, 3))
+        + "s"
+    )
+
+
+def export_results(results):
+    """
+    Export the results of every region, given as a dictionary from region name to the
+    results of its pipeline
+    """
+
+    for region, region_results in results.items():
+        export_region(region, region_results)
+
+
+def get_export_path(table, region):
+    """
+    Return the directory an exported table of a region is written to
+    """
+
+    return EXPORT_DIR + "/" + table + "/region=" + region
+
+
+def read_export(region, table="daily", jurisdictions=None, months=None, columns=None):
+    """
+    Read an exported table of a region, optionally only some jurisdictions, months
+    (as YYYY-MM), and columns. Months not asked for are never opened, and row groups
+    without any asked-for jurisdiction are skipped by their statistics
+    """
+
+    require_pyarrow()
+    jurisdiction_col, date_col = EXPORT_REGIONS[region]
+
+    dataset = ds.dataset(
+        get_export_path(table, region), format="parquet", partitioning="hive"
+    )
+
+    expression = get_filter(
+        jurisdiction_col, jurisdictions, months if table == "daily" else None
+    )
+    frame = dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+    return frame.drop(columns=MONTH_COL, errors="ignore")
+
+
+def get_filter(jurisdiction_col, jurisdictions, months):
+    """
+    Return a dataset filter keeping only the given jurisdictions and months (either
+    None for all). Each value gets its own equality test, which row group statistics
+    can rule out where a set membership test cannot
+    """
+
+    expression = ds.scalar(True)
+
+    for col, values in [(jurisdiction_col, jurisdictions), (MONTH_COL, months)]:
+        if values is not None:
+            expression = expression & functools.reduce(
+                operator.or_, [ds.field(col) == value for value in values]
+            )
+
+    return expression
+
+
+def count_row_groups(region, jurisdictions=None, months=None):
+    """
+    Return how many row groups of a region's daily export a read of the given
+    jurisdictions and months opens, and how many there are in total
+    """
+
+    jurisdiction_col, date_col = EXPORT_REGIONS[region]
+    dataset = ds.dataset(
+        get_export_path("daily", region), format="parquet", partitioning="hive"
+    )
+
+    expression = get_filter(jurisdiction_col, jurisdictions, months)
+    read = sum(
+        len(fragment.split_by_row_group(expression, schema=dataset.schema))
+        for fragment in dataset.get_fragments(filter=expression)
+    )
+    total = sum(fragment.num_row_groups for fragment in dataset.get_fragments())
+
+    return read, total
+
+
+def test_export():
+    """
+    Test that exported results read back identically, in full and by jurisdiction
+    and month, and that such reads skip the partitions and row groups they do not need
+    """
+
+    global EXPORT_DIR, EXPORT_ROW_GROUP_SIZE
+
+    rng = np.random.default_rng(0)
+    dates = pd.date_range("2021-01-01", periods=120)
+    states = ["CA", "ID", "NV", "OR", "WA"]
+    daily_results = pd.DataFrame(
+        {
+            "submission_date": np.tile(dates, len(states)),
+            "state": np.repeat(states, len(dates)),
+            "new_case": rng.random(len(dates) * len(states)),
+            "daily_vaccinations": rng.random(len(dates) * len(states)),
+            "geometry": None,
+        }
+    )
+    results = (
+        daily_results,
+        analysis.filled_means(daily_results.groupby("state"), ["new_case"]),
+        analysis.filled_means(daily_results.groupby("submission_date"), ["new_case"]),
+    )
+    previous_settings = (EXPORT_DIR, EXPORT_ROW_GROUP_SIZE)
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            EXPORT_DIR = tmp_dir
+            EXPORT_ROW_GROUP_SIZE = 10
+            export_results({"us": results})
+
+            # Everything reads back, in jurisdiction and date order
+            expected = daily_results.drop(columns="geometry")
+            actual = read_export("us").sort_values(["state", "submission_date"])
+            pd.testing.assert_frame_equal(
+                actual.reset_index(drop=True),
+                expected.sort_values(["state", "submission_date"]).reset_index(drop=True),
+            )
+            pd.testing.assert_frame_equal(
+                read_export("us", "by_jurisdiction").set_index("state"), results[1]
+            )
+
+            # A single state and a single month
+            washington = read_export("us", jurisdictions=["WA"])
+            assert (washington["state"] == "WA").all() and len(washington) == len(dates)
+            march = read_export("us", months=["2021-03"])
+            assert (march["submission_date"].dt.month == 3).all() and len(march) == 31 * 5
+
+            # Other months are never opened, and other states' row groups are skipped
+            read, total = count_row_groups("us", ["WA"], ["2021-03"])
+            assert read < total / 10
+
+            # Files are compressed and carry row group statistics
+            path = get_export_path("daily", "us") + "/month=2021-03/part-0.parquet"
+            row_group = pq.ParquetFile(path).metadata.row_group(0)
+            state_column = row_group.column(1)
+            assert state_column.compression == EXPORT_COMPRESSION.upper()
+            assert state_column.statistics.has_min_max
+    finally:
+        EXPORT_DIR, EXPORT_ROW_GROUP_SIZE = previous_settings
+
+    print("Export test passed")
+
+
+def benchmark_export(region):
+    """
+    Time reading a region's whole daily export against reading only its first
+    jurisdiction and only its last month
+    """
+
+    jurisdiction_col, date_col = EXPORT_REGIONS[region]
+    results = []
+
+    full = read_export(region)
+    reads = [
+        ("all", None, None),
+        ("one jurisdiction", [full[jurisdiction_col].min()], None),
+        ("one month", None, [full[date_col].max().strftime("%Y-%m")]),
+    ]
+
+    for name, jurisdictions, months in reads:
+        start = time.perf_counter()
+        frame = read_export(region, jurisdictions=jurisdictions, months=months)
+        seconds = time.perf_counter() - start
+        read, total = count_row_groups(region, jurisdictions, months)
+
+        results.append(
+            {
+                "Read": name,
+                "Rows": len(frame),
+                "Row_Groups": read,
+                "Total_Row_Groups": total,
+                "Seconds": seconds,
+            }
+        )
+
+    results = pd.DataFrame(results)
+    print(results)
+
+    return results
+
+
+def main():
+    """
+    Test all methods in export, then export and read back world and US results
+    """
+
+    test_export()
+
+    datasets = data_manager.get_dataset_info()
+    data_manager.update_datasets(datasets)
+    data = data_manager.retrieve_datasets(datasets)
+
+    export_results(
+        {"world": analysis.run_world_pipeline(data), "us": analysis.run_us_pipeline(data)}
+    )
+    benchmark_export("world")
+    benchmark_export("us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+Daniel Rashevsky
+CSE 163 AE
+This file computes the lagged cross-correlation between per capita daily vaccinations
+and new cases for every country and US state at once
+"""
+
+import pandas as pd
+import numpy as np
+
+import data_manager
+import analysis
+import visualization
+
+MAX_LAG_DAYS = 60
+MIN_OVERLAP_DAYS = 30
+WORLD_CASES_STAT = "new_cases"
+US_CASES_STAT = "new_case"
+VACCINATIONS_STAT = "daily_vaccinations"
+
+
+def get_jurisdiction_matrix(daily_results, jurisdiction_col, date_col, stat):
+    """
+    Return a stat from per-row results as a date x jurisdiction matrix covering
+    every day in the results, with missing days left empty
+    """
+
+    matrix = daily_results.pivot_table(
+        index=date_col, columns=jurisdiction_col, values=stat, dropna=False
+    )
+
+    return matrix.reindex(pd.date_range(matrix.index.min(), matrix.index.max()))
+
+
+def cross_correlate(a, b, nfft):
+    """
+    Return sum over t of a[t] * b[t + lag] for every lag and every column at once,
+    with negative lags wrapped around to the end of the first axis
+    """
+
+    a_fft = np.fft.rfft(a, n=nfft, axis=0)
+    b_fft = np.fft.rfft(b, n=nfft, axis=0)
+
+    return np.fft.irfft(np.conj(a_fft) * b_fft, n=nfft, axis=0)
+
+
+def lagged_cross_correlation(leading, following, max_lag=MAX_LAG_DAYS):
+    """
+    Given two date x jurisdiction matrices with the same shape, return the Pearson
+    correlation between leading[t] and following[t + lag] for every jurisdiction and
+    every lag from -max_lag to max_lag days, using only days where both are known
+    """
+
+    x = leading.to_numpy(dtype=float)
+    y = following.to_numpy(dtype=float)
+    x_mask = ~np.isnan(x)
+    y_mask = ~np.isnan(y)
+
+    # Standardize each column first to keep the FFT sums well conditioned
+    x = np.where(x_mask, (x - np.nanmean(x, axis=0)) / np.nanstd(x, axis=0), 0.0)
+    y = np.where(y_mask, (y - np.nanmean(y, axis=0)) / np.nanstd(y, axis=0), 0.0)
+    x = np.nan_to_num(x)
+    y = np.nan_to_num(y)
+    x_mask = x_mask.astype(float)
+    y_mask = y_mask.astype(float)
+
+    # Every running sum the correlation needs, for all lags and columns in one pass each
+    nfft = 2 ** int(np.ceil(np.log2(2 * len(x))))
+    n = np.round(cross_correlate(x_mask, y_mask, nfft))
+    sum_x = cross_correlate(x, y_mask, nfft)
+    sum_y = cross_correlate(x_mask, y, nfft)
+    sum_xx = cross_correlate(x * x, y_mask, nfft)
+    sum_yy = cross_correlate(x_mask, y * y, nfft)
+    sum_xy = cross_correlate(x, y, nfft)
+
+    # Keep lags -max_lag..max_lag, in order
+    lags = np.arange(-max_lag, max_lag + 1)
+    rows = lags % nfft
+    n, sum_x, sum_y, sum_xx, sum_yy, sum_xy = (
+        values[rows] for values in (n, sum_x, sum_y, sum_xx, sum_yy, sum_xy)
+    )
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        correlation = (n * sum_xy - sum_x * sum_y) / np.sqrt(
+            (n * sum_xx - sum_x ** 2) * (n * sum_yy - sum_y ** 2)
+        )
+    correlation[n < MIN_OVERLAP_DAYS] = np.nan
+
+    return pd.DataFrame(
+        np.clip(correlation, -1, 1).T,
+        index=leading.columns,
+        columns=pd.Index(lags, name="lag_days"),
+    )
+
+
+def analyze_lagged_correlation(daily_results, jurisdiction_col, date_col, cases_stat):
+    """
+    Return the lagged cross-correlation between per capita daily vaccinations and new
+    cases for every jurisdiction, with positive lags meaning vaccinations lead cases,
+    along with the strongest negative correlation and its lag for each jurisdiction
+    """
+
+    vaccinations = get_jurisdiction_matrix(
+        daily_results, jurisdiction_col, date_col, VACCINATIONS_STAT
+    )
+    cases = get_jurisdiction_matrix(
+        daily_results, jurisdiction_col, date_col, cases_stat
+    ).reindex(index=vaccinations.index, columns=vaccinations.columns)
+
+    correlation = lagged_cross_correlation(vaccinations, cases)
+
+    # Vaccinations slowing the spread show up as a negative correlation at a positive lag
+    following = correlation.loc[:, correlation.columns >= 0]
+    summary = pd.DataFrame(
+        {
+            "min_correlation": following.min(axis=1),
+            "min_correlation_lag_days": following.idxmin(axis=1),
+        }
+    )
+
+    return correlation, summary
+
+
+def analyze_world_lagged_correlation(world_results):
+    """
+    Return the lagged cross-correlation table and summary for every country
+    """
+
+    print("Correlating world vaccinations with new cases...")
+
+    return analyze_lagged_correlation(
+        world_results[0], "location", "date", WORLD_CASES_STAT
+    )
+
+
+def analyze_us_lagged_correlation(us_results):
+    """
+    Return the lagged cross-correlation table and summary for every US state
+    """
+
+    print("Correlating US vaccinations with new cases...")
+
+    return analyze_lagged_correlation(
+        us_results[0], "state", "submission_date", US_CASES_STAT
+    )
+
+
+def test_lagged_cross_correlation():
+    """
+    Test the batched correlation against pandas Series.corr for every column and lag
+    """
+
+    rng = np.random.default_rng(0)
+    dates = pd.date_range("2021-01-01", periods=200)
+    leading = pd.DataFrame(rng.random((200, 3)), index=dates, columns=["A", "B", "C"])
+
+    # Each following column mirrors its leading column inverted 14 days later, with gaps
+    following = -leading.shift(14) + rng.normal(0, 0.05, (200, 3))
+    leading.iloc[20:30, 1] = np.nan
+    following.iloc[100:110, 1] = np.nan
+
+    correlation = lagged_cross_correlation(leading, following, 20)
+
+    for column in leading.columns:
+        for lag in [-20, -3, 0, 14, 20]:
+            expected = leading[column].corr(following[column].shift(-lag))
+            assert np.isclose(correlation.loc[column, lag], expected), (column, lag)
+
+    assert (correlation.idxmin(axis=1) == 14).all()
+
+    print("Lagged cross-correlation test passed")
+
+
+def main():
+    """
+    Test all methods in lag_analysis
+    """
+
+    test_lagged_cross_correlation()
+
+    datasets = data_manager.get_dataset_info()
+    data_manager.update_datasets(datasets)
+    data = data_manager.retrieve_datasets(datasets)
+
+    world_results = analysis.run_world_pipeline(data)
+    us_results = analysis.run_us_pipeline(data)
+
+    # Test correlation tables and heatmaps for the world and US
+    world_correlation, world_summary = analyze_world_lagged_correlation(world_results)
+    print(world_summary)
+    visualization.plot_heatmap(
+        world_correlation,
+        "vaccinations_new_cases_lagged_correlation_by_country",
+        visualization.WORLD_EXT,
+    )
+
+    us_correlation, us_summary = analyze_us_lagged_correlation(us_results)
+    print(us_summary)
+    visualization.plot_heatmap(
+        us_correlation,
+        "vaccinations_new_cases_lagged_correlation_by_state",
+        visualization.US_EXT,
+    )
+
+
+if __name__ == "__main__":
+    main()
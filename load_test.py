@@ -0,0 +1,141 @@
+"""
+Daniel Rashevsky
+CSE 163 AE
+This file load tests the results service in server.py, measuring p50 and p99 latency
+for each endpoint
+"""
+
+import pandas as pd
+import numpy as np
+
+import argparse
+import asyncio
+import time
+
+import server
+
+DEFAULT_PATHS = [
+    "/world/jurisdictions",
+    "/world/days",
+    "/us/jurisdictions",
+    "/us/days",
+    "/us/jurisdictions/WA",
+    "/us/map/daily_vaccinations.png",
+    "/world/plot/new_cases.png",
+]
+
+
+async def request(reader, writer, host, path):
+    """
+    Send a GET request on a keep-alive connection and read the full response,
+    returning its status code
+    """
+
+    writer.write(("GET " + path + " HTTP/1.1\r\nHost: " + host + "\r\n\r\n").encode())
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    content_length = 0
+    while True:
+        line = await reader.readline()
+        if line in [b"\r\n", b""]:
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.lower() == "content-length":
+            content_length = int(value)
+    await reader.readexactly(content_length)
+
+    return status
+
+
+async def client(host, port, paths, num_requests, latencies):
+    """
+    Issue requests for the given paths in turn over one connection, recording
+    the latency of each
+    """
+
+    reader, writer = await asyncio.open_connection(host, port)
+
+    try:
+        for i in range(num_requests):
+            path = paths[i % len(paths)]
+            start = time.perf_counter()
+            status = await request(reader, writer, host, path)
+            latencies.append((path, status, time.perf_counter() - start))
+    finally:
+        writer.close()
+
+
+async def run_load_test(host, port, paths, concurrency, requests_per_client):
+    """
+    Run concurrent clients against the service and return every request's latency
+    """
+
+    latencies = []
+
+    # Stagger starting paths so clients do not all request the same thing at once
+    await asyncio.gather(
+        *[
+            client(
+                host,
+                port,
+                paths[i % len(paths):] + paths[:i % len(paths)],
+                requests_per_client,
+                latencies,
+            )
+            for i in range(concurrency)
+        ]
+    )
+
+    return pd.DataFrame(latencies, columns=["Path", "Status", "Seconds"])
+
+
+def summarize(latencies, elapsed):
+    """
+    Return p50 and p99 latency in milliseconds for every path and overall
+    """
+
+    latencies = latencies.assign(Milliseconds=latencies["Seconds"] * 1000)
+    by_path = latencies.groupby("Path")["Milliseconds"]
+    summary = pd.DataFrame(
+        {
+            "Requests": by_path.size(),
+            "Errors": latencies[latencies["Status"] != 200].groupby("Path").size(),
+            "p50_ms": by_path.quantile(0.5),
+            "p99_ms": by_path.quantile(0.99),
+        }
+    ).fillna(0)
+    summary.loc["(all)"] = [
+        len(latencies),
+        (latencies["Status"] != 200).sum(),
+        latencies["Milliseconds"].quantile(0.5),
+        latencies["Milliseconds"].quantile(0.99),
+    ]
+    print(summary)
+    print("Throughput: " + str(round(len(latencies) / elapsed, 1)) + " requests/s")
+
+    return summary
+
+
+def main():
+    """
+    Load test a running results service
+    """
+
+    parser = argparse.ArgumentParser(description="Load test the results service")
+    parser.add_argument("--host", default=server.HOST)
+    parser.add_argument("--port", type=int, default=server.PORT)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=100, help="requests per client")
+    parser.add_argument("paths", nargs="*", default=DEFAULT_PATHS)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    latencies = asyncio.run(
+        run_load_test(args.host, args.port, args.paths, args.concurrency, args.requests)
+    )
+    summarize(latencies, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
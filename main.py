@@ -10,12 +10,42 @@ import pandas as pd
 import geopandas as gpd
 import numpy as np
 
+import concurrent.futures
+
 import data_manager
 import data_processing
 import analysis
 import visualization
+import query
+import validation
+import lag_analysis
+import projections
+import snapshots
+import export
+import cube
 
 DAILY_TRENDS_ENABLED = False
+SAVE_QUERY_RESULTS = False
+CONCURRENT_PIPELINES = True
+VALIDATION_ENABLED = True
+LAG_CORRELATION_ENABLED = False
+PROJECTIONS_ENABLED = False
+ANIMATIONS_ENABLED = False
+COUNTY_TIER_ENABLED = False
+SCHEDULED_REFRESH = False
+SNAPSHOTS_ENABLED = False
+EXPORT_RESULTS = False
+PUBLISH_CUBES = False
+REGION_DATASETS = {
+    "world": analysis.WORLD_DATASETS,
+    "us": analysis.US_DATASETS,
+    "us_county": analysis.US_COUNTY_DATASETS,
+}
+REGION_PIPELINES = {
+    "world": analysis.run_world_pipeline,
+    "us": analysis.run_us_pipeline,
+    "us_county": analysis.run_us_county_pipeline,
+}
 
 
 def plot_daily_trends(world_results, us_results):
@@ -23,9 +53,14 @@ def plot_daily_trends(world_results, us_results):
     Graph daily new cases, vaccinations, and death rates of age and ethnic groups in the US for all jurisdictions
     """
 
-    # Filters for common trends and ethnicity/age-based trends in US data
-    us_stats_ethn = [stat for stat in analysis.US_STATS if ("Death" in stat)]
-    us_stats_ages = [stat for stat in analysis.US_STATS if ("year" in stat)]
+    plot_world_daily_trends(world_results)
+    plot_us_daily_trends(us_results)
+
+
+def plot_world_daily_trends(world_results):
+    """
+    Graph daily new cases and vaccinations for all countries
+    """
 
     # Graph daily new cases per capita over time for every country (multiple countries / plot)
     visualization.plot_multi_line_graph(
@@ -43,6 +78,16 @@ def plot_daily_trends(world_results, us_results):
         visualization.WORLD_EXT,
     )
 
+
+def plot_us_daily_trends(us_results):
+    """
+    Graph daily new cases, vaccinations, and death rates of age and ethnic groups for all US states
+    """
+
+    # Filters for common trends and ethnicity/age-based trends in US data
+    us_stats_ethn = [stat for stat in analysis.US_STATS if ("Death" in stat)]
+    us_stats_ages = [stat for stat in analysis.US_STATS if ("year" in stat)]
+
     # Graph daily new cases per capita over time for every US state (multiple states / plot)
     visualization.plot_multi_line_graph(
         us_results.pivot_table(
@@ -84,9 +129,14 @@ def map_avg_trends(world_results_by_country, us_results_by_state, world_basemap,
     ethnic groups in the US across time for all jurisdictions
     """
 
-    # Filters for common trends and ethnicity/age-based trends in US data
-    us_stats_ethn = [stat for stat in analysis.US_STATS if ("Death" in stat)]
-    us_stats_ages = [stat for stat in analysis.US_STATS if ("year" in stat)]
+    map_world_avg_trends(world_results_by_country, world_basemap)
+    map_us_avg_trends(us_results_by_state, us_basemap)
+
+
+def map_world_avg_trends(world_results_by_country, world_basemap):
+    """
+    Map average daily new cases and vaccinations across time for all countries
+    """
 
     # Map average daily COVID-19 new cases per capita by country
     visualization.plot_map(
@@ -110,6 +160,17 @@ def map_avg_trends(world_results_by_country, us_results_by_state, world_basemap,
         vmax=0.0005,
     )
 
+
+def map_us_avg_trends(us_results_by_state, us_basemap):
+    """
+    Map average daily new cases, vaccinations, and death rates of age and
+    ethnic groups across time for all US states
+    """
+
+    # Filters for common trends and ethnicity/age-based trends in US data
+    us_stats_ethn = [stat for stat in analysis.US_STATS if ("Death" in stat)]
+    us_stats_ages = [stat for stat in analysis.US_STATS if ("year" in stat)]
+
     # Map average daily COVID-19 new cases per capita by state
     visualization.plot_map(
         us_results_by_state,
@@ -157,19 +218,47 @@ def map_avg_trends(world_results_by_country, us_results_by_state, world_basemap,
         )
 
 
+def map_us_county_avg_trends(us_county_results_by_county, us_county_basemap):
+    """
+    Map average daily new cases and vaccinations across time for all US counties
+    """
+
+    # Map average daily COVID-19 new cases per capita by county
+    visualization.plot_map(
+        us_county_results_by_county,
+        "new_case",
+        "avg_daily_new_cases_per_capita_by_county",
+        visualization.US_EXT,
+        "Reds",
+        xlim=[-180, -50],
+        basemap=us_county_basemap,
+    )
+
+    # Map average daily COVID-19 vaccinations per capita by county
+    visualization.plot_map(
+        us_county_results_by_county,
+        "daily_vaccinations",
+        "avg_daily_vaccinations_per_capita_by_county",
+        visualization.US_EXT,
+        "Blues",
+        xlim=[-180, -50],
+        basemap=us_county_basemap,
+    )
+
+
 def plot_avg_trends(avg_world_results, avg_us_results):
     """
     Graph average daily new cases, vaccinations, and death rates of age and ethnic groups in the US across jurisdictions
     """
 
-    # Filters for common trends and ethnicity/age-based trends in US data
-    us_stats_common = [
-        stat
-        for stat in analysis.US_STATS
-        if (("Death" not in stat) and ("year" not in stat))
-    ]
-    us_stats_ethn = [stat for stat in analysis.US_STATS if ("Death" in stat)]
-    us_stats_ages = [stat for stat in analysis.US_STATS if ("year" in stat)]
+    plot_world_avg_trends(avg_world_results)
+    plot_us_avg_trends(avg_us_results)
+
+
+def plot_world_avg_trends(avg_world_results):
+    """
+    Graph average daily new cases and vaccinations across countries
+    """
 
     # Graph average new daily COVID-19 cases and vaccinations per capita for the world over time
     visualization.plot_line_graph(
@@ -179,6 +268,21 @@ def plot_avg_trends(avg_world_results, avg_us_results):
         visualization.WORLD_EXT,
     )
 
+
+def plot_us_avg_trends(avg_us_results):
+    """
+    Graph average daily new cases, vaccinations, and death rates of age and ethnic groups across US states
+    """
+
+    # Filters for common trends and ethnicity/age-based trends in US data
+    us_stats_common = [
+        stat
+        for stat in analysis.US_STATS
+        if (("Death" not in stat) and ("year" not in stat))
+    ]
+    us_stats_ethn = [stat for stat in analysis.US_STATS if ("Death" in stat)]
+    us_stats_ages = [stat for stat in analysis.US_STATS if ("year" in stat)]
+
     # Graph average new daily COVID-19 cases and vaccinations per capita for the US over time
     visualization.plot_line_graph(
         avg_us_results,
@@ -212,39 +316,355 @@ def plot_avg_trends(avg_world_results, avg_us_results):
     )
 
 
-def main():
+def render_world_results(world_results, world_basemap):
     """
-    Download, process, and analyze COVID-19 data, before graphing all trends
+    Graph and map all world trends
     """
 
-    # Download & retrieve COVID-19 data
-    datasets = data_manager.get_dataset_info()
-    data_manager.update_datasets(datasets)
-    data = data_manager.retrieve_datasets(datasets)
+    if (DAILY_TRENDS_ENABLED):
+        plot_world_daily_trends(world_results[0])
+
+    map_world_avg_trends(world_results[1], world_basemap)
+    plot_world_avg_trends(world_results[2])
+
+    # Animate daily new cases and vaccinations per capita by country
+    if (ANIMATIONS_ENABLED):
+        for stat, cmap in [("new_cases", "Reds"), ("daily_vaccinations", "Blues")]:
+            visualization.plot_map_animation(
+                world_results[0],
+                stat,
+                "daily_" + stat + "_per_capita_by_country",
+                visualization.WORLD_EXT,
+                cmap,
+                "iso_code",
+                "date",
+                basemap=world_basemap,
+            )
+
+    # Correlate vaccinations with later new cases by country
+    if (LAG_CORRELATION_ENABLED):
+        world_correlation, world_summary = lag_analysis.analyze_world_lagged_correlation(
+            world_results
+        )
+        print(world_summary)
+        visualization.plot_heatmap(
+            world_correlation,
+            "vaccinations_new_cases_lagged_correlation_by_country",
+            visualization.WORLD_EXT,
+        )
 
-    # Process & analyze world data
-    world_c_data = data_processing.consolidate_world_data(data)
-    world_pop = data_processing.get_world_pop_data(data)
-    world_results = analysis.analyze_world_data(world_c_data, world_pop)
+    # Project when each country reaches the vaccination target
+    if (PROJECTIONS_ENABLED):
+        world_projections = projections.project_world_trends(world_results)
+        print(world_projections.drop(columns="geometry"))
+        visualization.plot_map(
+            world_projections,
+            "days_to_target",
+            "projected_days_to_vaccination_target_by_country",
+            visualization.WORLD_EXT,
+            "Blues_r",
+            basemap=world_basemap,
+        )
 
-    # Process & analyze US data
-    us_c_data = data_processing.consolidate_us_data(data)
-    us_pop = data_processing.get_us_pop_data(data)
-    us_results = analysis.analyze_us_data(us_c_data, us_pop)
 
-    # Graph all trends (set DAILY_TRENDS_ENABLED = True for
-    # detailed jurisdiction-by-jurisdiction data)
+def render_us_results(us_results, us_basemap):
+    """
+    Graph and map all US trends
+    """
 
     if (DAILY_TRENDS_ENABLED):
-        plot_daily_trends(world_results[0], us_results[0])
+        plot_us_daily_trends(us_results[0])
+
+    map_us_avg_trends(us_results[1], us_basemap)
+    plot_us_avg_trends(us_results[2])
+
+    # Animate daily new cases and vaccinations per capita by state
+    if (ANIMATIONS_ENABLED):
+        for stat, cmap in [("new_case", "Reds"), ("daily_vaccinations", "Blues")]:
+            visualization.plot_map_animation(
+                us_results[0],
+                stat,
+                "daily_" + stat + "_per_capita_by_state",
+                visualization.US_EXT,
+                cmap,
+                "state",
+                "submission_date",
+                xlim=[-180, -50],
+                basemap=us_basemap,
+            )
+
+    # Correlate vaccinations with later new cases by state
+    if (LAG_CORRELATION_ENABLED):
+        us_correlation, us_summary = lag_analysis.analyze_us_lagged_correlation(us_results)
+        print(us_summary)
+        visualization.plot_heatmap(
+            us_correlation,
+            "vaccinations_new_cases_lagged_correlation_by_state",
+            visualization.US_EXT,
+        )
+
+    # Project when each state reaches the vaccination target
+    if (PROJECTIONS_ENABLED):
+        us_projections = projections.project_us_trends(us_results)
+        print(us_projections.drop(columns="geometry"))
+        visualization.plot_map(
+            us_projections,
+            "days_to_target",
+            "projected_days_to_vaccination_target_by_state",
+            visualization.US_EXT,
+            "Blues_r",
+            xlim=[-180, -50],
+            basemap=us_basemap,
+        )
+
+
+def render_us_county_results(us_county_results, us_county_basemap):
+    """
+    Map all US county trends
+    """
+
+    map_us_county_avg_trends(us_county_results[1], us_county_basemap)
+
+
+def get_regions():
+    """
+    Return the regions to process, leaving out the county tier unless it is enabled
+    """
+
+    return [
+        region
+        for region in REGION_PIPELINES
+        if (COUNTY_TIER_ENABLED or region != "us_county")
+    ]
+
+
+def run_region_pipeline(region):
+    """
+    Retrieve, consolidate, and analyze the datasets of one region in a worker
+    process, returning its results without geometry so only numbers are sent back
+    (and publishing its stat cube when PUBLISH_CUBES)
+    """
 
-    map_avg_trends(
-        world_results[1],
-        us_results[1],
-        data["world_countries_map"],
-        data["us_states_map"],
+    datasets = data_manager.get_dataset_info()
+    data = data_manager.retrieve_datasets(
+        datasets[datasets["Alias"].isin(REGION_DATASETS[region])]
+    )
+    if (VALIDATION_ENABLED):
+        validation.validate_datasets(data)
+    results = REGION_PIPELINES[region](data)
+    if (PUBLISH_CUBES):
+        cube.publish_cube(region, results[0])
+
+    return tuple(result.drop(columns="geometry", errors="ignore") for result in results)
+
+
+def attach_geometry(results, basemap, data_locations_col, geodata_locations_col):
+    """
+    Add each jurisdiction's geometry from the basemap back onto results returned
+    by run_region_pipeline
+    """
+
+    geometry = basemap.drop_duplicates(geodata_locations_col).set_index(
+        geodata_locations_col
+    )["geometry"]
+
+    daily_results, results_by_jurisdiction, results_by_day = results
+    daily_results["geometry"] = daily_results[data_locations_col].map(geometry)
+    results_by_jurisdiction["geometry"] = geometry.reindex(
+        results_by_jurisdiction.index.get_level_values(data_locations_col)
+    ).values
+
+    return daily_results, results_by_jurisdiction, results_by_day
+
+
+def run_concurrent_pipelines(datasets):
+    """
+    Run the world and US pipelines in separate worker processes, graphing each
+    region's trends (and exporting its results when EXPORT_RESULTS) as soon as they
+    arrive, and return both regions' results (running the US county tier alongside
+    them when COUNTY_TIER_ENABLED)
+    """
+
+    # Basemaps are read here instead of being sent back from the workers
+    regions = get_regions()
+    basemaps = data_manager.retrieve_datasets(
+        datasets[
+            datasets["Alias"].isin(
+                ["world_countries_map", "us_states_map"]
+                + (["us_counties_map"] if "us_county" in regions else [])
+            )
+        ]
     )
-    plot_avg_trends(world_results[2], us_results[2])
+    if "us_county" in regions:
+        basemaps["us_counties_map"] = data_processing.get_county_map(basemaps)
+
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(regions)) as pool:
+        futures = {
+            pool.submit(run_region_pipeline, region): region for region in regions
+        }
+
+        for future in concurrent.futures.as_completed(futures):
+            region = futures[future]
+
+            if region == "world":
+                # Read once the world worker has cached its spatial map matches
+                basemaps["world_countries_map"] = data_processing.get_world_map(basemaps)
+                results[region] = attach_geometry(
+                    future.result(), basemaps["world_countries_map"], "iso_code", "ISO"
+                )
+                render_world_results(results[region], basemaps["world_countries_map"])
+            elif region == "us_county":
+                results[region] = attach_geometry(
+                    future.result(), basemaps["us_counties_map"], "fips", "FIPS"
+                )
+                render_us_county_results(results[region], basemaps["us_counties_map"])
+            else:
+                results[region] = attach_geometry(
+                    future.result(), basemaps["us_states_map"], "state", "STATE"
+                )
+                render_us_results(results[region], basemaps["us_states_map"])
+
+            if (EXPORT_RESULTS):
+                export.export_region(region, results[region])
+
+    return results["world"], results["us"]
+
+
+def render_region(region, results, data):
+    """
+    Graph and map all trends of one region from its results and raw datasets
+    """
+
+    if region == "world":
+        render_world_results(results, data["world_countries_map"])
+    elif region == "us_county":
+        render_us_county_results(results, data_processing.get_county_map(data))
+    else:
+        render_us_results(results, data["us_states_map"])
+
+
+def refresh_regions(datasets, aliases, results):
+    """
+    Reprocess and re-render only the regions whose datasets were just updated, keeping
+    each region's latest results in results. When SAVE_QUERY_RESULTS, also saves the
+    new results and rebuilds the query caches of the updated datasets so later
+    interactive runs start warm
+    """
+
+    # Keep the new versions for later comparisons
+    if (SNAPSHOTS_ENABLED):
+        snapshots.take_snapshots(datasets, aliases)
+
+    for region in get_regions():
+        if not set(REGION_DATASETS[region]) & set(aliases):
+            continue
+
+        print("Refreshing " + region + " results...")
+        data = data_manager.retrieve_datasets(
+            datasets[datasets["Alias"].isin(REGION_DATASETS[region])]
+        )
+        if (VALIDATION_ENABLED):
+            validation.validate_datasets(data)
+
+        results[region] = REGION_PIPELINES[region](data)
+        render_region(region, results[region], data)
+        if (PUBLISH_CUBES):
+            cube.publish_cube(region, results[region][0])
+        if (EXPORT_RESULTS):
+            export.export_region(region, results[region])
+
+    if (SAVE_QUERY_RESULTS):
+        query.save_results(results["world"], results["us"])
+
+        try:
+            con = query.connect()
+        except ImportError as e:
+            print("Skipping query caches: " + str(e))
+        else:
+            try:
+                query.register_datasets(con, datasets[datasets["Alias"].isin(aliases)])
+            finally:
+                con.close()
+
+
+def main():
+    """
+    Download, process, and analyze COVID-19 data, before graphing all trends
+    """
+
+    # Download & retrieve COVID-19 data, skipping county datasets unless the
+    # county tier is enabled
+    datasets = data_manager.get_dataset_info()
+    if not (COUNTY_TIER_ENABLED):
+        datasets = datasets[~datasets["Alias"].isin(analysis.US_COUNTY_DATASETS)]
+    updated = data_manager.update_datasets(datasets)
+
+    # Keep every new dataset version for later comparisons (set SNAPSHOTS_ENABLED = True,
+    # then use snapshots.diff_snapshots)
+    if (SNAPSHOTS_ENABLED):
+        snapshots.take_snapshots(datasets, updated)
+
+    # Process, analyze, and graph world and US data side by side, graphing all
+    # trends (set DAILY_TRENDS_ENABLED = True for detailed jurisdiction-by-jurisdiction data)
+    if (CONCURRENT_PIPELINES):
+        world_results, us_results = run_concurrent_pipelines(datasets)
+
+    else:
+        data = data_manager.retrieve_datasets(datasets)
+
+        # Fail fast on bad upstream data
+        if (VALIDATION_ENABLED):
+            validation.validate_datasets(data)
+
+        # Process & analyze world data
+        world_c_data = data_processing.consolidate_world_data(data)
+        world_pop = data_processing.get_world_pop_data(data)
+        world_results = analysis.analyze_world_data(world_c_data, world_pop)
+
+        # Process & analyze US data
+        us_c_data = data_processing.consolidate_us_data(data)
+        us_pop = data_processing.get_us_pop_data(data)
+        us_results = analysis.analyze_us_data(us_c_data, us_pop)
+
+        # Graph all trends
+        render_world_results(world_results, data["world_countries_map"])
+        render_us_results(us_results, data["us_states_map"])
+
+        # Process, analyze, and map US county data (set COUNTY_TIER_ENABLED = True)
+        if (COUNTY_TIER_ENABLED):
+            us_county_results = analysis.run_us_county_pipeline(data)
+            render_us_county_results(
+                us_county_results, data_processing.get_county_map(data)
+            )
+
+        # Export results as partitioned Parquet for downstream jobs (set
+        # EXPORT_RESULTS = True, then use export.read_export)
+        if (EXPORT_RESULTS):
+            export.export_results({"world": world_results, "us": us_results})
+            if (COUNTY_TIER_ENABLED):
+                export.export_region("us_county", us_county_results)
+
+        # Publish stat cubes that other processes attach to without copying (set
+        # PUBLISH_CUBES = True, then use cube.attach_cube)
+        if (PUBLISH_CUBES):
+            cube.publish_results({"world": world_results, "us": us_results})
+            if (COUNTY_TIER_ENABLED):
+                cube.publish_cube("us_county", us_county_results[0])
+
+    # Save results for ad-hoc SQL queries (set SAVE_QUERY_RESULTS = True, then
+    # run query.py)
+    if (SAVE_QUERY_RESULTS):
+        query.save_results(world_results, us_results)
+
+    # Keep refreshing each dataset on its Update_Interval, reprocessing and
+    # re-rendering only the regions with new data (set SCHEDULED_REFRESH = True)
+    if (SCHEDULED_REFRESH):
+        results = {"world": world_results, "us": us_results}
+        data_manager.run_scheduler(
+            datasets,
+            on_update=lambda aliases: refresh_regions(datasets, aliases, results),
+        )
 
 
 if __name__ == "__main__":
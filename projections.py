@@ -0,0 +1,198 @@
+"""
+Daniel Rashevsky
+CSE 163 AE
+This file fits recent per capita vaccination and case trends for every country and US
+state at once, projecting when each will reach a target level of vaccination
+"""
+
+import pandas as pd
+import numpy as np
+
+import data_manager
+import analysis
+import visualization
+import lag_analysis
+
+VACCINATION_TARGET_SHARE = 0.7
+DOSES_PER_PERSON = 2
+TREND_WINDOW_DAYS = 28
+TREND_MIN_DAYS = 7
+MAX_PROJECTION_DAYS = 3650
+
+
+def fit_trends(matrix):
+    """
+    Given a date x jurisdiction matrix, return the least-squares slope (per day) and
+    the fitted value on the last day for every jurisdiction in one batched fit,
+    ignoring missing days. Jurisdictions with fewer than TREND_MIN_DAYS known days
+    get no fit
+    """
+
+    y = matrix.to_numpy(dtype=float)
+    known = ~np.isnan(y)
+    y = np.where(known, y, 0.0)
+
+    # Days relative to the last day, so the intercept is the fitted last value
+    t = (np.arange(len(y)) - (len(y) - 1))[:, None] * known
+
+    n = known.sum(axis=0)
+    sum_t = t.sum(axis=0)
+    sum_y = y.sum(axis=0)
+    sum_tt = (t * t).sum(axis=0)
+    sum_ty = (t * y).sum(axis=0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        slope = (n * sum_ty - sum_t * sum_y) / (n * sum_tt - sum_t ** 2)
+        last_value = (sum_y - slope * sum_t) / n
+
+    slope[n < TREND_MIN_DAYS] = np.nan
+    last_value[n < TREND_MIN_DAYS] = np.nan
+
+    return (
+        pd.Series(slope, index=matrix.columns),
+        pd.Series(last_value, index=matrix.columns),
+    )
+
+
+def project_trends(daily_results, jurisdiction_col, date_col, cases_stat):
+    """
+    Return, for every jurisdiction, cumulative vaccinations per capita, the recent
+    daily vaccination rate, the days and date until VACCINATION_TARGET_SHARE of the
+    population is fully vaccinated (counted as DOSES_PER_PERSON doses each), and the
+    recent trend slope of new cases per capita
+    """
+
+    target = VACCINATION_TARGET_SHARE * DOSES_PER_PERSON
+
+    vaccinations = lag_analysis.get_jurisdiction_matrix(
+        daily_results, jurisdiction_col, date_col, lag_analysis.VACCINATIONS_STAT
+    )
+    cases = lag_analysis.get_jurisdiction_matrix(
+        daily_results, jurisdiction_col, date_col, cases_stat
+    ).reindex(index=vaccinations.index, columns=vaccinations.columns)
+
+    # Cumulative vaccinations per capita, counting unreported days as none
+    vaccinated = vaccinations.fillna(0).cumsum()
+    window = vaccinated.iloc[-TREND_WINDOW_DAYS:].where(
+        vaccinations.iloc[-TREND_WINDOW_DAYS:].notna()
+    )
+    vaccination_rate, fitted_vaccinated = fit_trends(window)
+    case_slope, fitted_cases = fit_trends(cases.iloc[-TREND_WINDOW_DAYS:])
+
+    # Days until the target, or 0 for jurisdictions that have already reached it,
+    # leaving out projections too far ahead to be meaningful
+    last_date = vaccinated.index[-1]
+    current = vaccinated.iloc[-1]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        days_to_target = ((target - fitted_vaccinated) / vaccination_rate).where(
+            vaccination_rate > 0
+        )
+    days_to_target = days_to_target.clip(lower=0).where(current < target, 0)
+    days_to_target = days_to_target.where(days_to_target <= MAX_PROJECTION_DAYS)
+
+    projections = pd.DataFrame(
+        {
+            "vaccinated_per_capita": current,
+            "vaccination_rate": vaccination_rate,
+            "days_to_target": days_to_target,
+            "projected_target_date": last_date
+            + pd.to_timedelta(np.ceil(days_to_target), unit="D"),
+            "case_trend_slope": case_slope,
+        }
+    )
+    projections.index.name = jurisdiction_col
+
+    return projections
+
+
+def project_world_trends(world_results):
+    """
+    Return vaccination and case trend projections for every country, with geometry
+    """
+
+    print("Projecting world vaccination and case trends...")
+
+    projections = project_trends(world_results[0], "iso_code", "date", "new_cases")
+    geometry = world_results[1]["geometry"].droplevel("location")
+
+    return projections.join(geometry[~geometry.index.duplicated()])
+
+
+def project_us_trends(us_results):
+    """
+    Return vaccination and case trend projections for every US state, with geometry
+    """
+
+    print("Projecting US vaccination and case trends...")
+
+    projections = project_trends(us_results[0], "state", "submission_date", "new_case")
+
+    return projections.join(us_results[1]["geometry"])
+
+
+def test_fit_trends():
+    """
+    Test the batched fit against numpy's polyfit for every column
+    """
+
+    rng = np.random.default_rng(0)
+    matrix = pd.DataFrame(
+        np.arange(30)[:, None] * [0.5, -2.0, 0.0] + rng.normal(0, 1, (30, 3)),
+        columns=["A", "B", "C"],
+    )
+    matrix.iloc[5:9, 0] = np.nan
+    matrix.iloc[:26, 2] = np.nan
+
+    slope, last_value = fit_trends(matrix)
+
+    for column in ["A", "B"]:
+        known = matrix[column].notna()
+        expected = np.polyfit(np.arange(30)[known], matrix.loc[known, column], 1)
+        assert np.isclose(slope[column], expected[0])
+        assert np.isclose(last_value[column], np.polyval(expected, 29))
+
+    # Too few known days for a fit
+    assert np.isnan(slope["C"])
+
+    print("Trend fitting test passed")
+
+
+def main():
+    """
+    Test all methods in projections
+    """
+
+    test_fit_trends()
+
+    datasets = data_manager.get_dataset_info()
+    data_manager.update_datasets(datasets)
+    data = data_manager.retrieve_datasets(datasets)
+
+    # Test world projections and map
+    world_projections = project_world_trends(analysis.run_world_pipeline(data))
+    print(world_projections)
+    visualization.plot_map(
+        world_projections,
+        "days_to_target",
+        "projected_days_to_vaccination_target_by_country",
+        visualization.WORLD_EXT,
+        "Blues_r",
+        basemap=data["world_countries_map"],
+    )
+
+    # Test US projections and map
+    us_projections = project_us_trends(analysis.run_us_pipeline(data))
+    print(us_projections)
+    visualization.plot_map(
+        us_projections,
+        "days_to_target",
+        "projected_days_to_vaccination_target_by_state",
+        visualization.US_EXT,
+        "Blues_r",
+        xlim=[-180, -50],
+        basemap=data["us_states_map"],
+    )
+
+
+if __name__ == "__main__":
+    main()
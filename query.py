@@ -0,0 +1,266 @@
+"""
+Daniel Rashevsky
+CSE 163 AE
+This file provides an embedded SQL query layer over the cached raw datasets and the
+analysis results, so ad-hoc questions can be answered without rerunning the pipeline
+"""
+
+import pandas as pd
+import numpy as np
+
+import argparse
+import tempfile
+import os
+
+import data_manager
+
+QUERY_CACHE_DIR = "query_cache"
+RESULTS_DIR = "results"
+RESULT_TABLES = {
+    "world": ["world_daily", "world_by_country", "world_by_day"],
+    "us": ["us_daily", "us_by_state", "us_by_day"],
+}
+
+
+def connect():
+    """
+    Return a new in-memory DuckDB connection, so every query session has its own
+    views and no session waits on another's database file lock
+    """
+
+    try:
+        import duckdb
+    except ImportError:
+        raise ImportError("The SQL query layer requires the duckdb package")
+
+    return duckdb.connect(":memory:")
+
+
+def quote_literal(text):
+    """
+    Return text as a quoted SQL string literal
+    """
+
+    return "'" + text.replace("'", "''") + "'"
+
+
+def quote_identifier(text):
+    """
+    Return text as a quoted SQL identifier
+    """
+
+    return '"' + text.replace('"', '""') + '"'
+
+
+def register_datasets(con, metadata_frame):
+    """
+    Create a view for every downloaded CSV dataset, backed by a Parquet copy that is
+    rebuilt whenever the dataset is updated, so queries only scan the columns and
+    row groups they need
+    """
+
+    if not os.path.isdir(QUERY_CACHE_DIR):
+        os.mkdir(QUERY_CACHE_DIR)
+
+    for i, row in metadata_frame[~metadata_frame["Is_ShapeFile"]].iterrows():
+        alias = row["Alias"]
+        path = data_manager.find_dataset_file(metadata_frame.loc[i])
+        if path is None:
+            continue
+
+        # Convert the CSV to Parquet inside DuckDB, without loading it into pandas,
+        # and swap it in whole so other sessions never read a partial file
+        parquet_path = QUERY_CACHE_DIR + "/" + alias + ".parquet"
+        if not os.path.exists(parquet_path) or os.path.getmtime(
+            parquet_path
+        ) < os.path.getmtime(path):
+            print("Caching " + alias + " for queries...")
+            fd, tmp_path = tempfile.mkstemp(dir=QUERY_CACHE_DIR, suffix=".tmp")
+            os.close(fd)
+            try:
+                con.execute(
+                    "COPY (SELECT * FROM read_csv_auto(?, encoding = ?)) TO "
+                    + quote_literal(tmp_path)
+                    + " (FORMAT PARQUET, COMPRESSION ZSTD)",
+                    [path, data_manager.get_dataset_encoding(row) or "utf-8"],
+                )
+                os.replace(tmp_path, parquet_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+        create_view(con, alias, parquet_path)
+
+
+def register_results(con):
+    """
+    Create a view for every analysis result saved by save_results
+    """
+
+    for tables in RESULT_TABLES.values():
+        for table in tables:
+            parquet_path = RESULTS_DIR + "/" + table + ".parquet"
+            if os.path.exists(parquet_path):
+                create_view(con, table, parquet_path)
+
+
+def create_view(con, name, parquet_path):
+    """
+    Create or replace a view over a Parquet file. Views cannot take bound parameters,
+    so the name and path are quoted instead
+    """
+
+    con.execute(
+        "CREATE OR REPLACE VIEW "
+        + quote_identifier(name)
+        + " AS SELECT * FROM read_parquet("
+        + quote_literal(parquet_path)
+        + ")"
+    )
+
+
+def save_results(world_results, us_results):
+    """
+    Save the results of analyze_world_data and analyze_us_data as Parquet files for
+    the query layer, leaving out geometry
+    """
+
+    if not os.path.isdir(RESULTS_DIR):
+        os.mkdir(RESULTS_DIR)
+
+    for region, results in [("world", world_results), ("us", us_results)]:
+        for table, result in zip(RESULT_TABLES[region], results):
+
+            # Per-row results have a meaningless index, aggregates are keyed by it
+            if table.endswith("_daily"):
+                result = result.reset_index(drop=True)
+            else:
+                result = result.reset_index()
+
+            result = result.drop(columns="geometry", errors="ignore")
+            result.to_parquet(RESULTS_DIR + "/" + table + ".parquet", index=False)
+
+
+def query(sql, params=None, metadata_frame=None):
+    """
+    Run a SQL query over the cached datasets and analysis results, returning only
+    the query's result as a dataframe
+    """
+
+    if metadata_frame is None:
+        metadata_frame = data_manager.get_dataset_info()
+
+    con = connect()
+    try:
+        register_datasets(con, metadata_frame)
+        register_results(con)
+        return con.execute(sql, params or []).df()
+    finally:
+        con.close()
+
+
+def list_tables():
+    """
+    Return the names of all queryable tables
+    """
+
+    return query(
+        "SELECT view_name FROM duckdb_views() WHERE NOT internal ORDER BY view_name"
+    )["view_name"].tolist()
+
+
+def test_query_layer():
+    """
+    Test saving analysis results and querying them with filters and projections
+    """
+
+    global RESULTS_DIR
+
+    previous_settings = RESULTS_DIR
+    RESULTS_DIR = "test_results"
+
+    # Build small world and US results shaped like the analysis output
+    dates = pd.date_range("2021-01-01", periods=40)
+    us_daily = pd.DataFrame(
+        {
+            "state": np.repeat(["WA", "OR"], len(dates)),
+            "submission_date": np.tile(dates, 2),
+            "new_case": np.arange(2 * len(dates)) / 1e5,
+            "daily_vaccinations": np.arange(2 * len(dates)) / 1e4,
+        }
+    )
+    us_results = (
+        us_daily,
+        us_daily.groupby("state")[["new_case", "daily_vaccinations"]].mean(),
+        us_daily.groupby("submission_date")[["new_case", "daily_vaccinations"]].mean(),
+    )
+    world_daily = us_daily.rename(
+        columns={"state": "location", "submission_date": "date", "new_case": "new_cases"}
+    )
+    world_results = (
+        world_daily,
+        world_daily.groupby("location")[["new_cases", "daily_vaccinations"]].mean(),
+        world_daily.groupby("date")[["new_cases", "daily_vaccinations"]].mean(),
+    )
+
+    try:
+        save_results(world_results, us_results)
+        empty_metadata = data_manager.get_dataset_info().iloc[0:0]
+
+        # Vaccination rate for one state over the last 30 days
+        result = query(
+            "SELECT submission_date, daily_vaccinations FROM us_daily "
+            "WHERE state = ? AND submission_date > "
+            "(SELECT max(submission_date) FROM us_daily) - INTERVAL 30 DAY "
+            "ORDER BY submission_date",
+            ["WA"],
+            empty_metadata,
+        )
+        assert len(result) == 30
+        assert list(result.columns) == ["submission_date", "daily_vaccinations"]
+        assert result["daily_vaccinations"].iloc[-1] == us_daily["daily_vaccinations"].iloc[39]
+
+        # Aggregates keep their index as a column
+        result = query("SELECT * FROM us_by_state ORDER BY state", None, empty_metadata)
+        assert list(result["state"]) == ["OR", "WA"]
+    finally:
+        for table in RESULT_TABLES["world"] + RESULT_TABLES["us"]:
+            if os.path.exists(RESULTS_DIR + "/" + table + ".parquet"):
+                os.remove(RESULTS_DIR + "/" + table + ".parquet")
+        if os.path.isdir(RESULTS_DIR):
+            os.rmdir(RESULTS_DIR)
+        RESULTS_DIR = previous_settings
+
+    print("Query layer test passed")
+
+
+def main():
+    """
+    Run a SQL query given on the command line and print its result
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Query the cached COVID-19 datasets and analysis results with SQL"
+    )
+    parser.add_argument("sql", nargs="?", help="SQL query to run")
+    parser.add_argument(
+        "--tables", action="store_true", help="list the tables that can be queried"
+    )
+    parser.add_argument(
+        "--test", action="store_true", help="test all methods in query"
+    )
+    args = parser.parse_args()
+
+    if args.test:
+        test_query_layer()
+    elif args.tables:
+        print("\n".join(list_tables()))
+    elif args.sql is not None:
+        with pd.option_context("display.max_rows", None, "display.width", None):
+            print(query(args.sql))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+"""
+Daniel Rashevsky
+CSE 163 AE
+This file runs a long-running local HTTP service that keeps the analyzed world and US
+results warm in memory, serving per capita stats as JSON and charts rendered on demand
+"""
+
+import pandas as pd
+import numpy as np
+
+import concurrent.futures
+import collections
+import urllib.parse
+import argparse
+import threading
+import asyncio
+import json
+import os
+
+import data_manager
+import analysis
+import visualization
+
+HOST = "127.0.0.1"
+PORT = 8163
+RELOAD_CHECK_INTERVAL = 60
+CHART_CACHE_SIZE = 64
+REGIONS = {
+    "world": {
+        "datasets": analysis.WORLD_DATASETS,
+        "pipeline": analysis.run_world_pipeline,
+        "stats": analysis.WORLD_STATS,
+        "jurisdiction_col": "iso_code",
+        "date_col": "date",
+        "basemap": "world_countries_map",
+        "extension": visualization.WORLD_EXT,
+        "xlim": None,
+    },
+    "us": {
+        "datasets": analysis.US_DATASETS,
+        "pipeline": analysis.run_us_pipeline,
+        "stats": analysis.US_STATS,
+        "jurisdiction_col": "state",
+        "date_col": "submission_date",
+        "basemap": "us_states_map",
+        "extension": visualization.US_EXT,
+        "xlim": [-180, -50],
+    },
+}
+STATUS_TEXT = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+}
+
+
+def get_dataset_timestamps(aliases):
+    """
+    Return the last update time of each of the given datasets, as recorded by
+    data_manager.update_datasets
+    """
+
+    if not os.path.exists(data_manager.UPDATE_INFO):
+        return {}
+
+    timestamps = pd.read_csv(data_manager.UPDATE_INFO, index_col=0)
+    timestamps = timestamps[timestamps.index.isin(aliases)]
+
+    return timestamps["TimeStamp"].to_dict()
+
+
+def load_region(region, metadata_frame):
+    """
+    Retrieve, consolidate, and analyze the datasets of one region, returning its warm state
+    """
+
+    config = REGIONS[region]
+    timestamps = get_dataset_timestamps(config["datasets"])
+
+    # Only read the datasets this region's pipeline uses
+    data = data_manager.retrieve_datasets(
+        metadata_frame[metadata_frame["Alias"].isin(config["datasets"])]
+    )
+    results = config["pipeline"](data)
+
+    return {
+        "results": results,
+        "rows": results[0].groupby(config["jurisdiction_col"]).indices,
+        "basemap": data[config["basemap"]],
+        "timestamps": timestamps,
+    }
+
+
+def frame_to_json(frame):
+    """
+    Return a results dataframe as JSON records, leaving out geometry
+    """
+
+    frame = frame.drop(columns="geometry", errors="ignore")
+    return frame.to_json(orient="records", date_format="iso").encode()
+
+
+def render_chart(region, state, kind, stat):
+    """
+    Render a map of a stat's average by jurisdiction or a line graph of its average
+    by day, returning the PNG bytes
+    """
+
+    config = REGIONS[region]
+    name = "served_" + kind + "_" + stat
+
+    if kind == "map":
+        visualization.plot_map(
+            state["results"][1],
+            stat,
+            name,
+            config["extension"],
+            "Blues" if "vaccinations" in stat else "Reds",
+            xlim=config["xlim"],
+            basemap=state["basemap"],
+        )
+        ext = visualization.MAP_EXT
+    else:
+        visualization.plot_line_graph(
+            state["results"][2], [stat], name, config["extension"]
+        )
+        ext = visualization.PLOT_EXT
+
+    path = (
+        visualization.VIZ_PATH + "/" + ext + "_" + config["extension"] + "_" + name + ".png"
+    )
+    with open(path, "rb") as f:
+        return f.read()
+
+
+async def get_chart(server, region, kind, stat):
+    """
+    Return a chart's PNG bytes from the LRU chart cache, rendering it if needed
+    """
+
+    state = server["state"][region]
+    key = (region, kind, stat, state["version"])
+    cache = server["charts"]
+
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+
+    # Requests for a chart that is already being rendered wait for that render
+    if key in server["rendering"]:
+        return await asyncio.shield(server["rendering"][key])
+
+    # Render off the event loop, one chart at a time since pyplot is not thread safe
+    render = asyncio.get_running_loop().run_in_executor(
+        server["render_pool"], render_chart, region, state, kind, stat
+    )
+    server["rendering"][key] = render
+    try:
+        chart = await render
+    finally:
+        del server["rendering"][key]
+
+    cache[key] = chart
+    while len(cache) > CHART_CACHE_SIZE:
+        cache.popitem(last=False)
+
+    return chart
+
+
+async def route(server, path, params):
+    """
+    Return the status, content type, and body of the response to a GET request
+    """
+
+    parts = [part for part in path.split("/") if part != ""]
+
+    if len(parts) == 0:
+        return 200, "application/json", json.dumps(list(REGIONS)).encode()
+
+    region = parts[0]
+    if region not in REGIONS or region not in server["state"]:
+        return 404, "text/plain", b"Unknown region"
+
+    config = REGIONS[region]
+    state = server["state"][region]
+    results = state["results"]
+
+    # Average per capita stats for every jurisdiction
+    if parts[1:] == ["jurisdictions"]:
+        return 200, "application/json", frame_to_json(results[1].reset_index())
+
+    # Daily per capita stats for one jurisdiction
+    if len(parts) == 3 and parts[1] == "jurisdictions":
+        rows = state["rows"].get(parts[2])
+        if rows is None:
+            return 404, "text/plain", b"Unknown jurisdiction"
+
+        daily = results[0].iloc[rows]
+        columns = [config["date_col"]] + config["stats"]
+        if "stats" in params:
+            columns = [config["date_col"]] + [
+                stat for stat in params["stats"][0].split(",") if stat in config["stats"]
+            ]
+        return 200, "application/json", frame_to_json(daily[columns])
+
+    # Average per capita stats across jurisdictions for every day
+    if parts[1:] == ["days"]:
+        return 200, "application/json", frame_to_json(results[2].reset_index())
+
+    # Charts rendered on demand
+    if len(parts) == 3 and parts[1] in ["map", "plot"] and parts[2].endswith(".png"):
+        stat = parts[2][: -len(".png")]
+        if stat not in config["stats"]:
+            return 404, "text/plain", b"Unknown stat"
+
+        return 200, "image/png", await get_chart(server, region, parts[1], stat)
+
+    return 404, "text/plain", b"Not found"
+
+
+async def handle_connection(server, reader, writer):
+    """
+    Serve HTTP/1.1 GET requests on a connection until the client closes it
+    """
+
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+
+            # Read headers, which are only needed to honor Connection: close
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in [b"\r\n", b"\n", b""]:
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            try:
+                method, target, version = request_line.decode("latin-1").split()
+            except ValueError:
+                status, content_type, body = 400, "text/plain", b"Bad request"
+                method, target, version = "GET", "/", "HTTP/1.0"
+            else:
+                url = urllib.parse.urlsplit(target)
+                if method != "GET":
+                    status, content_type, body = 405, "text/plain", b"Only GET is supported"
+                else:
+                    try:
+                        status, content_type, body = await route(
+                            server,
+                            urllib.parse.unquote(url.path),
+                            urllib.parse.parse_qs(url.query),
+                        )
+                    except Exception as e:
+                        # Answer instead of dropping the connection, and keep serving
+                        print("Error serving " + target + ": " + repr(e))
+                        status, content_type, body = 500, "text/plain", b"Internal error"
+
+            keep_alive = version == "HTTP/1.1" and headers.get("connection") != "close"
+            writer.write(
+                (
+                    "HTTP/1.1 " + str(status) + " " + STATUS_TEXT[status] + "\r\n"
+                    "Content-Type: " + content_type + "\r\n"
+                    "Content-Length: " + str(len(body)) + "\r\n"
+                    "Connection: " + ("keep-alive" if keep_alive else "close") + "\r\n"
+                    "\r\n"
+                ).encode("latin-1")
+                + body
+            )
+            await writer.drain()
+
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def reload_changed_regions(server, metadata_frame):
+    """
+    Periodically reload only the regions whose datasets update_datasets has refreshed.
+    A region that fails to reload keeps serving its previous results, and is retried
+    at the next check
+    """
+
+    loop = asyncio.get_running_loop()
+
+    while True:
+        await asyncio.sleep(RELOAD_CHECK_INTERVAL)
+
+        for region, config in REGIONS.items():
+            if get_dataset_timestamps(config["datasets"]) == server["state"][region]["timestamps"]:
+                continue
+
+            print("Reloading " + region + " results...")
+            try:
+                state = await loop.run_in_executor(
+                    server["reload_pool"], load_region, region, metadata_frame
+                )
+            except Exception as e:
+                print("Reloading " + region + " results failed: " + repr(e))
+                continue
+
+            # Swap in the new results, which also retires their cached charts
+            state["version"] = server["state"][region]["version"] + 1
+            server["state"][region] = state
+
+
+async def serve(host=HOST, port=PORT, update=False, schedule=False):
+    """
+    Load every region's results and serve them until cancelled, optionally keeping
+    their datasets fresh with the update scheduler in a background thread
+    """
+
+    metadata_frame = data_manager.get_dataset_info()
+    if update:
+        data_manager.update_datasets(metadata_frame)
+
+    # New data the scheduler lands is picked up by reload_changed_regions
+    stop_scheduler = threading.Event()
+    if schedule:
+        aliases = [alias for config in REGIONS.values() for alias in config["datasets"]]
+        threading.Thread(
+            target=data_manager.run_scheduler,
+            args=(metadata_frame[metadata_frame["Alias"].isin(aliases)],),
+            kwargs={"stop_event": stop_scheduler},
+            daemon=True,
+        ).start()
+
+    server = {
+        "state": {},
+        "charts": collections.OrderedDict(),
+        "rendering": {},
+        "render_pool": concurrent.futures.ThreadPoolExecutor(max_workers=1),
+        "reload_pool": concurrent.futures.ThreadPoolExecutor(max_workers=1),
+    }
+
+    for region in REGIONS:
+        server["state"][region] = load_region(region, metadata_frame)
+        server["state"][region]["version"] = 0
+
+    http_server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(server, reader, writer), host, port
+    )
+    print("Serving results on http://" + host + ":" + str(port) + "/")
+
+    reloader = asyncio.create_task(reload_changed_regions(server, metadata_frame))
+    try:
+        async with http_server:
+            await http_server.serve_forever()
+    finally:
+        reloader.cancel()
+        stop_scheduler.set()
+
+
+def main():
+    """
+    Start the results service
+    """
+
+    parser = argparse.ArgumentParser(description="Serve COVID-19 analysis results")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument(
+        "--update", action="store_true", help="update stale datasets before loading"
+    )
+    parser.add_argument(
+        "--schedule",
+        action="store_true",
+        help="keep updating datasets on their Update_Interval while serving",
+    )
+    args = parser.parse_args()
+
+    asyncio.run(serve(args.host, args.port, args.update, args.schedule))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,522 @@
+"""
+Daniel Rashevsky
+CSE 163 AE
+This file keeps a dated snapshot of every dataset version, storing each as
+content-defined chunks shared with every other version so a daily snapshot only costs
+the rows upstream revised, and reports which jurisdictions and dates changed between
+any two snapshots
+"""
+
+import pandas as pd
+import numpy as np
+
+import datetime
+import tempfile
+import hashlib
+import json
+import time
+import zlib
+import io
+import os
+
+import data_manager
+
+SNAPSHOT_DIR = "snapshots"
+CHUNK_DIR = "chunks"
+MANIFEST_DIR = "manifests"
+# Chunks end after a line whose CRC-32 is divisible by CHUNK_BOUNDARY_DIVISOR, once
+# they hold CHUNK_MIN_SIZE bytes, so an edited row only changes the chunk around it
+CHUNK_MIN_SIZE = 4096
+CHUNK_MAX_SIZE = 65536
+CHUNK_BOUNDARY_DIVISOR = 32
+CHUNK_COMPRESSION_LEVEL = 6
+
+
+def get_chunks(f):
+    """
+    Split a binary file into chunks of whole lines, cutting at boundaries chosen by
+    the content of each line rather than by position
+    """
+
+    lines = []
+    size = 0
+
+    for line in f:
+        lines.append(line)
+        size += len(line)
+
+        if size >= CHUNK_MAX_SIZE or (
+            size >= CHUNK_MIN_SIZE and zlib.crc32(line) % CHUNK_BOUNDARY_DIVISOR == 0
+        ):
+            yield b"".join(lines)
+            lines = []
+            size = 0
+
+    if len(lines) > 0:
+        yield b"".join(lines)
+
+
+def get_chunk_path(digest):
+    """
+    Return the path of a stored chunk, spread over subdirectories by digest prefix
+    """
+
+    return SNAPSHOT_DIR + "/" + CHUNK_DIR + "/" + digest[:2] + "/" + digest
+
+
+def store_chunk(chunk):
+    """
+    Store a compressed chunk under its digest unless an identical chunk is already
+    stored, returning the digest and the number of bytes newly written
+    """
+
+    digest = hashlib.sha256(chunk).hexdigest()
+    path = get_chunk_path(digest)
+    if os.path.exists(path):
+        return digest, 0
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    compressed = zlib.compress(chunk, CHUNK_COMPRESSION_LEVEL)
+    write_atomic(path, compressed)
+
+    return digest, len(compressed)
+
+
+def read_chunk(digest):
+    """
+    Return the contents of a stored chunk
+    """
+
+    with open(get_chunk_path(digest), "rb") as f:
+        return zlib.decompress(f.read())
+
+
+def write_atomic(path, contents):
+    """
+    Write bytes to a path in one step, so no reader ever sees a partial file
+    """
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(contents)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def get_manifest_path(alias, date):
+    """
+    Return the path of the manifest listing the chunks of a dataset's snapshot
+    """
+
+    return SNAPSHOT_DIR + "/" + MANIFEST_DIR + "/" + alias + "/" + date + ".json"
+
+
+def read_manifest(alias, date):
+    """
+    Return the manifest of a dataset's snapshot on a date (YYYY-MM-DD)
+    """
+
+    path = get_manifest_path(alias, date)
+    if not os.path.exists(path):
+        raise KeyError("No snapshot of " + alias + " on " + date)
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def list_snapshots(alias):
+    """
+    Return the dates of every snapshot of a dataset, oldest first
+    """
+
+    manifest_dir = SNAPSHOT_DIR + "/" + MANIFEST_DIR + "/" + alias
+    if not os.path.isdir(manifest_dir):
+        return []
+
+    return sorted(
+        os.path.splitext(name)[0]
+        for name in os.listdir(manifest_dir)
+        if name.endswith(".json")
+    )
+
+
+def get_dataset_files(alias):
+    """
+    Return the path of every file a downloaded dataset is stored in (several for a
+    shapefile), keyed by its name without any storage compression extension
+    """
+
+    if not os.path.isdir(data_manager.DATASET_DIR):
+        return {}
+
+    files = {}
+    for name in sorted(os.listdir(data_manager.DATASET_DIR)):
+        if name.split(".")[0] != alias or name.endswith(
+            (data_manager.LOCK_EXT, data_manager.PARTIAL_EXT, data_manager.PARTIAL_INFO_EXT)
+        ):
+            continue
+
+        plain_name = name
+        for ext in data_manager.COMPRESSION_EXTS.values():
+            if name.endswith(ext):
+                plain_name = name[:-len(ext)]
+        files[plain_name] = data_manager.DATASET_DIR + "/" + name
+
+    return files
+
+
+def take_snapshot(metadata_row, date=None):
+    """
+    Snapshot the current version of a dataset under a date (today by default),
+    storing only the chunks no earlier snapshot already has. Returns the manifest
+    """
+
+    alias = metadata_row["Alias"]
+    date = date or datetime.date.today().isoformat()
+    start = time.perf_counter()
+
+    manifest = {"alias": alias, "date": date, "files": {}, "sizes": {}}
+    new_bytes = 0
+
+    # Hold the dataset's lock so an update cannot replace it partway through
+    with data_manager.file_lock(data_manager.DATASET_DIR + "/" + alias, shared=True):
+        for name, path in get_dataset_files(alias).items():
+            compression = pd.io.common.infer_compression(path, "infer")
+            digests = []
+            size = 0
+
+            # Chunk the decompressed contents, so versions dedupe however stored
+            with data_manager.open_dataset_file(path, compression, "rb") as f:
+                for chunk in get_chunks(f):
+                    digest, written = store_chunk(chunk)
+                    digests.append(digest)
+                    size += len(chunk)
+                    new_bytes += written
+
+            manifest["files"][name] = digests
+            manifest["sizes"][name] = size
+
+    path = get_manifest_path(alias, date)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_atomic(path, json.dumps(manifest).encode())
+
+    print(
+        "Snapshotted "
+        + alias
+        + " for "
+        + date
+        + " in "
+        + str(round(time.perf_counter() - start, 3))
+        + "s, "
+        + str(sum(manifest["sizes"].values()))
+        + " bytes stored as "
+        + str(new_bytes)
+        + " new bytes"
+    )
+
+    return manifest
+
+
+def take_snapshots(metadata_frame, aliases=None, date=None):
+    """
+    Snapshot the given datasets (every one by default), along with any downloaded
+    dataset that has never been snapshotted
+    """
+
+    for i, row in metadata_frame.iterrows():
+        alias = row["Alias"]
+        if len(get_dataset_files(alias)) == 0:
+            continue
+
+        if aliases is None or alias in aliases or len(list_snapshots(alias)) == 0:
+            take_snapshot(row, date)
+
+
+def rebuild_snapshot(alias, date, out_dir):
+    """
+    Rebuild the files of a dataset's snapshot into a directory, returning their paths
+    """
+
+    manifest = read_manifest(alias, date)
+    os.makedirs(out_dir, exist_ok=True)
+
+    paths = []
+    for name, digests in manifest["files"].items():
+        path = out_dir + "/" + name
+        with open(path, "wb", buffering=data_manager.WRITE_BUFFER_SZ) as f:
+            for digest in digests:
+                f.write(read_chunk(digest))
+        paths.append(path)
+
+    return paths
+
+
+def read_snapshot(metadata_row, date):
+    """
+    Return a dataset's snapshot as it was read on its date, with the columns and
+    dtypes in its schema
+    """
+
+    alias = metadata_row["Alias"]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        rebuild_snapshot(alias, date, tmp_dir)
+
+        # The data is read from a copy with the filename the dataset is stored under
+        previous_dir = data_manager.DATASET_DIR
+        data_manager.DATASET_DIR = tmp_dir
+        try:
+            return data_manager.retrieve_datasets(metadata_row.to_frame().T)[alias]
+        finally:
+            data_manager.DATASET_DIR = previous_dir
+
+
+def diff_snapshots(metadata_row, old_date, new_date):
+    """
+    Return every row of a CSV dataset that was added, removed, or changed between two
+    snapshots, keyed by the dataset's key columns (its jurisdictions and dates), with
+    the columns that changed. Only the chunks the two snapshots do not share are read
+    """
+
+    alias = metadata_row["Alias"]
+    schemas = data_manager.get_dataset_schemas()
+    schema = schemas[schemas["Alias"] == alias]
+    name = alias + ".csv"
+
+    old_digests = read_manifest(alias, old_date)["files"][name]
+    new_digests = read_manifest(alias, new_date)["files"][name]
+    old_rows = read_unshared_rows(old_digests, set(new_digests), schema, metadata_row)
+    new_rows = read_unshared_rows(new_digests, set(old_digests), schema, metadata_row)
+
+    # Rows are matched on their key columns, or on every column without any
+    keys = list(schema.loc[schema["Is_Key"], "Column"]) or list(old_rows.columns)
+    values = [column for column in old_rows.columns if column not in keys]
+    old_rows = old_rows.drop_duplicates(keys, keep="last")
+    new_rows = new_rows.drop_duplicates(keys, keep="last")
+
+    merged = old_rows.merge(
+        new_rows, on=keys, how="outer", suffixes=("_old", "_new"), indicator=True
+    )
+
+    change = np.select(
+        [merged["_merge"] == "left_only", merged["_merge"] == "right_only"],
+        ["removed", "added"],
+        "changed",
+    )
+
+    # Names of the columns that differ in every row found in both snapshots
+    changed_columns = pd.Series("", index=merged.index)
+    for column in values:
+        old_values, new_values = merged[column + "_old"], merged[column + "_new"]
+        differs = (old_values != new_values) & ~(old_values.isna() & new_values.isna())
+        changed_columns += np.where(differs & (change == "changed"), column + ", ", "")
+    changed_columns = changed_columns.str.slice(0, -2)
+
+    diff = merged[keys].assign(Change=change, Columns=changed_columns.to_numpy())
+    diff = diff[(diff["Change"] != "changed") | (diff["Columns"] != "")]
+
+    return diff.sort_values(keys).reset_index(drop=True)
+
+
+def read_unshared_rows(digests, shared_digests, schema, metadata_row):
+    """
+    Return the rows of a snapshot's CSV chunks that are not among the shared chunks,
+    read with the dataset's schema
+    """
+
+    # The header line starts the first chunk
+    first_chunk = read_chunk(digests[0])
+    header_end = first_chunk.index(b"\n") + 1
+    parts = [first_chunk[:header_end]]
+
+    for i, digest in enumerate(digests):
+        if digest in shared_digests:
+            continue
+        chunk = first_chunk if i == 0 else read_chunk(digest)
+        parts.append(chunk[header_end:] if i == 0 else chunk)
+
+    return data_manager.read_dataset(
+        io.BytesIO(b"".join(parts)),
+        schema,
+        data_manager.get_dataset_encoding(metadata_row),
+    )
+
+
+def get_store_size():
+    """
+    Return the number of bytes every stored chunk takes on disk
+    """
+
+    size = 0
+    for root, dirs, files in os.walk(SNAPSHOT_DIR + "/" + CHUNK_DIR):
+        size += sum(os.path.getsize(root + "/" + name) for name in files)
+
+    return size
+
+
+def test_snapshot_store():
+    """
+    Test that snapshots of a revised dataset share most chunks, rebuild byte for byte,
+    and diff to exactly the revised, added, and removed rows
+    """
+
+    global SNAPSHOT_DIR
+
+    rng = np.random.default_rng(0)
+    dates = pd.date_range("2020-01-01", periods=2000)
+    states = ["WA", "OR", "CA", "ID", "NV"]
+    old = pd.DataFrame(
+        {
+            "submission_date": np.repeat(dates.strftime("%m/%d/%Y"), len(states)),
+            "state": np.tile(states, len(dates)),
+            "new_case": rng.poisson(100, len(dates) * len(states)).astype(float),
+        }
+    )
+
+    # Upstream revises two past days, adds a day, and drops one state's first day
+    new = old.copy()
+    new.loc[(new["state"] == "OR") & (new["submission_date"] == "02/01/2021"), "new_case"] = -1.0
+    new.loc[(new["state"] == "CA") & (new["submission_date"] == "06/01/2021"), "new_case"] = -2.0
+    new = new.drop(new.index[2])
+    new = pd.concat(
+        [
+            new,
+            pd.DataFrame(
+                {
+                    "submission_date": (dates[-1] + pd.Timedelta(days=1)).strftime(
+                        "%m/%d/%Y"
+                    ),
+                    "state": states,
+                    "new_case": 5.0,
+                }
+            ),
+        ],
+        ignore_index=True,
+    )
+
+    metadata_row = pd.Series(
+        {
+            "Alias": "us_covid_data",
+            "URL": "",
+            "Is_ShapeFile": False,
+            "Is_Zip": False,
+            "Extract_FileName": np.nan,
+            "Update_Interval": 1,
+            "Checksum": np.nan,
+            "Encoding": np.nan,
+        }
+    )
+    previous_dirs = (SNAPSHOT_DIR, data_manager.DATASET_DIR)
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            SNAPSHOT_DIR = tmp_dir + "/snapshots"
+            data_manager.DATASET_DIR = tmp_dir + "/datasets"
+            os.mkdir(data_manager.DATASET_DIR)
+
+            contents = {}
+            for date, frame in [("2021-10-27", old), ("2021-10-28", new)]:
+                frame.to_csv(data_manager.DATASET_DIR + "/us_covid_data.csv", index=False)
+                with open(data_manager.DATASET_DIR + "/us_covid_data.csv", "rb") as f:
+                    contents[date] = f.read()
+                take_snapshot(metadata_row, date)
+
+            assert list_snapshots("us_covid_data") == ["2021-10-27", "2021-10-28"]
+
+            # The second version only adds the chunks around its revisions
+            store_size = get_store_size()
+            assert store_size < 1.5 * len(zlib.compress(contents["2021-10-27"]))
+
+            # Every version rebuilds exactly
+            for date, content in contents.items():
+                path = rebuild_snapshot("us_covid_data", date, tmp_dir + "/rebuilt")[0]
+                with open(path, "rb") as f:
+                    assert f.read() == content
+
+            snapshot = read_snapshot(metadata_row, "2021-10-27")
+            assert len(snapshot) == len(old)
+
+            diff = diff_snapshots(metadata_row, "2021-10-27", "2021-10-28")
+            assert list(zip(diff["state"], diff["Change"])) == [
+                ("CA", "removed"),
+                ("OR", "changed"),
+                ("CA", "changed"),
+            ] + [(state, "added") for state in sorted(states)]
+            assert (diff.loc[diff["Change"] == "changed", "Columns"] == "new_case").all()
+    finally:
+        SNAPSHOT_DIR, data_manager.DATASET_DIR = previous_dirs
+
+    print("Snapshot store test passed")
+
+
+def benchmark_snapshots(metadata_frame):
+    """
+    Time snapshotting and rebuilding every downloaded dataset, and compare the size of
+    the chunk store with keeping a full copy of every snapshot
+    """
+
+    results = []
+
+    for i, row in metadata_frame.iterrows():
+        alias = row["Alias"]
+        dates = list_snapshots(alias)
+        if len(dates) == 0:
+            continue
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            start = time.perf_counter()
+            rebuild_snapshot(alias, dates[-1], tmp_dir)
+            rebuild_seconds = time.perf_counter() - start
+
+        results.append(
+            {
+                "Alias": alias,
+                "Snapshots": len(dates),
+                "Bytes": sum(
+                    sum(read_manifest(alias, date)["sizes"].values()) for date in dates
+                ),
+                "Rebuild_Seconds": rebuild_seconds,
+            }
+        )
+
+    results = pd.DataFrame(results)
+    print(results)
+    if len(results) > 0:
+        print(
+            "Chunk store holds "
+            + str(results["Bytes"].sum())
+            + " bytes of snapshots in "
+            + str(get_store_size())
+            + " bytes"
+        )
+
+    return results
+
+
+def main():
+    """
+    Test all methods in snapshots, then snapshot the downloaded datasets
+    """
+
+    test_snapshot_store()
+
+    datasets = data_manager.get_dataset_info()
+    updated = data_manager.update_datasets(datasets)
+    take_snapshots(datasets, updated)
+
+    benchmark_snapshots(datasets)
+
+    # Show what upstream revised between the last two world snapshots
+    world_row = datasets[datasets["Alias"] == "world_covid_data"].iloc[0]
+    dates = list_snapshots("world_covid_data")
+    if len(dates) >= 2:
+        diff = diff_snapshots(world_row, dates[-2], dates[-1])
+        print(diff)
+        print(diff.groupby("iso_code").size().sort_values(ascending=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""
+Daniel Rashevsky
+CSE 163 AE
+This file validates retrieved datasets against the schemas declared in
+dataset_schemas.csv, so bad upstream data fails fast instead of deep in the pipeline
+"""
+
+import pandas as pd
+import numpy as np
+
+import concurrent.futures
+import multiprocessing
+import tempfile
+import pickle
+import time
+
+import data_manager
+
+REPORT_COLUMNS = ["Alias", "Check", "Column", "Failures", "Severity", "Example"]
+ERROR = "error"
+WARNING = "warning"
+
+
+class DatasetValidationError(Exception):
+    """
+    Raised when retrieved datasets fail validation, carrying the full report
+    """
+
+    def __init__(self, report):
+        super().__init__(
+            "Datasets failed validation:\n" + report.to_string(index=False)
+        )
+        self.report = report
+
+    def __reduce__(self):
+        # Rebuild from the report, so the error survives being sent back from a
+        # worker process
+        return DatasetValidationError, (self.report,)
+
+
+def validate_datasets(data, schemas=None):
+    """
+    Check every retrieved dataset for required columns, dtypes, key uniqueness, date
+    ranges, and value bounds. Returns a report of every failed check, raising a
+    DatasetValidationError if any of them is an error rather than a warning
+    """
+
+    start = time.perf_counter()
+    if schemas is None:
+        schemas = data_manager.get_dataset_schemas()
+
+    report = []
+    for alias, schema in schemas.groupby("Alias", sort=False):
+        if alias in data:
+            report += validate_dataset(alias, data[alias], schema)
+
+    report = pd.DataFrame(report, columns=REPORT_COLUMNS)
+    print(
+        "Validated "
+        + str(len(data))
+        + " datasets in "
+        + str(round(time.perf_counter() - start, 3))
+        + "s, "
+        + str((report["Severity"] == ERROR).sum())
+        + " errors, "
+        + str((report["Severity"] == WARNING).sum())
+        + " warnings"
+    )
+
+    if (report["Severity"] == ERROR).any():
+        raise DatasetValidationError(report)
+    if len(report) > 0:
+        print(report.to_string(index=False))
+
+    return report
+
+
+def validate_dataset(alias, frame, schema):
+    """
+    Return a report row for every check a single dataset fails
+    """
+
+    report = []
+
+    # Required columns, without which no other check on the column can run
+    missing = schema[~schema["Column"].isin(frame.columns)]
+    for column in missing["Column"]:
+        report.append(failure(alias, "missing column", column, 1, ERROR, None))
+    schema = schema[schema["Column"].isin(frame.columns)]
+
+    # Declared dtypes
+    for column, dtype in zip(schema["Column"], schema["Dtype"]):
+        if not has_dtype(frame[column], dtype):
+            report.append(
+                failure(alias, "dtype", column, 1, ERROR, str(frame[column].dtype))
+            )
+
+    # Key uniqueness
+    keys = list(schema.loc[schema["Is_Key"], "Column"])
+    if len(keys) > 0:
+        duplicated = frame.duplicated(subset=keys, keep=False)
+        if duplicated.any():
+            report.append(
+                failure(
+                    alias,
+                    "duplicate key",
+                    ", ".join(keys),
+                    int(duplicated.sum()),
+                    ERROR,
+                    tuple(frame.loc[duplicated.idxmax(), keys]),
+                )
+            )
+
+    # Date ranges and value bounds
+    bounded = schema[schema["Min_Value"].notna() | schema["Max_Value"].notna()]
+    for column, dtype, min_value, max_value in zip(
+        bounded["Column"], bounded["Dtype"], bounded["Min_Value"], bounded["Max_Value"]
+    ):
+        values = frame[column]
+        is_date = dtype.startswith("datetime64")
+        if is_date and not pd.api.types.is_datetime64_any_dtype(values):
+            continue
+        if not is_date and not pd.api.types.is_numeric_dtype(values):
+            continue
+
+        out_of_bounds = np.zeros(len(values), dtype=bool)
+        if pd.notna(min_value):
+            out_of_bounds |= (values < parse_bound(min_value, is_date)).to_numpy()
+        if pd.notna(max_value):
+            out_of_bounds |= (values > parse_bound(max_value, is_date)).to_numpy()
+
+        if out_of_bounds.any():
+            report.append(
+                failure(
+                    alias,
+                    "date range" if is_date else "value bounds",
+                    column,
+                    int(out_of_bounds.sum()),
+                    ERROR if is_date else WARNING,
+                    values.iloc[out_of_bounds.argmax()],
+                )
+            )
+
+    return report
+
+
+def has_dtype(values, dtype):
+    """
+    Return whether a column has the kind of dtype declared in its schema
+    """
+
+    if dtype == "str":
+        return pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values)
+    if dtype.startswith("datetime64"):
+        return pd.api.types.is_datetime64_any_dtype(values)
+    if dtype.startswith("int"):
+        return pd.api.types.is_integer_dtype(values)
+
+    return pd.api.types.is_numeric_dtype(values)
+
+
+def parse_bound(bound, is_date):
+    """
+    Return a schema Min_Value/Max_Value as a comparable date or number
+    """
+
+    if is_date:
+        return pd.Timestamp.now().normalize() if bound == "today" else pd.Timestamp(bound)
+
+    return float(bound)
+
+
+def failure(alias, check, column, failures, severity, example):
+    """
+    Return a report row for a failed check
+    """
+
+    return {
+        "Alias": alias,
+        "Check": check,
+        "Column": column,
+        "Failures": failures,
+        "Severity": severity,
+        "Example": example,
+    }
+
+
+def test_validation():
+    """
+    Test that each kind of bad data is caught and reported
+    """
+
+    schema = pd.DataFrame(
+        {
+            "Alias": "us_covid_data",
+            "Column": ["submission_date", "state", "new_case"],
+            "Dtype": ["datetime64[ns]", "str", "float64"],
+            "Date_Format": ["%m/%d/%Y", np.nan, np.nan],
+            "Is_Key": [True, True, False],
+            "Min_Value": ["2019-12-01", np.nan, "0"],
+            "Max_Value": ["today", np.nan, np.nan],
+        }
+    )
+    good = pd.DataFrame(
+        {
+            "submission_date": pd.to_datetime(["2021-01-01", "2021-01-02"]),
+            "state": ["WA", "WA"],
+            "new_case": [10.0, 20.0],
+        }
+    )
+
+    # Clean data passes without any report rows
+    assert len(validate_datasets({"us_covid_data": good}, schema)) == 0
+
+    # Negative corrections are only warnings
+    negative = good.assign(new_case=[10.0, -5.0])
+    report = validate_datasets({"us_covid_data": negative}, schema)
+    assert list(report["Check"]) == ["value bounds"]
+
+    # Renamed columns, duplicate keys, and impossible dates are errors
+    bad_frames = {
+        "missing column": good.rename(columns={"new_case": "new_cases"}),
+        "duplicate key": good.assign(submission_date=good["submission_date"].iloc[0]),
+        "date range": good.assign(submission_date=pd.to_datetime(["1900-01-01"] * 2)),
+        "dtype": good.assign(new_case=["10", "20"]),
+    }
+    for check, frame in bad_frames.items():
+        try:
+            validate_datasets({"us_covid_data": frame}, schema)
+            assert False, check + " was not detected"
+        except DatasetValidationError as e:
+            assert check in list(e.report["Check"])
+
+    # Retyped and reformatted columns are read as they are and reported, rather
+    # than failing while the dataset is read
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = tmp_dir + "/us_covid_data.csv"
+        pd.DataFrame(
+            {
+                "submission_date": ["01/01/2021", "2021-01-02"],
+                "state": ["WA", "WA"],
+                "new_case": ["10", "ten"],
+            }
+        ).to_csv(path, index=False)
+        frame = data_manager.read_dataset(path, schema)
+        try:
+            validate_datasets({"us_covid_data": frame}, schema)
+            assert False, "unreadable columns were not detected"
+        except DatasetValidationError as e:
+            assert list(e.report.loc[e.report["Check"] == "dtype", "Column"]) == [
+                "submission_date",
+                "new_case",
+            ]
+
+    # The report survives pickling, and so being raised in a worker process
+    error = pickle.loads(pickle.dumps(DatasetValidationError(report)))
+    assert error.report.equals(report) and str(error).endswith(
+        report.to_string(index=False)
+    )
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=1, mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        try:
+            pool.submit(
+                validate_datasets, {"us_covid_data": bad_frames["dtype"]}, schema
+            ).result()
+            assert False, "validation error was not raised in the worker"
+        except DatasetValidationError as e:
+            assert "dtype" in list(e.report["Check"])
+
+    print("Validation test passed")
+
+
+def main():
+    """
+    Test all methods in validation, then validate the downloaded datasets
+    """
+
+    test_validation()
+
+    datasets = data_manager.get_dataset_info()
+    data_manager.update_datasets(datasets)
+
+    start = time.perf_counter()
+    data = data_manager.retrieve_datasets(datasets)
+    print("Loaded datasets in " + str(round(time.perf_counter() - start, 3)) + "s")
+
+    validate_datasets(data)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,10 +9,18 @@ import geopandas as gpd
 import numpy as np
 
 from mpl_toolkits.axes_grid1 import make_axes_locatable
+from matplotlib.collections import LineCollection, PatchCollection
+from matplotlib.patches import PathPatch
+from matplotlib.path import Path
 import matplotlib.pyplot as plt
 import matplotlib.font_manager as fnt
+import matplotlib
+from PIL import Image, GifImagePlugin
 
+import subprocess
+import shutil
 import sys
+import time
 import os
 
 import data_manager
@@ -22,9 +30,24 @@ import analysis
 VIZ_PATH = "visualizations"
 MAP_EXT = "map"
 PLOT_EXT = "plot"
+ANIMATION_EXT = "animation"
 WORLD_EXT = "world"
 US_EXT = "us"
 NUM_MULTI_PLOTS = 7
+# One of "split" (NUM_MULTI_PLOTS separate line graphs) or "grid" (every
+# jurisdiction in one small multiples figure)
+MULTI_PLOT_MODE = "split"
+GRID_CELL_SIZE = (1.6, 0.9)
+GRID_CELL_PAD = 0.1
+# Downsample long series to a minimum and maximum per pixel column before plotting,
+# about 1280 pixels across a line graph and 256 across a grid cell's line at dpi=200
+DOWNSAMPLE_ENABLED = True
+LINE_DOWNSAMPLE_POINTS = 1280
+GRID_DOWNSAMPLE_POINTS = 256
+ANIMATION_DPI = 100
+ANIMATION_FPS = 12
+ANIMATION_SMOOTHING_DAYS = 7
+ANIMATION_COLOR_QUANTILE = 0.99
 
 
 def plot_map(data, column, name, extension, cmap, xlim=None, basemap=None, vmin=None, vmax=None):
@@ -36,21 +59,11 @@ def plot_map(data, column, name, extension, cmap, xlim=None, basemap=None, vmin=
 
     print("Graphing " + name + " for " + extension + "...")
 
-    # Create graph directory if needed
-    if not os.path.isdir(VIZ_PATH):
-        os.mkdir(VIZ_PATH)
-
     # Convert data to geodataframe
     data = gpd.GeoDataFrame(data)
 
-    # Setup map
-    (fig, ax) = plt.subplots(figsize=(18, 9), dpi=200)
-    ax.set_title(name)
-    cax = make_axes_locatable(ax).append_axes("right", size="5%", pad=0.1)
-
-    # Limit map x-axis to certain range
-    if xlim is not None:
-        ax.set_xlim(xlim)
+    # Setup map and plot basemap
+    (fig, ax, cax) = setup_map(name, xlim, basemap, 200)
 
     # Set normalization
     if (vmin is not None and vmax is not None):
@@ -58,10 +71,6 @@ def plot_map(data, column, name, extension, cmap, xlim=None, basemap=None, vmin=
     else:
         norm = None
 
-    # Plot basemap
-    if basemap is not None:
-        basemap.plot(ax=ax, color="#CCCCCC", cax=cax)
-
     # Plot column
     data.plot(column=column, legend=True, ax=ax, cax=cax, cmap=cmap, norm=norm)
 
@@ -76,6 +85,251 @@ def plot_map(data, column, name, extension, cmap, xlim=None, basemap=None, vmin=
     plt.close(fig)
 
 
+def setup_map(name, xlim, basemap, dpi):
+    """
+    Create the graph directory if needed and return a titled map figure, its axes,
+    and its colorbar axes, with the x-axis limited to an optional range and an
+    optional basemap plotted underneath
+    """
+
+    # Create graph directory if needed
+    if not os.path.isdir(VIZ_PATH):
+        os.mkdir(VIZ_PATH)
+
+    # Setup map
+    (fig, ax) = plt.subplots(figsize=(18, 9), dpi=dpi)
+    ax.set_title(name)
+    cax = make_axes_locatable(ax).append_axes("right", size="5%", pad=0.1)
+
+    # Limit map x-axis to certain range
+    if xlim is not None:
+        ax.set_xlim(xlim)
+
+    # Plot basemap
+    if basemap is not None:
+        basemap.plot(ax=ax, color="#CCCCCC", cax=cax)
+
+    return fig, ax, cax
+
+
+def get_polygon_paths(geometries):
+    """
+    Return a matplotlib path for every polygon in a sequence of polygon and
+    multipolygon geometries, along with the position of the geometry each came from
+    """
+
+    paths = []
+    owners = []
+
+    for i, geometry in enumerate(geometries):
+        if geometry is None or geometry.is_empty:
+            continue
+
+        polygons = geometry.geoms if geometry.geom_type == "MultiPolygon" else [geometry]
+        for polygon in polygons:
+            rings = [polygon.exterior] + list(polygon.interiors)
+            paths.append(
+                Path.make_compound_path(
+                    *[Path(np.asarray(ring.coords)[:, :2]) for ring in rings]
+                )
+            )
+            owners.append(i)
+
+    return paths, np.array(owners, dtype=int)
+
+
+def plot_map_animation(
+    daily_results,
+    column,
+    name,
+    extension,
+    cmap,
+    jurisdiction_col,
+    date_col,
+    xlim=None,
+    basemap=None,
+    vmin=None,
+    vmax=None,
+):
+    """
+    Given per-row daily results with geometry, a column to map, name, data category
+    extension, colormap, jurisdiction and date columns, optional x-axis range,
+    optional basemap geodataframe, and optional vmin/vmax, saves a time-lapse of the
+    column's ANIMATION_SMOOTHING_DAYS average for every day as an MP4 (or a GIF
+    without ffmpeg, or if it fails). The map and every jurisdiction's polygons are
+    drawn once, and each frame only recolors them. Returns the path of the saved
+    animation
+    """
+
+    print("Animating " + name + " for " + extension + "...")
+
+    # Smoothed values as a date x jurisdiction matrix, and each jurisdiction's geometry
+    matrix = daily_results.pivot_table(
+        index=date_col, columns=jurisdiction_col, values=column, dropna=False
+    )
+    matrix = matrix.reindex(pd.date_range(matrix.index.min(), matrix.index.max()))
+    matrix = matrix.rolling(ANIMATION_SMOOTHING_DAYS, min_periods=1).mean()
+    geometry = daily_results.dropna(subset=["geometry"]).drop_duplicates(
+        jurisdiction_col
+    ).set_index(jurisdiction_col)["geometry"]
+    paths, owners = get_polygon_paths(geometry.reindex(matrix.columns))
+    values = matrix.to_numpy(dtype=float)[:, owners]
+
+    # Keep colors comparable across frames
+    if vmin is None:
+        vmin = min(0.0, np.nanmin(values))
+    if vmax is None:
+        vmax = np.nanquantile(values, ANIMATION_COLOR_QUANTILE)
+    norm = plt.Normalize(vmin=vmin, vmax=vmax)
+
+    # Setup map, basemap, polygons, and colorbar once
+    (fig, ax, cax) = setup_map(name, xlim, basemap, ANIMATION_DPI)
+    polygons = PatchCollection(
+        [PathPatch(path) for path in paths],
+        cmap=plt.get_cmap(cmap).with_extremes(bad="#EEEEEE"),
+        norm=norm,
+        edgecolor="#666666",
+        linewidth=0.2,
+        animated=True,
+    )
+    polygons.set_array(np.ma.masked_invalid(values[0]))
+    ax.add_collection(polygons)
+    fig.colorbar(polygons, cax=cax)
+    if xlim is None:
+        ax.autoscale_view()
+    date_label = ax.text(
+        0.01,
+        0.03,
+        "",
+        transform=ax.transAxes,
+        fontsize="x-large",
+        fontweight="bold",
+        animated=True,
+    )
+
+    # Render everything but the polygons and date once, then only redraw those two
+    # over a copy of it for every frame
+    fig.canvas.draw()
+    background = fig.canvas.copy_from_bbox(fig.bbox)
+    width, height = fig.canvas.get_width_height()
+
+    def draw_frame(i):
+        fig.canvas.restore_region(background)
+        polygons.set_array(np.ma.masked_invalid(values[i]))
+        date_label.set_text(str(matrix.index[i])[:10])
+        ax.draw_artist(polygons)
+        ax.draw_artist(date_label)
+        return bytes(fig.canvas.buffer_rgba())
+
+    # Save animation, piping raw frames to ffmpeg if it is installed
+    ffmpeg = shutil.which(matplotlib.rcParams["animation.ffmpeg_path"])
+    path = VIZ_PATH + "/" + ANIMATION_EXT + "_" + extension + "_" + name
+    if ffmpeg is not None:
+        encoder = subprocess.Popen(
+            [
+                ffmpeg, "-y", "-loglevel", "error",
+                "-f", "rawvideo", "-pix_fmt", "rgba",
+                "-s", str(width) + "x" + str(height), "-r", str(ANIMATION_FPS),
+                "-i", "-",
+                "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+                "-vcodec", "libx264", "-pix_fmt", "yuv420p",
+                path + ".mp4",
+            ],
+            stdin=subprocess.PIPE,
+        )
+        try:
+            for i in range(len(matrix)):
+                encoder.stdin.write(draw_frame(i))
+            encoder.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        if encoder.wait() == 0:
+            plt.close(fig)
+            return path + ".mp4"
+
+        print("ffmpeg failed to encode " + name + ", saving a GIF instead")
+        if os.path.exists(path + ".mp4"):
+            os.remove(path + ".mp4")
+
+    # Map every GIF frame onto the palette of the last one, which is the most filled
+    # in, and write each frame as soon as it is drawn
+    def get_gif_frame(i):
+        image = Image.frombuffer("RGBA", (width, height), draw_frame(i)).convert("RGB")
+        return image.quantize(palette=palette, dither=Image.Dither.NONE)
+
+    palette = (
+        Image.frombuffer("RGBA", (width, height), draw_frame(len(matrix) - 1))
+        .convert("RGB")
+        .quantize(colors=256)
+    )
+    with open(path + ".gif", "wb") as f:
+        header = GifImagePlugin.getheader(
+            get_gif_frame(0), info={"loop": 0, "optimize": False}
+        )[0]
+        f.write(b"".join(header))
+        for i in range(len(matrix)):
+            f.write(
+                b"".join(
+                    GifImagePlugin.getdata(
+                        get_gif_frame(i), duration=1000 // ANIMATION_FPS
+                    )
+                )
+            )
+        f.write(b";")
+
+    # Close figure
+    plt.close(fig)
+
+    return path + ".gif"
+
+
+def benchmark_map_animation(
+    daily_results, column, extension, jurisdiction_col, date_col, basemap, xlim=None
+):
+    """
+    Time an animated map of a column per frame against a full plot_map call for a
+    single day
+    """
+
+    start = time.perf_counter()
+    plot_map_animation(
+        daily_results,
+        column,
+        "benchmark_animation",
+        extension,
+        "Reds",
+        jurisdiction_col,
+        date_col,
+        xlim=xlim,
+        basemap=basemap,
+    )
+    num_frames = daily_results[date_col].nunique()
+    per_frame = (time.perf_counter() - start) / num_frames
+
+    start = time.perf_counter()
+    last_day = daily_results[daily_results[date_col] == daily_results[date_col].max()]
+    plot_map(
+        last_day, column, "benchmark_single_day", extension, "Reds", xlim=xlim, basemap=basemap
+    )
+    full_map = time.perf_counter() - start
+
+    results = pd.DataFrame(
+        [
+            {
+                "Frames": num_frames,
+                "Seconds_Per_Frame": per_frame,
+                "Seconds_Per_Plot_Map": full_map,
+                "Frame_Fraction": per_frame / full_map,
+                "Minutes_For_365_Frames": 365 * per_frame / 60,
+            }
+        ]
+    )
+    print(results)
+
+    return results
+
+
 def plot_line_graph(data, columns, name, extension):
     """
     Given a dataframe, column to graph, name, and data category extension
@@ -98,6 +352,8 @@ def plot_line_graph(data, columns, name, extension):
 
     # Plot columns
     data = data[columns]
+    if DOWNSAMPLE_ENABLED:
+        data = downsample(data, LINE_DOWNSAMPLE_POINTS)
     data.plot(legend=True, ax=ax)
     ax.legend(bbox_to_anchor=(1.05, 1), loc="upper left", prop=fontP)
     fig.autofmt_xdate()
@@ -112,18 +368,64 @@ def plot_line_graph(data, columns, name, extension):
     plt.close(fig)
 
 
-def plot_multi_line_graph(data, title, extension):
+def plot_heatmap(data, name, extension, cmap="RdBu_r", vmin=-1.0, vmax=1.0):
+    """
+    Given a dataframe of values with jurisdictions as rows and another variable as
+    columns, a name, data category extension, colormap, and color range, plots a heatmap
+    """
+
+    print("Graphing " + name + " for " + extension + "...")
+
+    # Create graph directory if needed
+    if not os.path.isdir(VIZ_PATH):
+        os.mkdir(VIZ_PATH)
+
+    # Size the graph so every jurisdiction gets a readable row
+    (fig, ax) = plt.subplots(figsize=(12, max(4, 0.12 * len(data))), dpi=200)
+    ax.set_title(name)
+
+    # Plot values
+    image = ax.imshow(
+        data.to_numpy(dtype=float), aspect="auto", cmap=cmap, vmin=vmin, vmax=vmax,
+        interpolation="nearest",
+    )
+    fig.colorbar(image, ax=ax, fraction=0.03, pad=0.02)
+
+    # Label rows with jurisdictions and columns with a subset of their values
+    ax.set_yticks(range(len(data.index)))
+    ax.set_yticklabels(data.index, fontsize="xx-small")
+    col_step = max(1, len(data.columns) // 20)
+    ax.set_xticks(range(0, len(data.columns), col_step))
+    ax.set_xticklabels(data.columns[::col_step], fontsize="x-small")
+    ax.set_xlabel(data.columns.name)
+
+    # Save heatmap
+    fig.savefig(
+        VIZ_PATH + "/" + PLOT_EXT + "_" + extension + "_" + name + ".png",
+        bbox_inches="tight",
+    )
+
+    # Close figure
+    plt.close(fig)
+
+
+def plot_multi_line_graph(data, title, extension, mode=None):
     """
     Given a dataframe containing a single statistic to map and multiple columns
     representing different jurisdictions, a common graph title, and a data category
-    extension, create a series of plots containing the graphs of that statistic
-    across those jurisdictions
+    extension, graph that statistic across those jurisdictions, either as one grid of
+    small multiples or as a series of line graphs depending on MULTI_PLOT_MODE
     """
 
-    # Divide dataframe into several plots
+    mode = MULTI_PLOT_MODE if mode is None else mode
+    if mode == "grid":
+        plot_small_multiples(data, title, extension)
+        return
+
+    # Divide dataframe into at most NUM_MULTI_PLOTS plots
     cols = list(data.columns)
     total_cols = len(cols)
-    vars_per_plot = total_cols // NUM_MULTI_PLOTS
+    vars_per_plot = max(1, -(-total_cols // NUM_MULTI_PLOTS))
 
     # Graph, name, and save each plot
     for i in range(0, total_cols, vars_per_plot):
@@ -135,6 +437,235 @@ def plot_multi_line_graph(data, title, extension):
         )
 
 
+def plot_small_multiples(data, name, extension):
+    """
+    Given a dataframe containing a single statistic with a column for every
+    jurisdiction, a name, and data category extension, plots every jurisdiction's
+    line in its own cell of one grid, with every cell sharing the same date and value
+    range. All lines are drawn as a single collection on one set of axes
+    """
+
+    print("Graphing " + name + " for " + extension + "...")
+
+    # Create graph directory if needed
+    if not os.path.isdir(VIZ_PATH):
+        os.mkdir(VIZ_PATH)
+
+    if DOWNSAMPLE_ENABLED:
+        data = downsample(data, GRID_DOWNSAMPLE_POINTS)
+
+    # Lay out a grid about as wide as it is tall
+    values = data.to_numpy(dtype=float)
+    num_cells = values.shape[1]
+    aspect = GRID_CELL_SIZE[1] / GRID_CELL_SIZE[0]
+    num_cols = max(1, int(np.ceil(np.sqrt(num_cells * aspect))))
+    num_rows = max(1, -(-num_cells // num_cols))
+    cell_cols = np.arange(num_cells) % num_cols
+    cell_rows = num_rows - 1 - np.arange(num_cells) // num_cols
+
+    # Scale dates and values into each cell, leaving padding around the line
+    low = min(0.0, np.nanmin(values)) if np.isfinite(values).any() else 0.0
+    high = np.nanmax(values) if np.isfinite(values).any() else 1.0
+    span = high - low if high > low else 1.0
+    x = GRID_CELL_PAD + np.linspace(0, 1 - 2 * GRID_CELL_PAD, len(values))
+    y = GRID_CELL_PAD + (values - low) / span * (1 - 3 * GRID_CELL_PAD)
+    segments = np.stack(
+        [
+            np.broadcast_to(x[:, None] + cell_cols, values.shape),
+            y + cell_rows,
+        ],
+        axis=-1,
+    ).transpose(1, 0, 2)
+
+    # Setup graph
+    (fig, ax) = plt.subplots(
+        figsize=(GRID_CELL_SIZE[0] * num_cols, GRID_CELL_SIZE[1] * num_rows + 0.6),
+        dpi=200,
+    )
+    ax.set_title(
+        name
+        + "\n"
+        + str(data.index.min())[:10]
+        + " to "
+        + str(data.index.max())[:10]
+        + ", every cell from "
+        + "{:.3g}".format(low)
+        + " to "
+        + "{:.3g}".format(high),
+        fontsize="small",
+    )
+    ax.set_xlim(0, num_cols)
+    ax.set_ylim(0, num_rows)
+    ax.axis("off")
+
+    # Plot every line and cell border at once, then label each cell
+    ax.add_collection(LineCollection(segments, linewidths=0.6, colors="#B22222"))
+    ax.add_collection(
+        LineCollection(
+            [
+                [(col, row), (col + 1, row), (col + 1, row + 1), (col, row + 1), (col, row)]
+                for col, row in zip(cell_cols, cell_rows)
+            ],
+            linewidths=0.3,
+            colors="#AAAAAA",
+        )
+    )
+    for label, col, row in zip(data.columns, cell_cols, cell_rows):
+        ax.text(
+            col + GRID_CELL_PAD / 2,
+            row + 1 - GRID_CELL_PAD / 2,
+            str(label),
+            fontsize=4,
+            va="top",
+        )
+
+    # Save graph
+    fig.savefig(
+        VIZ_PATH + "/" + PLOT_EXT + "_" + extension + "_" + name + ".png",
+        bbox_inches="tight",
+    )
+
+    # Close figure
+    plt.close(fig)
+
+
+def downsample(data, points):
+    """
+    Given a dataframe with a row for every day and a column for every series, return
+    at most about the given number of rows, keeping each series' minimum and maximum
+    (in the order they occurred) within every bucket of consecutive days. Every series
+    is bucketed at once, and shorter dataframes are returned unchanged
+    """
+
+    num_days = len(data)
+    if num_days <= points:
+        return data
+
+    # Split days into equal buckets, padding the last one with empty days
+    bucket_size = -(-num_days // (points // 2))
+    num_buckets = -(-num_days // bucket_size)
+    values = data.to_numpy(dtype=float)
+    values = np.concatenate(
+        [values, np.full((num_buckets * bucket_size - num_days, values.shape[1]), np.nan)]
+    ).reshape(num_buckets, bucket_size, values.shape[1])
+
+    # Find each bucket's extremes for every series, ignoring empty days
+    empty = np.isnan(values)
+    lowest = np.where(empty, np.inf, values).argmin(axis=1)
+    highest = np.where(empty, -np.inf, values).argmax(axis=1)
+    lows = np.take_along_axis(values, lowest[:, None, :], axis=1)[:, 0, :]
+    highs = np.take_along_axis(values, highest[:, None, :], axis=1)[:, 0, :]
+    low_first = lowest <= highest
+
+    # Each bucket becomes its first extreme at its start and the other halfway through
+    downsampled = np.empty((2 * num_buckets, values.shape[2]))
+    downsampled[0::2] = np.where(low_first, lows, highs)
+    downsampled[1::2] = np.where(low_first, highs, lows)
+    starts = np.arange(num_buckets) * bucket_size
+    positions = np.stack(
+        [starts, np.minimum(starts + bucket_size // 2, num_days - 1)], axis=1
+    ).ravel()
+
+    return pd.DataFrame(downsampled, index=data.index[positions], columns=data.columns)
+
+
+def test_downsample():
+    """
+    Test that downsampling keeps every series' extremes and gaps, and leaves short
+    series alone
+    """
+
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame(
+        rng.normal(0, 1, (1000, 3)).cumsum(axis=0),
+        index=pd.date_range("2020-01-01", periods=1000),
+        columns=["A", "B", "C"],
+    )
+    data.iloc[200:400, 1] = np.nan
+
+    downsampled = downsample(data, 100)
+    assert len(downsampled) <= 100
+    assert downsampled.index.is_monotonic_increasing
+    assert np.allclose(downsampled.max(), data.max())
+    assert np.allclose(downsampled.min(), data.min())
+    assert downsampled.loc["2020-08-01":"2021-01-01", "B"].isna().all()
+    assert downsample(data, 2000) is data
+
+    print("Downsampling test passed")
+
+
+def benchmark_downsampling(data, extension):
+    """
+    Time graphing every jurisdiction in a date x jurisdiction dataframe as a grid and
+    as split line graphs with and without downsampling, along with the size of the
+    PNGs written
+    """
+
+    global DOWNSAMPLE_ENABLED
+    previous = DOWNSAMPLE_ENABLED
+    results = []
+
+    try:
+        for mode in ["grid", "split"]:
+            for enabled in [False, True]:
+                DOWNSAMPLE_ENABLED = enabled
+                name = "benchmark_downsample_" + mode + "_" + str(enabled).lower()
+
+                start = time.perf_counter()
+                plot_multi_line_graph(data, name, extension, mode)
+                seconds = time.perf_counter() - start
+
+                paths = [
+                    VIZ_PATH + "/" + path
+                    for path in os.listdir(VIZ_PATH)
+                    if path.startswith(PLOT_EXT + "_" + extension + "_" + name)
+                ]
+                results.append(
+                    {
+                        "Mode": mode,
+                        "Downsampled": enabled,
+                        "Days": len(data),
+                        "Jurisdictions": len(data.columns),
+                        "Seconds": seconds,
+                        "Megabytes": sum(os.path.getsize(path) for path in paths) / 1e6,
+                    }
+                )
+    finally:
+        DOWNSAMPLE_ENABLED = previous
+
+    results = pd.DataFrame(results)
+    print(results)
+
+    return results
+
+
+def benchmark_multi_line_graph(data, extension):
+    """
+    Time graphing every jurisdiction in a date x jurisdiction dataframe as split line
+    graphs and as a grid of small multiples, per jurisdiction
+    """
+
+    results = []
+
+    for mode in ["split", "grid"]:
+        start = time.perf_counter()
+        plot_multi_line_graph(data, "benchmark_" + mode, extension, mode)
+        seconds = time.perf_counter() - start
+        results.append(
+            {
+                "Mode": mode,
+                "Jurisdictions": len(data.columns),
+                "Seconds": seconds,
+                "Milliseconds_Per_Jurisdiction": 1000 * seconds / len(data.columns),
+            }
+        )
+
+    results = pd.DataFrame(results)
+    print(results)
+
+    return results
+
+
 def main():
     """
     Tests all functionality and creates graphs tracking new cases and vaccinations over time for the US and world,
@@ -193,6 +724,40 @@ def main():
         basemap=data["world_countries_map"],
     )
 
+    # Test visualization: graph daily new cases per capita for every country in a grid,
+    # and time it against split line graphs
+    daily_world_cases = world_results[0].pivot_table(
+        index="date", columns="location", values="new_cases"
+    )
+    plot_multi_line_graph(
+        daily_world_cases,
+        "daily_new_cases_per_capita_over_time_for_all_countries",
+        WORLD_EXT,
+        mode="grid",
+    )
+    benchmark_multi_line_graph(daily_world_cases, WORLD_EXT)
+
+    # Test visualization: animate daily new cases per capita by country, and time it
+    # per frame against a full map
+    plot_map_animation(
+        world_results[0],
+        "new_cases",
+        "daily_new_cases_per_capita_by_country",
+        WORLD_EXT,
+        "Reds",
+        "iso_code",
+        "date",
+        basemap=data["world_countries_map"],
+    )
+    benchmark_map_animation(
+        world_results[0], "new_cases", WORLD_EXT, "iso_code", "date",
+        data["world_countries_map"],
+    )
+
+    # Test downsampling, and time graphing with and without it
+    test_downsample()
+    benchmark_downsampling(daily_world_cases, WORLD_EXT)
+
 
 if __name__ == "__main__":
     main()